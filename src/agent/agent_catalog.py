@@ -0,0 +1,160 @@
+"""
+===================================================================================================
+Title : agent_catalog.py
+
+Description : shared in-memory catalog of downloadable network files, indexed by file size
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import csv
+import json
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from typing import NamedTuple, Optional
+from application import Agent
+from log import LogWriter
+from fetcher import ControlFetcher
+
+cls_agent = Agent()
+log_writer = LogWriter()
+fetcher = ControlFetcher()
+
+# How long we keep serving a stale catalog, before trying to refresh again, when a refresh fails
+CONST_REFRESH_RETRY_SECS = 60
+
+class CatalogEntry(NamedTuple):
+    address: str
+    name: str
+    md5: str
+
+# The CSV is parsed once per refresh into per fileSize buckets, the buckets are never mutated once
+# published, so readers only need the reference and no lock - a refresh swaps the reference atomically.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class FileCatalog:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(FileCatalog, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__buckets = {}                      # fileSize -> tuple(CatalogEntry)
+            self.__expires_at = 0.0                  # time.monotonic() when the buckets go stale
+            self.__refresh_lock = threading.Lock()   # single-flight, only one worker refreshes
+
+    def __download_csv(self):
+        response = fetcher.fetch(cls_agent.Configuration.CSV_URL)
+
+        # a 304 means the file on disk is still current, only the cache time needs moving on
+        if response.modified or not os.path.exists(cls_agent.Configuration.CACHE_FILE):
+            os.makedirs(os.path.dirname(cls_agent.Configuration.CACHE_FILE), exist_ok=True)
+            with open(cls_agent.Configuration.CACHE_FILE, 'w', newline='') as file:
+                file.write(response.text)
+        #endIf
+        with open(cls_agent.Configuration.CACHE_INFO_FILE, 'w') as info_file:
+            cache_info = {'download_time': time.time()}
+            json.dump(cache_info, info_file)
+
+    # Returns the age in seconds of the on-disk cache, or None if there is no usable cache
+    def __disk_cache_age(self) -> Optional[float]:
+        if os.path.exists(cls_agent.Configuration.CACHE_FILE) and os.path.exists(cls_agent.Configuration.CACHE_INFO_FILE):
+            try:
+                with open(cls_agent.Configuration.CACHE_INFO_FILE, 'r') as info_file:
+                    cache_info = json.load(info_file)
+                return time.time() - float(cache_info['download_time'])
+            except (ValueError, KeyError, OSError):
+                return None
+            #endTry
+        #endIf
+        return None
+
+    # texts are one or more CSV files, a local directory of them is one catalog
+    def __parse_csv(self, texts: list) -> dict:
+        buckets = {}
+        for text in texts:
+            reader = csv.DictReader(row for row in text.splitlines() if not row.startswith('#'))
+            for row in reader:
+                filesize = (row.get('fileSize') or "").strip().lower()
+                address = (row.get('address') or "").strip()
+                if not filesize or not address:
+                    continue
+                #endIf
+                entry = CatalogEntry(address=address, name=(row.get('name') or "").strip(), md5=(row.get('md5') or "").strip())
+                buckets.setdefault(filesize, []).append(entry)
+            #endFor
+        #endFor
+        return {filesize: tuple(entries) for filesize, entries in buckets.items()}
+
+    def __refresh(self):
+        # Single-flight - whoever gets the lock refreshes, everyone else waits then re-checks the expiry
+        with self.__refresh_lock:
+            if time.monotonic() < self.__expires_at:
+                return
+            #endIf
+
+            try:
+                if fetcher.is_local(cls_agent.Configuration.CSV_URL):
+                    # read straight from disk, there is nothing to gain from the cache - the ControlWatcher
+                    # invalidates the catalog as soon as the source changes
+                    buckets = self.__parse_csv([response.text for response in fetcher.fetch_all(cls_agent.Configuration.CSV_URL, suffix=".csv")])
+                    age = 0.0
+                else:
+                    age = self.__disk_cache_age()
+                    if age is None or age >= cls_agent.Configuration.CACHE_TIME:
+                        self.__download_csv()
+                        age = 0.0
+                    #endIf
+                    with open(cls_agent.Configuration.CACHE_FILE, newline='') as csvfile:
+                        buckets = self.__parse_csv([csvfile.read()])
+                    #endWith
+                #endIfElse
+            except (requests.exceptions.RequestException, OSError, csv.Error) as e:
+                if self.__buckets:
+                    log_writer.log("> > FileCatalog/__refresh: refresh failed, serving stale catalog: %s", logging.WARNING, e)
+                    self.__expires_at = time.monotonic() + CONST_REFRESH_RETRY_SECS
+                    return
+                #endIf
+                raise
+            #endTry
+
+            # publish the new buckets, then the new expiry
+            self.__buckets = buckets
+            self.__expires_at = time.monotonic() + max(cls_agent.Configuration.CACHE_TIME - age, 0)
+            if log_writer.is_enabled(logging.DEBUG):
+                log_writer.log("> > FileCatalog/__refresh: catalog loaded %s", logging.DEBUG, ', '.join(f'{k}={len(v)}' for k, v in buckets.items()))
+            #endIf
+        #endWith
+
+    def get_file(self, filesize: str) -> Optional[CatalogEntry]:
+        if time.monotonic() >= self.__expires_at:
+            self.__refresh()
+        #endIf
+
+        bucket = self.__buckets.get(filesize.lower())
+        if bucket:
+            return random.choice(bucket)
+        else:
+            return None
+        #endIf
+
+    def invalidate(self):
+        self.__expires_at = 0.0
@@ -0,0 +1,149 @@
+"""
+===================================================================================================
+Title : agent_concurrency.py
+
+Description : adaptive (AIMD) concurrency for the download workers of a task
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from agent.agent_concurrency import ConcurrencyController
+# controller = ConcurrencyController(task_ref, ceiling=workers)
+# if controller.acquire(timeout=60):
+#     ... run the client ...
+#     controller.release(seconds, network_error)
+
+import logging
+import os
+import threading
+import time
+from application import Agent
+from log import LogWriter
+from agent.agent_performance import Performance
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# The task starts all of its workers (up to the XML 'workers' value, the ceiling), but each download has to hold a
+# slot, and only 'limit' slots exist.  After every window of results - one per slot, so roughly one round of
+# downloads - the limit is adjusted:
+#   backed off (limit x CONCURRENCY_BACKOFF) if the network error rate, the latency against the best seen, or the
+#   host load average is too high
+#   otherwise raised by one, up to the ceiling
+# so the workers ramp up while the network is healthy, and halve as soon as it isn't.
+#
+# Notes : one instance per task run, it is shared by that run's workers.
+class ConcurrencyController:
+    def __init__(self, task_ref: str, ceiling: int):
+        self.task_ref = task_ref
+        self.ceiling = max(int(ceiling), 1)
+        self.floor = min(cls_agent.Configuration.CONCURRENCY_MIN, self.ceiling)
+        if cls_agent.Configuration.CONCURRENCY_ENABLED:
+            self.limit = max(min(cls_agent.Configuration.CONCURRENCY_INITIAL, self.ceiling), self.floor)
+        else:
+            self.limit = self.ceiling
+        #endIfElse
+
+        self.__condition = threading.Condition()
+        self.__inflight = 0
+        self.__latencies = []       # successful downloads in this window, seconds
+        self.__errors = 0           # network errors in this window
+        self.__baseline = None      # best window mean latency seen, creeps up if the network gets slower for good
+        self.__publish(self.__gauge("start"))
+
+    # Blocks until a slot is free (True), the timeout passes, or abort() returns True (False)
+    def acquire(self, timeout: float = None, abort=None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__condition:
+            while self.__inflight >= self.limit:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or (abort is not None and abort()):
+                    return False
+                #endIf
+                # woken by a release, the slice only bounds how late an abort is noticed
+                self.__condition.wait(5 if remaining is None else min(remaining, 5))
+            #endWhile
+            self.__inflight += 1
+            return True
+        #endWith
+
+    def release(self, seconds: float, network_error: bool = False):
+        gauge = None
+        with self.__condition:
+            self.__inflight -= 1
+            if network_error:
+                self.__errors += 1
+            elif seconds > 0:
+                self.__latencies.append(seconds)
+            #endIfElse
+            if cls_agent.Configuration.CONCURRENCY_ENABLED and len(self.__latencies) + self.__errors >= self.limit:
+                gauge = self.__adjust()
+            #endIf
+            self.__condition.notify_all()
+        #endWith
+        # published once the lock is released, it writes to the metrics file / influx and workers wait on the lock
+        if gauge is not None:
+            self.__publish(gauge)
+        #endIf
+
+    def __load_per_cpu(self) -> float:
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0.0  # not available on this platform
+        #endTry
+
+    # Called under the condition at the end of each window, returns the gauge to publish if the limit changed
+    def __adjust(self):
+        samples = len(self.__latencies) + self.__errors
+        error_rate = self.__errors / samples
+        latency = sum(self.__latencies) / len(self.__latencies) if self.__latencies else None
+        load = self.__load_per_cpu()
+        self.__latencies, self.__errors = [], 0
+
+        reason = None
+        if error_rate > cls_agent.Configuration.CONCURRENCY_ERROR_RATE:
+            reason = f"network errors {error_rate:.0%}"
+        elif latency is not None and self.__baseline is not None and latency > self.__baseline * cls_agent.Configuration.CONCURRENCY_LATENCY_TOLERANCE:
+            reason = f"latency {latency:.1f}s against {self.__baseline:.1f}s"
+        elif load > cls_agent.Configuration.CONCURRENCY_LOAD_PER_CPU:
+            reason = f"load {load:.2f} per cpu"
+        #endIfElse
+
+        if latency is not None:
+            self.__baseline = latency if self.__baseline is None else min(latency, self.__baseline * 1.05)
+        #endIf
+
+        previous = self.limit
+        if reason:
+            self.limit = max(self.floor, int(self.limit * cls_agent.Configuration.CONCURRENCY_BACKOFF))
+        else:
+            self.limit = min(self.ceiling, self.limit + 1)
+        #endIfElse
+        if self.limit != previous:
+            log_writer.log("Task %s concurrency %s -> %s%s", logging.INFO, self.task_ref, previous, self.limit, f" ({reason})" if reason else "")
+            return self.__gauge(reason or "increase")
+        #endIf
+        return None
+
+    # The gauge fields, taken under the condition so they are consistent
+    def __gauge(self, reason: str) -> dict:
+        return {"limit": self.limit, "ceiling": self.ceiling, "inflight": self.__inflight, "reason": reason}
+
+    def __publish(self, gauge: dict):
+        Performance().set_gauge("concurrency", {"task": self.task_ref}, gauge)
+
+    def close(self):
+        with self.__condition:
+            gauge = self.__gauge("stop")
+        #endWith
+        self.__publish(gauge)
@@ -15,20 +15,21 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
-import inspect
 import logging
 from log import LogWriter
 from dataclasses import dataclass
-from client.autonomi import ant_client
+from client.autonomi import ant_client, ant_engine
+from client.progress import ant_progress
 from agent.agent_performance import Performance
 from application import Agent
 from agent.agent_limiter import Limiter
-import csv 
-import os 
-import random 
-import requests 
+from agent.agent_catalog import FileCatalog
+from agent.agent_verify import FileVerifier
+from agent.agent_scratch import ScratchSpace
+import asyncio
+import random
 import time 
-import json
+from datetime import datetime, timedelta
 import kill_switch
 from agent.agent_helper import Utils
 
@@ -37,8 +38,18 @@ cls_agent = Agent()
 #logging handler
 log_writer = LogWriter()
 
-#get a handle to kill switch detection
-killswitch_checker = kill_switch.GitHubRepoIssuesChecker()
+#get a handle to kill switch state, polled in the background
+killswitch_monitor = kill_switch.KillSwitchMonitor()
+
+# client response -> (outcome, TestResults error counter), anything else is a download that worked
+CONST_OUTCOMES = {
+    "error:network": ("network", "nw_err"),
+    "error:timeout": ("timeout", "nw_err"),
+    "error:client": ("client", "cli_err"),
+    "Error: not_found": ("client", "cli_err"),   # the client binary is missing
+    "error:unknown": ("unknown", "un_err"),
+    "error:aborted": ("aborted", "aborted"),
+}
 
 #This can go MultiClass, be aware of thread safety !
 class AgentDownloader:
@@ -55,116 +66,238 @@ class AgentDownloader:
         #rate limit handler
         self.rate_limit = Limiter()
 
-#-----> Cache handling of files that can be processed in the CSV file ----------------------------------------
-    def __download_csv(self): 
-        response = requests.get(cls_agent.Configuration.CSV_URL) 
-        response.raise_for_status() 
-        with open(cls_agent.Configuration.CACHE_FILE, 'w', newline='') as file: 
-            file.write(response.text) 
-        with open(cls_agent.Configuration.CACHE_INFO_FILE, 'w') as info_file: 
-            cache_info = {'download_time': time.time()} 
-            json.dump(cache_info, info_file) 
-                
-    def __is_cache_valid(self): 
-        if os.path.exists(cls_agent.Configuration.CACHE_FILE) and os.path.exists(cls_agent.Configuration.CACHE_INFO_FILE): 
-            with open(cls_agent.Configuration.CACHE_INFO_FILE, 'r') as info_file: 
-                cache_info = json.load(info_file) 
-                if time.time() - cache_info['download_time'] < cls_agent.Configuration.CACHE_TIME: 
-                    return True
-                #endIf 
-                return False 
-            #endWith
-        #endIf
+        #shared catalog of files to download
+        self.catalog = FileCatalog()
+
+        #md5 verification of downloaded files, runs in a process pool
+        self.verifier = FileVerifier()
 
+        #scratch space the downloads are written to
+        self.scratch = ScratchSpace()
+
+#-----> Catalog of files that can be processed, shared by all workers ----------------------------------------
     def get_file(self,filesize): 
-        if not self.__is_cache_valid(): 
-            self.__download_csv()
-        #endIf
-            
-        with open(cls_agent.Configuration.CACHE_FILE, newline='') as csvfile: 
-            reader = csv.DictReader(row for row in csvfile if not row.startswith('#')) 
-            matching_rows = [row for row in reader if row.get('fileSize') == filesize] 
-            if matching_rows: 
-                return random.choice(matching_rows) 
-            else: 
-                return None
-            #endIf
-        #endWith
+        return self.catalog.get_file(filesize)
 
     def __get_file_address(self, filesize): 
-        file_dict = self.get_file(filesize) 
-        if file_dict: 
+        entry = self.get_file(filesize) 
+        if entry: 
             return self.file( 
-                address=file_dict['address'], 
-                name=file_dict['name'], 
-                md5=file_dict['md5'] 
+                address=entry.address, 
+                name=entry.name, 
+                md5=entry.md5 
             ) 
         return None
 
+# -----> Verify ----------------------------------------------------------------
+    # The hash runs off this thread, so the worker moves straight on - the metric is added once the hash is known,
+    # with the hash time kept apart from the download time
+    def __verify_and_add(self, test, test_results, file_path, md5):
+        if not self.verifier.can_verify(file_path, md5):
+            self.scratch.done(file_path)
+            test.add_results(test_results)
+            return
+        #endIf
+
+        def verified(future):
+            try:
+                matched, _, seconds = future.result()
+                test_results.t_hash = seconds
+                test_results.md5_err = 0 if matched else 1
+            except Exception:
+                pass # already logged by the verifier, the download result still stands
+            #endTry
+            self.scratch.done(file_path)
+            test.add_results(test_results)
+
+        try:
+            future = self.verifier.submit(file_path, md5)
+        except Exception as e:   # a broken or shut down process pool - the download result still stands, unverified
+            log_writer.log("> > AgentDownloader/__verify_and_add: md5 check of %s not started: %s", logging.WARNING, file_path, e)
+            self.scratch.done(file_path)
+            test.add_results(test_results)
+            return
+        #endTry
+        future.add_done_callback(verified)
+
+# -----> One test ----------------------------------------------------------------
+    # Runs the client once and adds the results, returns the client response.  intended_start (time.time()) is
+    # when an open loop arrival was due, the test is timed from then.
+    def __run_test(self, file_address, filesize, timeout, test_results, controller=None, intended_start=None):
+        test, started, progress = self.__begin_test(test_results, intended_start)
+        response = None
+        try:
+            with ant_engine().owned(test_results.task_ref):
+                response = self.ant_client.download (file_address,timeout,progress,filesize)
+            #endWith
+        finally:
+            #end timer
+            test.stop_timer()
+            if controller is not None:
+                controller.release(test.execution_time, response == "error:network")
+            #endIf
+        #endTry
+        self.__end_test(test, started, progress, response, file_address, filesize, test_results, intended_start)
+        return response
+
+    # The same, as a coroutine on the ant_engine loop - no thread waits on the client.  Cancelled at the cool down
+    # deadline, the client is killed and the test recorded as aborted.
+    async def __run_test_async(self, file_address, filesize, timeout, test_results, intended_start=None):
+        test, started, progress = self.__begin_test(test_results, intended_start)
+        try:
+            response = await self.ant_client.download_async(file_address, timeout, progress, filesize)
+        except asyncio.CancelledError:
+            test.stop_timer()
+            self.__end_test(test, started, progress, "error:aborted", file_address, filesize, test_results, intended_start)
+            raise
+        #endTry
+        test.stop_timer()
+        self.__end_test(test, started, progress, response, file_address, filesize, test_results, intended_start)
+        return response
+
+    def __begin_test(self, test_results, intended_start):
+        #push our test instance, into a test we are about to run
+        test = Performance.Test(test_results.test_type) 
+                        
+        #push timer start - an open loop arrival is timed from when it was due, not from when it got a worker
+        started = time.time()
+        test.start_timer(at=intended_start)
+        return test, started, ant_progress()
+
+    def __end_test(self, test, started, progress, response, file_address, filesize, test_results, intended_start):
+        #push performance stats
+        test_results.file_size = filesize #duplicate ?
+        test_results.md5 = file_address.md5
+        progress.apply(test_results)
+        if intended_start is not None:
+            test_results.t_queue = round(max(started - intended_start, 0), 3)
+        #endIf
+
+        #how the attempt ended, a failure also counts against its error class
+        test_results.outcome, counter = CONST_OUTCOMES.get(response, ("ok", None))
+        if counter is not None:
+            setattr(test_results, counter, 1)
+        #endIf
+
+        self.__verify_and_add(test, test_results, progress.file_path, file_address.md5)
+
+    # Runs the download, retrying a failure while the policy for its class allows - retry caps the retries for the
+    # download, DOWNLOAD_RETRY_POLICY the retries for each class.  Each retry waits out a backoff, doubled from
+    # DOWNLOAD_RETRY_BACKOFF_SECS with jitter so workers that failed together don't retry together.  Every attempt
+    # takes a slot then a rate limit token, the slot first so a token is never taken for a download that can't run -
+    # token_taken if the caller already has one for the first attempt.  A retry that can't start before the cool down
+    # deadline isn't made.  Every attempt is a result of its own, so its latency and outcome are recorded.  Returns the
+    # last response, None if the first attempt never started.
+    def __download_with_retry(self, file_address, filesize, timeout, retry, task_ref, controller=None, intended_start=None, token_taken=False):
+        deadline = Utils.cooldown_deadline()
+        retries = {}    # outcome -> retries made for it
+        attempt = 1
+        response = None
+        while True:
+            #wait for a slot from the task's concurrency controller, which adapts to the network and host load
+            wait_secs = (deadline - datetime.now()).total_seconds()
+            if controller is not None and not controller.acquire(timeout=wait_secs, abort=killswitch_monitor.is_active):
+                log_writer.log("> > AgentDownloader/__download_with_retry: no concurrency slot before the cool down deadline", logging.DEBUG)
+                return response
+            #endIf
+
+            #take a token from the rate limiter, waiting for one up to the cool down deadline - give up if the
+            #kill-switch is turned on while waiting, or no token will arrive in time
+            if attempt > 1 or not token_taken:
+                wait_secs = (deadline - datetime.now()).total_seconds()
+                if not self.rate_limit.acquire("download", task_ref, timeout=wait_secs, wait=killswitch_monitor.wait):
+                    log_writer.log("> > AgentDownloader/__download_with_retry: rate limited, no token before the cool down deadline", logging.DEBUG)
+                    if controller is not None:
+                        controller.release(0)   # hand the slot back, nothing ran so there is nothing to learn from it
+                    #endIf
+                    return response
+                #endIf
+            #endIf
+
+            test_results = Performance.TestResults(test_type="download", task_ref=task_ref, attempt=attempt)
+            response = self.__run_test(file_address, filesize, timeout, test_results, controller, intended_start if attempt == 1 else None)
+
+            outcome = test_results.outcome
+            if attempt > retry or retries.get(outcome, 0) >= cls_agent.Configuration.DOWNLOAD_RETRY_POLICY.get(outcome, 0):
+                return response
+            #endIf
+
+            delay = min(cls_agent.Configuration.DOWNLOAD_RETRY_BACKOFF_SECS * (2 ** (attempt - 1)), cls_agent.Configuration.DOWNLOAD_RETRY_BACKOFF_MAX_SECS) * random.uniform(0.5, 1.5)
+            if datetime.now() + timedelta(seconds=delay) >= deadline:
+                log_writer.log("> > AgentDownloader/__download_with_retry: %s after attempt %s, no time to retry before the cool down deadline", logging.DEBUG, outcome, attempt)
+                return response
+            #endIf
+            log_writer.log("> > AgentDownloader/__download_with_retry: task_ref:%s %s after attempt %s, retry in %.1fs", logging.INFO, task_ref, outcome, attempt, delay)
+
+            #woken early if the kill switch turns on, then give up
+            if killswitch_monitor.wait(delay):
+                return response
+            #endIf
+
+            retries[outcome] = retries.get(outcome, 0) + 1
+            attempt += 1
+        #endWhile
+
+    # One open loop arrival, due at intended_start - the rate limit token was already taken by the AgentRunner.  The
+    # file is picked on the calling thread (a catalog refresh can fetch), then the download runs as a coroutine on the
+    # ant_engine loop, so an arrival in flight holds no thread.  Returns its concurrent Future, or None if there is
+    # no file to download.
+    #
+    # A failure isn't retried: a retry would hold the arrival's place through its backoff, so when the network
+    # degrades later arrivals would be dropped as full, and the load offered would fall just when it should hold steady.
+    def download_at(self, filesize: str, timeout: int, task_ref: str, intended_start: float):
+        file_address = self.__get_file_address(filesize)
+        if not file_address:
+            log_writer.log("> > AgentDownloader/download_at: Unable to find a file in CSV matching %s", logging.ERROR, filesize)
+            cls_agent.Exception.throw(error="AgentDownloader.download_at: Unable to find a file in CSV matching file size")
+            return None
+        #endIf
+        test_results = Performance.TestResults(test_type="download", task_ref=task_ref)
+        return ant_engine().submit(self.__run_test_async(file_address, filesize, timeout, test_results, intended_start), owner=task_ref)
+
 # -----> Download --------------------------------------------------------------
     def download (self, 
                   filesize: str, 
                   offset: int, 
                   timeout: int, 
                   retry: int, 
-                  repeat: bool) -> None:
+                  repeat: bool,
+                  task_ref: str = "",
+                  controller = None) -> None:
         
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: filesize:{filesize} Repeating:{repeat}",logging.DEBUG)        
+        log_writer.log("> > AgentDownloader/download: filesize:%s Repeating:%s",logging.DEBUG, filesize, repeat)        
 
         # ensure we go through one itteration
         repeat_loop = True  
 
-        #python type casting on how it handles boolean =o
-        #todo: need to handle that when passing XML input file, this is the wrong place
-        repeat = repeat.lower() in ['true', '1', 'yes']
-        if offset in ('false','0'): 
-            offset = 0
-        else:
-            offset = int(offset)
-        #endIf
-
         # Mimicking do-while loop :(
         while repeat_loop: 
             #*** Start Download
 
-            #push into rate limiter, on true we are overloaded so break
-            rl = self.rate_limit.push_download()
-            if rl:
-                break
-
-            #start a performance instance
-            test_results = Performance.TestResults(test_type="download")
-
             #get address of a file from CSV to download
-            file_address = self.__get_file_address(str.lower(filesize)) 
+            file_address = self.__get_file_address(filesize) 
             
             if file_address:
-                if isinstance(offset, int) and int(offset) > 0:
+                if offset > 0:
                     #call the offset, and sleep for this long
-                    time_to_sleep = Utils.offset(offset_minutes=int(offset))
-                    log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: time_to_sleep {time_to_sleep}", logging.DEBUG)
+                    time_to_sleep = Utils.offset(offset_minutes=offset)
+                    log_writer.log("> > AgentDownloader/download: time_to_sleep %s", logging.DEBUG, time_to_sleep)
                     time.sleep(time_to_sleep)
                 #endIf
 
-                #push our test instance, into a test we are about to run
-                test = Performance.Test(test_results.test_type) 
-                                
-                #push timer start
-                test.start_timer()
-
-                response = self.ant_client.download (file_address,timeout)
-
-                #if response is soft fail - retry
-                test.stop_timer()
-                #end timer
-                #push performance stats
-                test_results.file_size = filesize #duplicate ?
+                response = self.__download_with_retry(file_address, filesize, timeout, retry, task_ref, controller)
 
-                test.add_results(test_results)
+                #no slot or rate limit token before the cool down deadline, or the client was killed at cool down /
+                #kill-switch / shutdown, stop repeating
+                if response is None:
+                    break
+                elif response == "error:aborted":
+                    repeat = False
+                #endIfElse
        
             else: 
                 #need to handle this somehow...
-                log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: Unable to find a file in CSV matching {filesize}",logging.ERROR)
+                log_writer.log("> > AgentDownloader/download: Unable to find a file in CSV matching %s",logging.ERROR, filesize)
 
                 #throw and exception, as we can't run this task
                 #to-do: need a more graceful way to just block download tasks
@@ -173,9 +306,9 @@ class AgentDownloader:
 
             #*** Finish Download
             # Update condition if we have been requested to loop
-            if bool(repeat):
+            if repeat:
                 #check to see if we should be cancelling due to kill switch
-                if killswitch_checker.check_for_kill_switch()[0]: #need a try catch in the kill switch class
+                if killswitch_monitor.is_active():
                     repeat_loop = False
                     break
                 elif Utils.scheduler_no_tasks_window():
@@ -183,17 +316,17 @@ class AgentDownloader:
                     break
                 #endIfElse
 
-                #enfore a sleep, so this thread can yield
-                time.sleep(cls_agent.Configuration.DOWNLOAD_YIELD_SECS)                 
+                #enfore a sleep, so this thread can yield - woken early if the kill switch turns on
+                if killswitch_monitor.wait(cls_agent.Configuration.DOWNLOAD_YIELD_SECS):
+                    repeat_loop = False
+                    break
+                #endIf
             else:
                 #download was not requested to repeat
                 repeat_loop = False
             #endIf
         #endWhile
 
-        #release test object
-        test_results = None
-
         self.cleanup()
 
     def cleanup (self):
@@ -42,3 +42,13 @@ class Utils:
 
         return (offset_seconds)
 
+
+
+    # The next 55 minute cool down mark, tasks must be finished by this time
+    def cooldown_deadline() -> datetime.datetime:
+        now = datetime.datetime.now()
+        deadline = now.replace(minute=55, second=0, microsecond=0)
+        if now >= deadline:
+            deadline += datetime.timedelta(hours=1)
+        #endIf
+        return deadline
@@ -0,0 +1,277 @@
+"""
+===================================================================================================
+Title : agent_influx.py
+
+Description : InfluxDB v2 line protocol formatting, and a batched writer with a disk spool
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from agent.agent_influx import InfluxSink, line_protocol
+# InfluxSink().write([line_protocol("measurement", {"tag": "x"}, {"field": 1.0}, time.time_ns())])
+#
+# INFLUX_URL can point at any http server that accepts /api/v2/write, so a local fake endpoint is enough to test it.
+
+import gzip
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# -----> Line protocol ---------------------------------------------------------
+# https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/#special-characters
+def _escape(value: str, characters: str) -> str:
+    value = str(value).replace("\\", "\\\\")
+    for character in characters:
+        value = value.replace(character, f"\\{character}")
+    #endFor
+    return value.replace("\n", "\\n")
+
+def escape_measurement(value) -> str:
+    return _escape(value, ", ")
+
+def escape_tag(value) -> str:
+    return _escape(value, ",= ")
+
+def format_field(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, int):
+        return f"{value}i"
+    elif isinstance(value, float):
+        return repr(value)
+    else:
+        return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+    #endIfElse
+
+# Tags with an empty value are left out, as line protocol doesn't allow them
+def line_protocol(measurement: str, tags: dict, fields: dict, timestamp_ns: int) -> str:
+    tag_set = "".join(f",{escape_tag(key)}={escape_tag(value)}" for key, value in tags.items() if value is not None and str(value) != "")
+    field_set = ",".join(f"{escape_tag(key)}={format_field(value)}" for key, value in fields.items())
+    return f"{escape_measurement(measurement)}{tag_set} {field_set} {timestamp_ns}"
+
+# Seconds to wait from a Retry-After header, which is either seconds or an HTTP date - default if it is neither
+def retry_after(value: str, default: float) -> float:
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    #endTry
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return default
+    #endTry
+
+# -----> Sink -------------------------------------------------------------------
+# Lines are batched, and sent gzip'd when the batch reaches INFLUX_BATCH_LINES or INFLUX_BATCH_SECS has passed.  A
+# failed write is retried with backoff, and if InfluxDB still can't be reached the batch is spooled to disk and
+# replayed after the next successful write, so metrics survive the database being down.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class InfluxSink:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(InfluxSink, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.enabled = cls_agent.Configuration.INFLUX_ENABLED
+            self.__batch = []
+            self.__batch_lock = threading.Lock()
+            self.__wake = threading.Event()
+            self.__stop_event = threading.Event()
+            self.__write_lock = threading.Lock()     # one write (or spool replay) at a time
+            self.__session = requests.Session()
+            self.__thread = None
+
+            self.written = 0
+            self.spooled = 0
+            self.dropped = 0
+
+            if self.enabled:
+                os.makedirs(cls_agent.Configuration.INFLUX_SPOOL_DIR, exist_ok=True)
+                self.__thread = threading.Thread(target=self.__run, daemon=True, name="Thread-8(InfluxSink._run)")
+                self.__thread.start()
+            #endIf
+
+    def write(self, lines: list):
+        if not self.enabled or not lines:
+            return
+        #endIf
+        with self.__batch_lock:
+            self.__batch.extend(lines)
+            full = len(self.__batch) >= cls_agent.Configuration.INFLUX_BATCH_LINES
+        #endWith
+        if full:
+            self.__wake.set()
+        #endIf
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            self.__wake.wait(cls_agent.Configuration.INFLUX_BATCH_SECS)
+            self.__wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # the batch is lost, but the thread must live on or write() would buffer without end
+                log_writer.log("> > InfluxSink/__run: flush failed: %s", logging.ERROR, e)
+            #endTry
+        #endWhile
+
+    def flush(self):
+        with self.__batch_lock:
+            batch = self.__batch
+            self.__batch = []
+        #endWith
+        if not batch:
+            return
+        #endIf
+
+        # send in batch sized slices, a spill can hand us more than one batch at a time
+        size = cls_agent.Configuration.INFLUX_BATCH_LINES
+        for start in range(0, len(batch), size):
+            body = gzip.compress(("\n".join(batch[start:start + size]) + "\n").encode('utf-8'))
+            if self.__send(body):
+                self.written += len(batch[start:start + size])
+                self.__replay_spool()
+            else:
+                self.__spool(body)
+            #endIf
+        #endFor
+
+    # Returns True once InfluxDB has accepted the body, or it was rejected as bad data (retrying won't help)
+    def __send(self, body: bytes) -> bool:
+        url = f"{cls_agent.Configuration.INFLUX_URL.rstrip('/')}/api/v2/write"
+        params = {"org": cls_agent.Configuration.INFLUX_ORG, "bucket": cls_agent.Configuration.INFLUX_BUCKET, "precision": "ns"}
+        headers = {
+            "Authorization": f"Token {cls_agent.Configuration.INFLUX_TOKEN or os.environ.get('INFLUX_TOKEN', '')}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip"
+        }
+
+        with self.__write_lock:
+            for attempt in range(cls_agent.Configuration.INFLUX_MAX_RETRIES + 1):
+                delay = min(cls_agent.Configuration.INFLUX_BACKOFF_SECS * (2 ** attempt), cls_agent.Configuration.INFLUX_BACKOFF_MAX_SECS) * random.uniform(0.5, 1.5)
+                try:
+                    response = self.__session.post(url, params=params, headers=headers, data=body, timeout=(cls_agent.Configuration.FETCH_CONNECT_TIMEOUT, cls_agent.Configuration.FETCH_READ_TIMEOUT))
+                    if response.status_code < 300:
+                        return True
+                    elif response.status_code == 429 or response.status_code >= 500:
+                        delay = min(retry_after(response.headers.get("Retry-After"), delay), cls_agent.Configuration.INFLUX_BACKOFF_MAX_SECS)
+                        log_writer.log("> > InfluxSink/__send: influxdb returned %s, retry in %.1fs", logging.DEBUG, response.status_code, delay)
+                    else:
+                        self.dropped += 1
+                        log_writer.log("InfluxDB rejected a batch (%s): %s", logging.ERROR, response.status_code, response.text[:200])
+                        return True
+                    #endIfElse
+                except requests.exceptions.RequestException as e:
+                    log_writer.log("> > InfluxSink/__send: influxdb unreachable, retry in %.1fs: %s", logging.DEBUG, delay, e)
+                #endTry
+                if attempt < cls_agent.Configuration.INFLUX_MAX_RETRIES and self.__stop_event.wait(delay):
+                    break # shutting down, spool what we have
+                #endIf
+            #endFor
+        #endWith
+        return False
+
+    def __spool_files(self) -> list:
+        directory = cls_agent.Configuration.INFLUX_SPOOL_DIR
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".lp.gz"))
+
+    # A full or read only disk drops the batch, rather than the thread
+    def __spool(self, body: bytes):
+        file_path = os.path.join(cls_agent.Configuration.INFLUX_SPOOL_DIR, f"{time.time_ns()}.lp.gz")
+        try:
+            with open(file_path, 'wb') as file:
+                file.write(body)
+            #endWith
+        except OSError as e:
+            self.dropped += 1
+            log_writer.log("InfluxDB unavailable, and the batch couldn't be spooled to %s: %s", logging.ERROR, file_path, e)
+            return
+        #endTry
+        self.spooled += 1
+        log_writer.log("InfluxDB unavailable, batch spooled to %s", logging.WARNING, file_path)
+
+        # keep the spool bounded, the oldest batches go first
+        try:
+            files = self.__spool_files()
+            total = sum(os.path.getsize(file) for file in files)
+            while files and total > cls_agent.Configuration.INFLUX_SPOOL_MAX_BYTES:
+                oldest = files.pop(0)
+                total -= os.path.getsize(oldest)
+                os.remove(oldest)
+                self.dropped += 1
+            #endWhile
+        except OSError as e:
+            log_writer.log("> > InfluxSink/__spool: unable to trim the spool: %s", logging.ERROR, e)
+        #endTry
+
+    def __replay_spool(self):
+        try:
+            files = self.__spool_files()
+        except OSError as e:
+            log_writer.log("> > InfluxSink/__replay_spool: unable to list the spool: %s", logging.ERROR, e)
+            return
+        #endTry
+        for file_path in files:
+            try:
+                with open(file_path, 'rb') as file:
+                    body = file.read()
+                #endWith
+            except OSError as e:
+                log_writer.log("> > InfluxSink/__replay_spool: unable to read %s: %s", logging.ERROR, file_path, e)
+                continue
+            #endTry
+            if not self.__send(body):
+                return
+            #endIf
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                # left behind, it will be sent again on the next replay
+                log_writer.log("> > InfluxSink/__replay_spool: unable to remove %s: %s", logging.ERROR, file_path, e)
+            #endTry
+            log_writer.log("> > InfluxSink/__replay_spool: replayed %s", logging.DEBUG, file_path)
+        #endFor
+
+    def stats(self) -> dict:
+        with self.__batch_lock:
+            pending = len(self.__batch)
+        #endWith
+        return {"pending": pending, "written": self.written, "spooled": self.spooled, "dropped": self.dropped}
+
+    def shutdown(self):
+        if not self.enabled:
+            return
+        #endIf
+        self.__stop_event.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=5)
+        #endIf
+        self.flush()
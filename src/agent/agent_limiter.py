@@ -14,73 +14,241 @@ permissions and limitations relating to use of the Code/Software.
 
 ===================================================================================================
 """
-from ratelimit import limits, RateLimitException 
-from log import LogWriter 
-import logging 
-from datetime import datetime, timedelta
+
+# reference from other objects with
+# from agent.agent_limiter import Limiter
+# if Limiter().try_acquire("download", task_ref):                        # never blocks
+# if Limiter().acquire("download", task_ref, timeout=60, wait=ev.wait):  # blocks until a token, the timeout, or wait() returns True
+#
+# Limits come from the control XML, and fall back to the LIMIT_* configuration when the XML doesn't set them:
+#
+#   <Schedule>
+#     <Limits>
+#       <Limit type="download" rate="600/hour" burst="20"/>
+#     </Limits>
+#     <Task> ... <Option key="rate" value="60/hour"/> <Option key="burst" value="5"/> ... </Task>
+#
+# A task with a rate option gets its own bucket as well, and a request has to take a token from both.
+
+import logging
+import threading
+import time
+from application import Agent
+from log import LogWriter
 
 #handle to log processing
 log_writer = LogWriter()
+cls_agent = Agent()
+
+CONST_RATE_UNITS = {"s": 1, "sec": 1, "second": 1, "m": 60, "min": 60, "minute": 60, "h": 3600, "hour": 3600, "d": 86400, "day": 86400}
+CONST_UNIT_NAMES = {1: "second", 60: "minute", 3600: "hour", 86400: "day"}
+CONST_TEST_TYPES = ("download", "upload", "quote")
+
+# "600/hour" -> (600, 3600), raises ValueError if it can't be read
+def parse_rate(rate: str):
+    count, _, unit = str(rate).strip().lower().partition("/")
+    unit = unit.strip() or "hour"
+    if unit.endswith("s") and unit[:-1] in CONST_RATE_UNITS:
+        unit = unit[:-1]
+    #endIf
+    if unit not in CONST_RATE_UNITS or float(count) < 0:
+        raise ValueError(f"invalid rate '{rate}', expected <count>/<second|minute|hour|day>")
+    #endIf
+    return float(count), CONST_RATE_UNITS[unit]
+
+# Refills continuously at count/period tokens a second, up to burst.  Not locked itself, the Limiter holds its lock
+# around every call.
+class TokenBucket:
+    def __init__(self, name: str, count: float, period: float, burst: float):
+        self.name = name
+        self.count = count
+        self.period = period
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.rejected = 0
+
+    @property
+    def rate(self) -> float:
+        return self.count / self.period
 
-# Define the rate limit (60 requests per hour) 
-CONST_ONE_HOUR = 3600 
-
-# Define the cooldown period for handling RateLimitException (5 minutes) 
-CONST_FIVE_MINUTES = timedelta(minutes=5) 
-
-# Timestamp to track the last time the rate limit exception was handled 
-last_exception_time = datetime.min
-
-#to-do - BROKEN, need to sort out the scope and debug
-def download_rate_limit(func): 
-    def wrapper(*args, **kwargs): 
-        global last_exception_time 
-        try: 
-            return func(*args, **kwargs) 
-        except RateLimitException: 
-            current_time = datetime.now() 
-            if current_time - last_exception_time >= CONST_FIVE_MINUTES: 
-                last_exception_time = current_time 
-                log_writer.log(f"!!!rate limit applied - too many download requests, suppressing for 5 minutes", logging.INFO) 
-            return None 
-    return wrapper
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until a token is available, inf if the bucket never refills
+    def wait_time(self) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        #endIf
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def describe(self) -> str:
+        return f"{self.name} {self.count:g}/{CONST_UNIT_NAMES[self.period]} burst {self.burst:g} ({self.tokens:.1f} tokens)"
 
 # Notes : This is a single instance class, so ensure that is enforced.
 class Limiter:
     #Ensure this is a single instance class
     _instance = None
 
-    def __new__(cls, *args, **kwargs): 
-        if not cls._instance: cls._instance = super(Limiter, cls).__new__(cls, *args, **kwargs) 
-        return cls._instance 
-    
-    def __init__(self): 
-        if not hasattr(self, 'initialized'): 
-            # Ensure __init__ runs only once 
-            self.initialized = True 
-    
-    @download_rate_limit 
-    @limits(calls=2, period=CONST_ONE_HOUR) # Adjusted to 2 requests per hour 
-    def __download_limiter(self): 
-        return True , None
-
-    def push_download(self) -> bool: 
-        try: 
-            result = self.__download_limiter() 
-            if result: 
-                return True 
-            else: 
-                return False 
-        except RateLimitException: 
-            return True # Return True when limit is reached
-
-    def push_upload(self) -> bool:
-        return False
-
-    def push_quote(self) -> bool:
-        return False
-    
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(Limiter, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__lock = threading.Condition()
+            self.__types = {}       # test type -> TokenBucket
+            self.__tasks = {}       # task_ref -> TokenBucket
+
+            # requests turned away, per test type - read by the /metrics endpoint
+            self.rejected = {test_type: 0 for test_type in CONST_TEST_TYPES}
+            self.configure()
+
+    def __default(self, test_type: str):
+        return getattr(cls_agent.Configuration, f"LIMIT_{test_type.upper()}_RATE"), getattr(cls_agent.Configuration, f"LIMIT_{test_type.upper()}_BURST")
+
+    # A bucket that is replaced keeps the tokens it had, so reloading the XML doesn't hand out a fresh burst
+    def __replace(self, buckets: dict, key: str, bucket: TokenBucket):
+        old = buckets.get(key)
+        if old is not None:
+            old.refill(time.monotonic())
+            bucket.tokens = min(old.tokens, bucket.burst)
+            bucket.rejected = old.rejected
+        #endIf
+        buckets[key] = bucket
+
+    # limits is {test type: (rate, burst)} from the control XML, anything missing falls back to the configuration
+    def configure(self, limits: dict = None):
+        limits = limits or {}
+        with self.__lock:
+            for test_type in CONST_TEST_TYPES:
+                rate, burst = limits.get(test_type) or self.__default(test_type)
+                try:
+                    count, period = parse_rate(rate)
+                    burst = float(burst)
+                except ValueError as e:
+                    log_writer.log("Limiter : %s, using the default for %s", logging.ERROR, e, test_type)
+                    rate, burst = self.__default(test_type)
+                    count, period = parse_rate(rate)
+                #endTry
+                self.__replace(self.__types, test_type, TokenBucket(test_type, count, period, float(burst)))
+            #endFor
+            self.__lock.notify_all()
+        #endWith
+
+    # Per task bucket from the task's rate/burst options, a task without a rate option has none
+    def configure_task(self, task_ref: str, rate: str = None, burst=None):
+        with self.__lock:
+            if not rate:
+                self.__tasks.pop(task_ref, None)
+                return
+            #endIf
+            try:
+                count, period = parse_rate(rate)
+                burst = float(burst or 1)
+            except ValueError as e:
+                log_writer.log("Limiter : task %s %s, no task limit applied", logging.ERROR, task_ref, e)
+                self.__tasks.pop(task_ref, None)
+                return
+            #endTry
+            self.__replace(self.__tasks, task_ref, TokenBucket(f"task {task_ref}", count, period, burst))
+            self.__lock.notify_all()
+        #endWith
+
+    def __buckets(self, test_type: str, task_ref: str = None) -> list:
+        # a test type without a bucket isn't limited
+        buckets = [self.__types[test_type]] if test_type in self.__types else []
+        if task_ref in self.__tasks:
+            buckets.append(self.__tasks[task_ref])
+        #endIf
+        return buckets
+
+    # Takes a token from the test type bucket, and the task bucket if there is one, only if both have a token.
+    # Returns 0 once taken, otherwise the seconds until it could be.
+    def __take(self, buckets: list) -> float:
+        now = time.monotonic()
+        for bucket in buckets:
+            bucket.refill(now)
+        #endFor
+        wait = max((bucket.wait_time() for bucket in buckets), default=0.0)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.tokens -= 1
+            #endFor
+        #endIf
+        return wait
+
+    def __reject(self, test_type: str, buckets: list):
+        self.rejected[test_type] = self.rejected.get(test_type, 0) + 1
+        for bucket in buckets:
+            if bucket.tokens < 1:
+                bucket.rejected += 1
+            #endIf
+        #endFor
+
+    # Non blocking, True if a token was taken
+    def try_acquire(self, test_type: str, task_ref: str = None) -> bool:
+        with self.__lock:
+            buckets = self.__buckets(test_type, task_ref)
+            if self.__take(buckets) == 0:
+                return True
+            #endIf
+            self.__reject(test_type, buckets)
+            return False
+        #endWith
+
+    # Blocks until a token is taken (True), or the timeout passes (False).  wait, if given, is used to sleep - a
+    # function taking seconds and returning True to give up early, e.g. KillSwitchMonitor().wait.
+    def acquire(self, test_type: str, task_ref: str = None, timeout: float = None, wait=None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                buckets = self.__buckets(test_type, task_ref)
+                delay = self.__take(buckets)
+                if delay == 0:
+                    return True
+                #endIf
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining < delay:
+                    # a token won't arrive in time, don't sit out the rest of the timeout
+                    self.__reject(test_type, buckets)
+                    return False
+                #endIf
+                if wait is None:
+                    # woken early if the limits are reconfigured
+                    self.__lock.wait(min(delay, 60))
+                    continue
+                #endIf
+            #endWith
+            if wait(min(delay, 60)):
+                with self.__lock:
+                    self.__reject(test_type, self.__buckets(test_type, task_ref))
+                #endWith
+                return False
+            #endIf
+        #endWhile
+
+    def stats(self) -> dict:
+        with self.__lock:
+            now = time.monotonic()
+            stats = {}
+            for bucket in list(self.__types.values()) + list(self.__tasks.values()):
+                bucket.refill(now)
+                stats[bucket.name] = {"rate": bucket.rate, "burst": bucket.burst, "tokens": round(bucket.tokens, 2), "rejected": bucket.rejected}
+            #endFor
+            return stats
+
     def show_limits(self):
-        #to:do
-        log_writer.log(f"Rate Limiting Active : Download (2 calls/hour) / Upload (undefined) / Quote (undefined)",logging.INFO)
-        
\ No newline at end of file
+        with self.__lock:
+            now = time.monotonic()
+            buckets = list(self.__types.values()) + list(self.__tasks.values())
+            for bucket in buckets:
+                bucket.refill(now)
+            #endFor
+            described = " / ".join(bucket.describe() for bucket in buckets)
+        #endWith
+        log_writer.log("Rate Limiting Active : %s", logging.INFO, described)
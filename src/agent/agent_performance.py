@@ -23,21 +23,162 @@ import time
 import os
 import threading
 import logging
-import datetime
-import inspect
 from log import LogWriter
-from collections import defaultdict
+from array import array
 from typing import Optional
 from application import Agent
+from agent.agent_sketch import RollingHistograms
+from agent.agent_influx import InfluxSink, line_protocol
 
 cls_agent = Agent()
 log_writer = LogWriter()
 
+# Metrics are held as columns of compact arrays rather than a list of TestResults objects, one row per result.
+# Strings (test type, file size, task, md5) are interned to a small code, the intern table lives as long as the rows
+# that use it.  All access is under the lock, and drain() swaps the columns and table out in one step, so a result
+# added while a flush is writing lands in the next flush, never lost.
+class MetricsBuffer:
+    # column name, array typecode - names match the TestResults attributes, "S" columns hold interned strings
+    COLUMNS = (
+        ("test_type", "S"), ("file_size", "S"), ("task_ref", "S"), ("md5", "S"),
+        ("execution", "d"), ("cost", "d"),
+        ("cli_err", "l"), ("nw_err", "l"), ("un_err", "l"), ("md5_err", "l"), ("aborted", "l"),
+        ("t_connect", "d"), ("t_first_chunk", "d"), ("t_chunks_done", "d"), ("t_written", "d"),
+        ("bytes_written", "q"), ("t_hash", "d"), ("t_queue", "d"), ("attempt", "l"), ("outcome", "S")
+    )
+
+    class Chunk:
+        def __init__(self, strings, timestamp, columns):
+            self.strings = strings
+            self.timestamp = timestamp
+            self.columns = columns
+
+        def __len__(self):
+            return len(self.timestamp)
+
+        # (timestamp_ns, {column: value})
+        def row(self, index):
+            values = {}
+            for name, typecode in MetricsBuffer.COLUMNS:
+                value = self.columns[name][index]
+                values[name] = self.strings[value] if typecode == "S" else value
+            #endFor
+            return self.timestamp[index], values
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.__lock = threading.Lock()
+        #a full buffer holds at most this many distinct strings, the codes must fit
+        strings = capacity * sum(1 for _, typecode in self.COLUMNS if typecode == "S")
+        self.__code_type = 'H' if strings <= 0xFFFF else 'L'
+        self.__reset()
+
+    def __reset(self):
+        self.__timestamp = array('q')
+        self.__columns = {name: array(self.__code_type if typecode == "S" else typecode) for name, typecode in self.COLUMNS}
+        self.__codes = {}       # string -> code
+        self.__strings = []     # code -> string
+
+    def __code(self, value) -> int:
+        value = str(value)
+        code = self.__codes.get(value)
+        if code is None:
+            code = len(self.__strings)
+            self.__codes[value] = code
+            self.__strings.append(value)
+        #endIf
+        return code
+
+    # Returns True when the buffer has reached capacity, and must be drained
+    def append(self, results: 'Performance.TestResults') -> bool:
+        with self.__lock:
+            #resolve the whole row first, then append it - a value a column can't hold takes the row back out, so
+            #no column is left a row longer than the rest
+            row = []
+            for name, typecode in self.COLUMNS:
+                value = getattr(results, name)
+                if typecode == "S":
+                    row.append(self.__code(value if value is not None else ""))
+                else:
+                    row.append(value or 0)
+                #endIfElse
+            #endFor
+            rows = len(self.__timestamp)
+            try:
+                for (name, _), value in zip(self.COLUMNS, row):
+                    self.__columns[name].append(value)
+                #endFor
+            except (TypeError, OverflowError):
+                for column in self.__columns.values():
+                    del column[rows:]
+                #endFor
+                raise
+            #endTry
+            self.__timestamp.append(time.time_ns())
+            return len(self.__timestamp) >= self.capacity
+        #endWith
+
+    def drain(self) -> 'MetricsBuffer.Chunk':
+        with self.__lock:
+            chunk = self.Chunk(self.__strings, self.__timestamp, self.__columns)
+            self.__reset()
+        #endWith
+        return chunk
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__timestamp)
+
+# Running totals since the agent started, per (test type, file size), for the /metrics endpoint.  add_metric() pays
+# a few additions under the lock, a scrape copies the totals out under the same lock and formats them outside it.
+class ResultCounters:
+    # cumulative histogram bounds, seconds - the last bucket (+Inf) is implied
+    BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    ERRORS = ("cli_err", "nw_err", "un_err", "md5_err", "aborted")
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__series = {}      # (test_type, file_size) -> totals
+
+    def record(self, results: 'Performance.TestResults'):
+        key = (results.test_type, str(results.file_size))
+        with self.__lock:
+            totals = self.__series.get(key)
+            if totals is None:
+                totals = self.__series[key] = {"count": 0, "sum": 0.0, "bytes": 0, "buckets": [0] * len(self.BUCKETS), **{error: 0 for error in self.ERRORS}}
+            #endIf
+            totals["count"] += 1
+            totals["sum"] += results.execution
+            totals["bytes"] += results.bytes_written or 0
+            for index, bound in enumerate(self.BUCKETS):
+                if results.execution <= bound:
+                    totals["buckets"][index] += 1
+                    break
+                #endIf
+            #endFor
+            for error in self.ERRORS:
+                totals[error] += getattr(results, error) or 0
+            #endFor
+        #endWith
+
+    # {(test_type, file_size): totals}, buckets are returned cumulative
+    def snapshot(self) -> dict:
+        with self.__lock:
+            series = {key: {**totals, "buckets": list(totals["buckets"])} for key, totals in self.__series.items()}
+        #endWith
+        for totals in series.values():
+            running = 0
+            for index, count in enumerate(totals["buckets"]):
+                running += count
+                totals["buckets"][index] = running
+            #endFor
+        #endFor
+        return series
+
 class Performance:
     #Ensure this is a single instance class
     _instance = None
     #to-do: this is a mess, need to rationalize
-    mem_metrics = []
     metrics_file = "./cache/metrics/metrics.csv"
     metrics_summary_file = "./cache/metrics/summary.csv"
     perf_influxdb = "_ant_agent"
@@ -57,7 +198,20 @@ class Performance:
                 os.makedirs(os.path.dirname(self.metrics_file), exist_ok=True) 
                 os.makedirs(os.path.dirname(self.metrics_summary_file), exist_ok=True) 
             except Exception as e:
-                cls_agent.Exception.throw(error=(f"{self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: Permission or File access Error"))
+                cls_agent.Exception.throw(error=("Performance/__init__: Permission or File access Error"))
+
+            # results waiting to be written, when full the thread adding the result spills it to disk
+            self.mem_metrics = MetricsBuffer(cls_agent.Configuration.METRICS_BUFFER_CAPACITY)
+            self.__write_lock = threading.Lock()
+
+            # optional direct write to InfluxDB
+            self.influx = InfluxSink()
+
+            # latency histograms per test type, file size and task, kept as results arrive so no list needs walking
+            self.latency = RollingHistograms()
+            self.totals = ResultCounters()
+            self.quantiles = {}     # {(type, filesize, task): {window: {quantile: seconds}}} from the last 1 minute flush
+            self.gauges = {}        # {(name, tags): fields} latest value of each gauge, for the /metrics endpoint
             
             self.flush_thread = threading.Thread(target=self.__flush_periodically, daemon=True, name="Thread-4(Performance._flush_periodically)") 
             self.flush_thread.start() 
@@ -70,13 +224,34 @@ class Performance:
             #to-do need to handle thread termination, as it might hang exit in waiting state
 
     def __flush_mem_metrics_to_disk(self):
-        # Use a temporary list to store the current metrics 
-        temp_metrics = self.mem_metrics[:] 
-        self.mem_metrics = [] 
+        # Swap the buffer out, anything added from here on goes into the next flush
+        chunk = self.mem_metrics.drain()
+        if not len(chunk):
+            return
+        #endIf
         
-        with open(self.metrics_file, 'a') as file: 
-            for metric in temp_metrics: 
-                file.write(f"{self.perf_influxdb},test={metric.test_type} filesize=\"{metric.file_size}\",md5={metric.md5},cost={metric.cost},cli_err={metric.cli_err},nw_err={metric.nw_err},un_err={metric.un_err},exec={metric.execution} {self.__get_influxdb_time()}\n")
+        lines = []
+        for index in range(len(chunk)): 
+            timestamp, metric = chunk.row(index)
+            lines.append(line_protocol(self.perf_influxdb,
+                {"test": metric['test_type'], "filesize": metric['file_size'], "task": metric['task_ref']},
+                {"md5": metric['md5'], "cost": metric['cost'], "cli_err": metric['cli_err'], "nw_err": metric['nw_err'], "un_err": metric['un_err'],
+                 "md5_err": metric['md5_err'], "aborted": metric['aborted'], "exec": metric['execution'], "t_conn": metric['t_connect'],
+                 "t_first": metric['t_first_chunk'], "t_done": metric['t_chunks_done'], "t_write": metric['t_written'],
+                 "bytes": metric['bytes_written'], "t_hash": metric['t_hash'], "t_queue": metric['t_queue'],
+                 "attempt": metric['attempt'], "outcome": metric['outcome']},
+                timestamp))
+        #endFor
+        self.__write_lines(self.metrics_file, lines)
+
+    # Lines go to the local file, and to InfluxDB when the sink is enabled
+    def __write_lines(self, file_path, lines):
+        with self.__write_lock, open(file_path, 'a') as file: 
+            for line in lines:
+                file.write(f"{line}\n")
+            #endFor
+        #endWith
+        self.influx.write(lines)
     
     def __1_min_flush(self): 
         # Every 1 minute, calculate stats and flush metrics to disk 
@@ -86,36 +261,59 @@ class Performance:
     def shutdown(self): 
         # Shutdown the Performance instance 
         self.__flush_mem_metrics_to_disk() 
+        self.influx.shutdown()
         self._instance = None
 
+    # Point in time values (e.g. a task's concurrency) - written straight out as <measurement>_<name>, as they change
+    # rarely, and the latest value is kept for the /metrics endpoint
+    def set_gauge(self, name: str, tags: dict, fields: dict):
+        self.gauges[(name, tuple(tags.items()))] = fields
+        self.__write_lines(self.metrics_file, [line_protocol(f"{self.perf_influxdb}_{name}", tags, fields, self.__get_influxdb_time())])
+
     def __get_influxdb_time(self):
-        # Get current UTC time 
-        current_time = datetime.datetime.utcnow() 
-        
-        # Get the time since Unix Epoch in nanoseconds 
-        epoch_time_ns = int(time.mktime(current_time.timetuple())) * 1_000_000_000 + current_time.microsecond * 1_000 
-        
-        return epoch_time_ns
-    
+        # Time since Unix Epoch in nanoseconds, UTC
+        return time.time_ns()
+
     def __calculate_stats(self):
-        # Calculate statistics for all metrics in mem_metrics 
-        stats = defaultdict(lambda: {'count': 0, 'min': float('inf'), 'max': float('-inf'), 'total_time': 0}) 
-        
-        for metric in self.mem_metrics: 
-            name, time = metric.test_type, metric.execution 
-            stats[name]['count'] += 1 
-            stats[name]['min'] = min(stats[name]['min'], time) 
-            stats[name]['max'] = max(stats[name]['max'], time) 
-            stats[name]['total_time'] += time 
+        # Percentiles per series over the 1m/5m/1h windows, for the minute just ended
+        windows = self.latency.rotate()
+        timestamp = self.__get_influxdb_time()
         
-        with open(self.metrics_summary_file, 'a') as file: 
-            for name, data in stats.items(): 
-                mean_time = round( data['total_time'] / data['count'], 2) 
-                file.write(f"{self.perf_influxdb_summary},type={name},min={data['min']},max={data['max']},mean={mean_time},count={data['count']} {self.__get_influxdb_time()}\n")
+        lines = []
+        quantiles = {}
+        for key, histograms in windows.items(): 
+            tags = dict(zip(("type", "filesize", "task"), key))
+            quantiles[key] = {}
+            for window, data in histograms.items():
+                if data.count == 0:
+                    continue
+                #endIf
+                quantiles[key][window] = {q: round(data.quantile(q), 3) for q in (0.5, 0.9, 0.99, 0.999)}
+                lines.append(line_protocol(self.perf_influxdb_summary, {**tags, "window": window},
+                    {"min": round(data.min, 3), "max": round(data.max, 3), "mean": round(data.mean(), 3), "count": data.count,
+                     "p50": round(data.quantile(0.5), 3), "p90": round(data.quantile(0.9), 3), "p99": round(data.quantile(0.99), 3), "p999": round(data.quantile(0.999), 3)},
+                    timestamp))
+            #endFor
+        #endFor
+        self.quantiles = quantiles      # swapped whole, a scrape sees the last minute or this one, never half of each
+        self.__write_lines(self.metrics_summary_file, lines)
 
     def add_metric(self, results: 'Performance.TestResults' ):
-        log_writer.log(f"+ + {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: Add Metric -> {results.test_type},{results.execution:.2f}s", logging.INFO) 
-        self.mem_metrics.append(results)
+        log_writer.log("+ + Performance/add_metric: Add Metric -> %s,%.2fs", logging.INFO, results.test_type, results.execution) 
+
+        self.totals.record(results)
+
+        # series are (type, filesize, task), None where the series doesn't split on it
+        self.latency.record((results.test_type, None, None), results.execution)
+        self.latency.record((results.test_type, str(results.file_size), None), results.execution)
+        if results.task_ref:
+            self.latency.record((results.test_type, None, results.task_ref), results.execution)
+        #endIf
+
+        # backpressure - the buffer is full, so this thread pays for writing it out
+        if self.mem_metrics.append(results):
+            self.__flush_mem_metrics_to_disk()
+        #endIf
 
     class TestResults: 
         def __init__( 
@@ -123,11 +321,23 @@ class Performance:
                 test_type: str, 
                 file_size: Optional[float] = 0, 
                 execution: Optional[float] = 0, 
-                md5: Optional[float] = 0, 
+                md5: Optional[str] = "", 
                 cost: Optional[float] = 0, 
                 cli_err: int = 0, 
                 nw_err: int = 0, 
-                un_err: int = 0 
+                un_err: int = 0, 
+                aborted: int = 0, 
+                t_connect: float = 0, 
+                t_first_chunk: float = 0, 
+                t_chunks_done: float = 0, 
+                t_written: float = 0, 
+                bytes_written: int = 0, 
+                md5_err: int = 0, 
+                t_hash: float = 0, 
+                task_ref: str = "",
+                t_queue: float = 0,
+                attempt: int = 1,
+                outcome: str = ""
         ): 
             self.test_type = test_type 
             self.file_size = file_size 
@@ -137,11 +347,31 @@ class Performance:
             self.cli_err = cli_err 
             self.nw_err = nw_err 
             self.un_err = un_err 
+            self.aborted = aborted 
+            # seconds from the client starting, to each phase of the download - 0 if not seen
+            self.t_connect = t_connect 
+            self.t_first_chunk = t_first_chunk 
+            self.t_chunks_done = t_chunks_done 
+            self.t_written = t_written 
+            self.bytes_written = bytes_written 
+            # 1 if the downloaded file didn't match the catalog md5, and seconds spent hashing it
+            self.md5_err = md5_err 
+            self.t_hash = t_hash 
+            self.task_ref = task_ref 
+            # open loop only - seconds from the intended start to the client starting, execution includes it
+            self.t_queue = t_queue
+            # 1 for the first try of a download, 2 for its first retry .. and how it ended - ok, network, timeout,
+            # client, unknown or aborted (the error counters split the same way)
+            self.attempt = attempt
+            self.outcome = outcome
         
         def __repr__(self): 
             return ( 
                 f"TestResults(test_type={self.test_type!r}, file_size={self.file_size!r}, execution={self.execution!r}, " 
-                f"md5={self.md5!r}, cost={self.cost!r}, cli_err={self.cli_err!r}, nw_err={self.nw_err!r}, un_err={self.un_err!r})" 
+                f"md5={self.md5!r}, cost={self.cost!r}, cli_err={self.cli_err!r}, nw_err={self.nw_err!r}, un_err={self.un_err!r}, aborted={self.aborted!r}, " 
+                f"t_connect={self.t_connect!r}, t_first_chunk={self.t_first_chunk!r}, t_chunks_done={self.t_chunks_done!r}, " 
+                f"t_written={self.t_written!r}, bytes_written={self.bytes_written!r}, md5_err={self.md5_err!r}, t_hash={self.t_hash!r}, task_ref={self.task_ref!r}, t_queue={self.t_queue!r}, "
+                f"attempt={self.attempt!r}, outcome={self.outcome!r})" 
             )
 
     class Test: 
@@ -151,8 +381,10 @@ class Performance:
             self.start_time = None
             self.performance = Performance() # Get the singleton instance of Performance 
 
-        def start_timer(self):
-            self.start_time = time.time()
+        # at is the time the test should have started, when that was earlier than now - an open loop arrival that
+        # waited for a worker is timed from when it was due, so the wait isn't hidden from the latency
+        def start_timer(self, at: float = None):
+            self.start_time = time.time() if at is None else min(at, time.time())
 
         def stop_timer(self):
             if self.start_time is not None: 
@@ -0,0 +1,126 @@
+"""
+===================================================================================================
+Title : agent_pool.py
+
+Description : agent wide pool of worker threads, shared by every task
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# Every worker in the agent runs on this pool, so the total load on the node machine is capped no matter how
+# many tasks overlap.  A worker is only admitted if there is room in the queue, and the task hasn't used up
+# its quota - otherwise it is rejected, and the caller runs with fewer workers.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class WorkerPool:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(WorkerPool, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.size = self.__pool_size()
+            self.queue_size = cls_agent.Configuration.WORKER_POOL_QUEUE
+            self.task_quota = cls_agent.Configuration.WORKER_TASK_QUOTA
+
+            self.__lock = threading.Lock()
+            self.__active = 0
+            self.__queued = 0
+            self.__rejected = 0
+            self.__per_task = defaultdict(int)     # task_ref -> workers active or queued
+
+            self.__executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="Thread-3(WorkerPool)")
+            log_writer.log("Worker Pool : %s workers, queue %s, quota per task %s", logging.INFO, self.size, self.queue_size, self.task_quota)
+
+    def __pool_size(self) -> int:
+        if cls_agent.Configuration.WORKER_POOL_SIZE > 0:
+            return cls_agent.Configuration.WORKER_POOL_SIZE
+        #endIf
+        # downloads mostly wait on the client process, so allow a few workers per cpu
+        return min((os.cpu_count() or 1) * cls_agent.Configuration.WORKER_POOL_PER_CPU, cls_agent.Configuration.WORKER_POOL_CEILING)
+
+    # Returns a Future for the admitted worker, or None if it was rejected
+    def submit(self, task_ref: str, fn, *args, **kwargs) -> Optional[Future]:
+        with self.__lock:
+            if self.__queued >= self.queue_size or self.__per_task.get(task_ref, 0) >= self.task_quota:
+                self.__rejected += 1
+                log_writer.log("> > WorkerPool/submit: %s worker rejected, active:%s queued:%s task:%s", logging.WARNING, task_ref, self.__active, self.__queued, self.__per_task.get(task_ref, 0))
+                return None
+            #endIf
+            self.__queued += 1
+            self.__per_task[task_ref] += 1
+        #endWith
+
+        future = self.__executor.submit(self.__run, task_ref, fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.__cancelled(f, task_ref))
+        return future
+
+    def __run(self, task_ref, fn, *args, **kwargs):
+        with self.__lock:
+            self.__queued -= 1
+            self.__active += 1
+        #endWith
+        cls_agent.push_thread_worker()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            cls_agent.pop_thread_worker()
+            with self.__lock:
+                self.__active -= 1
+                self.__release(task_ref)
+            #endWith
+        #endTry
+
+    # A worker cancelled while still queued never reaches __run, so give its slot back here
+    def __cancelled(self, future: Future, task_ref: str):
+        if future.cancelled():
+            with self.__lock:
+                self.__queued -= 1
+                self.__release(task_ref)
+            #endWith
+        #endIf
+
+    def __release(self, task_ref):
+        self.__per_task[task_ref] -= 1
+        if self.__per_task[task_ref] <= 0:
+            del self.__per_task[task_ref]
+        #endIf
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "size": self.size,
+                "active": self.__active,
+                "queued": self.__queued,
+                "rejected": self.__rejected,
+                "tasks": dict(self.__per_task)
+            }
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,210 @@
+"""
+===================================================================================================
+Title : agent_profiler.py
+
+Description : CPU stack sampling and memory allocation tracing, switched on and off at runtime
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from agent.agent_profiler import Profiler
+# Profiler().toggle_cpu()       # or start_cpu() / stop_cpu()
+# Profiler().toggle_memory()    # or start_memory() / snapshot_memory() / stop_memory()
+#
+# From the console press >> p << (cpu) or >> m << (memory), or POST /profile/cpu or /profile/memory to the
+# metrics endpoint (when METRICS_HTTP_PROFILE_ENABLED).  Output is written to PROFILE_DIR:
+#   cpu-<time>.folded   one line per stack "thread;module:function;... count", for flamegraph.pl / speedscope
+#   cpu-<time>.txt      functions by samples, self and total
+#   mem-<time>.txt      allocations grown since tracing started (or the last snapshot), by line
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# Notes : This is a single instance class, so ensure that is enforced.
+class Profiler:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(Profiler, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__lock = threading.Lock()
+            self.__cpu_thread = None
+            self.__cpu_stop = threading.Event()
+            self.__stacks = Counter()           # folded stack -> samples
+            self.__samples = 0
+            self.__cpu_started = None
+            self.__memory_baseline = None
+
+    def __file_path(self, kind: str, extension: str) -> str:
+        os.makedirs(cls_agent.Configuration.PROFILE_DIR, exist_ok=True)
+        return os.path.join(cls_agent.Configuration.PROFILE_DIR, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    # -----> CPU ---------------------------------------------------------------
+    # cProfile only sees the thread that enabled it, so instead every thread's stack is sampled from one background
+    # thread.  A sample costs a walk of each stack, the threads being sampled are never paused or instrumented.
+    def __sample(self):
+        interval = 1 / cls_agent.Configuration.PROFILE_SAMPLE_HZ
+        depth = cls_agent.Configuration.PROFILE_STACK_DEPTH
+        own = threading.get_ident()
+        while not self.__cpu_stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                #endIf
+                stack = []
+                while frame is not None and len(stack) < depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                #endWhile
+                stack.append(names.get(ident, str(ident)))
+                self.__stacks[";".join(reversed(stack))] += 1
+            #endFor
+            self.__samples += 1
+        #endWhile
+
+    def start_cpu(self) -> bool:
+        with self.__lock:
+            if self.__cpu_thread is not None:
+                return False
+            #endIf
+            self.__stacks = Counter()
+            self.__samples = 0
+            self.__cpu_started = time.monotonic()
+            self.__cpu_stop.clear()
+            self.__cpu_thread = threading.Thread(target=self.__sample, daemon=True, name="Thread-11(Profiler._sample)")
+            self.__cpu_thread.start()
+        #endWith
+        log_writer.log("Profiler : CPU sampling started at %s Hz", logging.INFO, cls_agent.Configuration.PROFILE_SAMPLE_HZ)
+        return True
+
+    # Returns the .folded file written, or None if sampling wasn't running
+    def stop_cpu(self):
+        with self.__lock:
+            if self.__cpu_thread is None:
+                return None
+            #endIf
+            self.__cpu_stop.set()
+            self.__cpu_thread.join()
+            self.__cpu_thread = None
+            stacks, samples, seconds = self.__stacks, self.__samples, time.monotonic() - self.__cpu_started
+        #endWith
+
+        folded_path = self.__file_path("cpu", "folded")
+        with open(folded_path, 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+            #endFor
+        #endWith
+
+        # per function, self = on top of the stack, total = anywhere in it (counted once per stack)
+        own, total = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] += count
+            #endIf
+            for function in set(frames):
+                total[function] += count
+            #endFor
+        #endFor
+        summary_path = folded_path[:-len(".folded")] + ".txt"
+        with open(summary_path, 'w') as file:
+            file.write(f"{samples} samples over {seconds:.1f}s, all threads\n\n{'self':>8} {'total':>8}  function\n")
+            for function, count in own.most_common(cls_agent.Configuration.PROFILE_TOP_N):
+                file.write(f"{count:>8} {total[function]:>8}  {function}\n")
+            #endFor
+        #endWith
+
+        log_writer.log("Profiler : CPU sampling stopped, %s samples written to %s", logging.INFO, samples, folded_path)
+        return folded_path
+
+    def toggle_cpu(self):
+        return self.stop_cpu() if self.cpu_active() else self.start_cpu()
+
+    def cpu_active(self) -> bool:
+        return self.__cpu_thread is not None
+
+    # -----> Memory ------------------------------------------------------------
+    def start_memory(self) -> bool:
+        with self.__lock:
+            if tracemalloc.is_tracing():
+                return False
+            #endIf
+            tracemalloc.start(cls_agent.Configuration.PROFILE_TRACE_FRAMES)
+            self.__memory_baseline = tracemalloc.take_snapshot()
+        #endWith
+        log_writer.log("Profiler : memory tracing started", logging.INFO)
+        return True
+
+    # Writes the allocations grown since the baseline, and makes this snapshot the new baseline
+    def snapshot_memory(self):
+        with self.__lock:
+            if not tracemalloc.is_tracing():
+                return None
+            #endIf
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            baseline, self.__memory_baseline = self.__memory_baseline, snapshot
+            current, peak = tracemalloc.get_traced_memory()
+        #endWith
+
+        file_path = self.__file_path("mem", "txt")
+        with open(file_path, 'w') as file:
+            file.write(f"traced {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB\n\n")
+            for stat in snapshot.compare_to(baseline, 'lineno')[:cls_agent.Configuration.PROFILE_TOP_N]:
+                file.write(f"{stat}\n")
+            #endFor
+        #endWith
+        log_writer.log("Profiler : memory snapshot written to %s", logging.INFO, file_path)
+        return file_path
+
+    def stop_memory(self):
+        file_path = self.snapshot_memory()
+        with self.__lock:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            #endIf
+            self.__memory_baseline = None
+        #endWith
+        return file_path
+
+    def toggle_memory(self):
+        return self.stop_memory() if self.memory_active() else self.start_memory()
+
+    def memory_active(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def status(self) -> dict:
+        return {"cpu": self.cpu_active(), "cpu_samples": self.__samples, "memory": self.memory_active()}
+
+    def shutdown(self):
+        self.stop_cpu()
+        self.stop_memory()
@@ -15,30 +15,30 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 from application import Agent
-import inspect
 import logging
 from log import LogWriter
-from tasks import Agent_Task
+from tasks import TaskSpec
+import random
 import threading 
-import time 
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import wait
+from datetime import datetime
 from agent.agent_download import AgentDownloader
+from agent.agent_helper import Utils
+from agent.agent_pool import WorkerPool
+from agent.agent_concurrency import ConcurrencyController
+from agent.agent_limiter import Limiter
+from agent.agent_performance import Performance
+import kill_switch
+from client.autonomi import ant_engine
 
 #get a handle to the logging class
 log_writer = LogWriter()
 cls_agent = Agent()
+worker_pool = WorkerPool()
 
-#to-do: these should not be here
-CONST_DEFAULT_WORKERS = 1
-CONST_MAX_WORKERS = 10
-
-CONST_DEFAULT_FILESIZE = "tiny"
-CONST_FILESIZES = { "small": "small", "tiny": "tiny", "huge": "huge" } 
-
-CONST_DEFAULT_OFFSET = 0
-CONST_DEFAULT_RETRY = 3
-CONST_DEFAULT_TIMEOUT = 30
-CONST_DEFAULT_REPEAT = False
+#get a handle to kill switch state, polled in the background
+killswitch_monitor = kill_switch.KillSwitchMonitor()
 
 #This can go multi-class, be aware of thread safety !
 class AgentRunner:
@@ -46,7 +46,7 @@ class AgentRunner:
         self.__AgentRunnerRef = ""
         self.downloadclients = [] 
         self.created_time = datetime.now()
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: created={self.created_time.strftime('%Y-%m-%d %H:%M:%S')}", logging.INFO )
+        log_writer.log("> > AgentRunner/__init__: created=%s", logging.INFO, self.created_time.strftime('%Y-%m-%d %H:%M:%S') )
 
         # Calculate the time until the next 55-minute mark 
         self.schedule_self_destruct()
@@ -57,79 +57,157 @@ class AgentRunner:
     def exec_quote_task(self, task):
         pass
     
-    def exec_download_task(self, task):
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: INVOKE",logging.INFO)
+    def exec_download_task(self, task: TaskSpec):
+        log_writer.log("> > AgentRunner/exec_download_task: INVOKE",logging.INFO)
 
         self.__AgentRunnerRef = task.task_ref  # Make sure this is being set correctly
 
-        # Get the workers value and ensure it's an integer, defaulting to the integer default if not present 
-        workers = min(int(task.test_options.get('workers', CONST_DEFAULT_WORKERS)), CONST_MAX_WORKERS)
-        
-        filesize = task.test_options.get('filesize', CONST_DEFAULT_FILESIZE)
-        if filesize.lower() in CONST_FILESIZES:
-            filesize = CONST_FILESIZES[filesize.lower()]
+        if task.arrival == "closed":
+            controller = ConcurrencyController(task.task_ref, task.workers)
+            futures = self.__start_closed_loop(task, controller)
         else:
-            filesize = CONST_DEFAULT_FILESIZE
+            controller = None
+            futures = self.__run_open_loop(task)
+        #endIfElse
+
+        # Calculate time left until the 55th minute of the current hour 
+        seconds_to_55 = (Utils.cooldown_deadline() - datetime.now()).total_seconds()
         
-        offset = task.test_options.get('offset', CONST_DEFAULT_OFFSET)
-        timeout = task.test_options.get('timeout', CONST_DEFAULT_TIMEOUT)
-        retry = task.test_options.get('retry', CONST_DEFAULT_RETRY)
-        repeat = task.test_options.get('repeat', CONST_DEFAULT_REPEAT)
+        # Wait for workers to complete or time out 
+        _, not_done = wait(futures, timeout=max(seconds_to_55, 0))
+        running = [future for future in not_done if not future.cancel()]
+        if running:
+            log_writer.log("%s workers for task %s exceeded time limit, terminating client processes", logging.WARNING, len(running), task.task_ref)
+            # Threads cannot be forcefully terminated in Python, but killing the client releases the worker - only
+            # this task's clients, another task may still be inside its own window
+            ant_engine().terminate_all("cool down deadline", task.task_ref)
+            wait(running, timeout=cls_agent.Configuration.CLIENT_KILL_GRACE_SECS * 2)
+        #endIf
+        if controller is not None:
+            controller.close()
+        #endIf
+        log_writer.log("< < AgentRunner/exec_download_task: return: NONE",logging.INFO)
+
+        #make sure we try and hand the thread back :to-do need better thread safety code, as if this is missed we can run out of threads !
+        self.cleanup()
         
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: task_ref:{task.task_ref}, filesize:{filesize}, workers:{workers}",logging.INFO)
+    # Closed loop - every worker downloads, and repeats once its own download is done.  workers is the ceiling, the
+    # controller decides how many of them download at once.
+    def __start_closed_loop(self, task: TaskSpec, controller: ConcurrencyController) -> list:
+        # the options were typed, defaulted and checked against the worker quota when the XML was loaded
+        workers = task.workers
+        filesize = task.filesize
+
+        log_writer.log("> > AgentRunner/exec_download_task: task_ref:%s, filesize:%s, workers:%s",logging.INFO, task.task_ref, filesize, workers)
         
-        threads = []
+        futures = []
 
-        #spawn the thread workers
+        #hand the workers to the shared pool, which may admit fewer than we asked for
         for i in range(workers):
             downloadclient = AgentDownloader()
+            future = worker_pool.submit(task.task_ref, downloadclient.download, filesize, task.offset, task.timeout, task.retry, task.repeat, task.task_ref, controller)
+            if future is None:
+                log_writer.log("> > AgentRunner/exec_download_task: task_ref:%s running with %s of %s workers, pool is full", logging.WARNING, task.task_ref, len(futures), workers)
+                break
+            #endIf
             self.downloadclients.append(downloadclient)
-            thread = threading.Thread(target=downloadclient.download, args=(filesize, offset, timeout, retry, repeat), name=f"Thread-2(AgentRunner.exec_download_task).{task.task_ref}.{self.created_time.strftime('%Y-%m-%d %H:%M:%S')}")
-            threads.append(thread)
-            thread.start()
-        
-        # Calculate time left until the 55th minute of the current hour 
-        now = datetime.now()
-        seconds_to_55 = ((55 - now.minute) * 60) - now.second
-        
-        # Wait for threads to complete or time out 
-        start_time = time.time()
-        for thread in threads:
-            elapsed = time.time() - start_time
-            remaining_time = seconds_to_55 - elapsed
-            if remaining_time > 0:
-                while thread.is_alive() and remaining_time > 0:
-                    thread.join(timeout=1)  # Check every second
-                    remaining_time -= 1
-                #endWhile
+            futures.append(future)
+        #endFor
+        if log_writer.is_enabled(logging.DEBUG):
+            log_writer.log("> > AgentRunner/exec_download_task: worker pool %s", logging.DEBUG, worker_pool.stats())
+        #endIf
+        return futures
+
+    # Open loop - downloads start on a schedule of arrivals at arrival_rate a minute, poisson or evenly spaced, whether
+    # or not earlier ones have finished, so a slow network can't quietly lower the load it is offered.  Each download
+    # is timed from when its arrival was due.  Up to workers are in flight, an arrival beyond that (or without a rate
+    # limit token) is dropped and counted, never delayed - delaying it would close the loop again.  The downloads run
+# as coroutines on the ant_engine loop, so arrivals in flight don't hold WorkerPool threads.
+    #
+    # Runs on the task thread until the cool down deadline, returns the futures of the downloads started.
+    def __run_open_loop(self, task: TaskSpec) -> list:
+        log_writer.log("> > AgentRunner/__run_open_loop: task_ref:%s, %s arrivals at %s/min, at most %s in flight", logging.INFO, task.task_ref, task.arrival, task.arrival_rate, task.workers)
+
+        mean_gap = 60 / task.arrival_rate
+        next_gap = (lambda: random.expovariate(1 / mean_gap)) if task.arrival == "poisson" else (lambda: mean_gap)
+        deadline = Utils.cooldown_deadline().timestamp()
+        downloadclient = AgentDownloader()
+        self.downloadclients.append(downloadclient)
+
+        lock = threading.Lock()
+        counts = {"offered": 0, "started": 0, "dropped": 0, "limited": 0, "inflight": 0}
+        futures = []
+
+        def finished(future):
+            with lock:
+                counts["inflight"] -= 1
+            #endWith
+
+        def record():
+            with lock:
+                fields = dict(counts)
+            #endWith
+            Performance().set_gauge("open_loop", {"task": task.task_ref}, {"target_rpm": task.arrival_rate, **fields})
+
+        intended = time.time()
+        next_record = intended + 60
+        while True:
+            # arrivals are placed on the schedule, not after the last one started - if the thread wakes late, the
+            # arrivals it missed start straight away, and their lateness is part of their latency
+            intended += next_gap()
+            if intended >= deadline or killswitch_monitor.wait(max(intended - time.time(), 0)) or Utils.scheduler_no_tasks_window():
+                break
             #endIf
-            if thread.is_alive():
-                log_writer.log(f"Terminating thread {thread.name} as it exceeded time limit", logging.WARNING)
-                # Threads cannot be forcefully terminated in Python :( #sad, so we log and move on
+
+            with lock:
+                counts["offered"] += 1
+                full = counts["inflight"] >= task.workers
+                if full:
+                    counts["dropped"] += 1
+                #endIf
+            #endWith
+            if not full:
+                if not Limiter().try_acquire("download", task.task_ref):
+                    with lock:
+                        counts["limited"] += 1
+                    #endWith
+                else:
+                    # a coroutine on the ant_engine loop, not a pool thread - workers bounds how many are in flight
+                    future = downloadclient.download_at(task.filesize, task.timeout, task.task_ref, intended)
+                    with lock:
+                        if future is None:
+                            counts["dropped"] += 1
+                        else:
+                            counts["started"] += 1
+                            counts["inflight"] += 1
+                        #endIfElse
+                    #endWith
+                    if future is not None:
+                        future.add_done_callback(finished)
+                        futures.append(future)
+                    #endIf
+                #endIfElse
             #endIf
-        #endFor
-        log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: return: NONE",logging.INFO)
 
-        #make sure we try and hand the thread back :to-do need better thread safety code, as if this is missed we can run out of threads !
-        self.cleanup()
-        
+            if time.time() >= next_record:
+                record()
+                next_record += 60
+            #endIf
+        #endWhile
+
+        record()
+        log_writer.log("> > AgentRunner/__run_open_loop: task_ref:%s offered %s, started %s, dropped %s, rate limited %s", logging.INFO, task.task_ref, counts["offered"], counts["started"], counts["dropped"], counts["limited"])
+        return futures
+
     def schedule_self_destruct(self): #todo: tidy this up
-        now = datetime.now() 
-        minutes = now.minute 
-        seconds = now.second 
-        if minutes < 55: 
-            minutes_to_wait = 55 - minutes 
-        else: 
-            minutes_to_wait = (60 - minutes) + 55 # to the next hour and 55 minutes 
-        
-        seconds_to_wait = minutes_to_wait * 60 - seconds 
-        log_writer.log(f"- - {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: class self-destruction in {seconds_to_wait} seconds", logging.INFO )
+        seconds_to_wait = int((Utils.cooldown_deadline() - datetime.now()).total_seconds())
+        log_writer.log("- - AgentRunner/schedule_self_destruct: class self-destruction in %s seconds", logging.INFO, seconds_to_wait )
 
         self.deletion_thread = threading.Timer(seconds_to_wait, self.self_destruct) 
         self.deletion_thread.start() 
     
     def self_destruct(self): 
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: self-destructed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", logging.INFO)
+        log_writer.log("> > AgentRunner/self_destruct: self-destructed at %s", logging.INFO, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         self.cleanup() # Ensure cleanup is called 
     
     def cleanup(self): 
@@ -139,11 +217,11 @@ class AgentRunner:
         else: 
             self.deletion_thread.join(timeout=5)
 
-        log_writer.log(f"AgentRunner instance cleaned up at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", logging.INFO) 
+        log_writer.log("AgentRunner instance cleaned up at %s", logging.INFO, datetime.now().strftime('%Y-%m-%d %H:%M:%S')) 
 
         for runner in self.downloadclients: 
             runner.cleanup() 
         #endFor
 
-        log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: Instance Deleted", logging.INFO)
+        log_writer.log("< < AgentRunner/cleanup: Instance Deleted", logging.INFO)
         del self
\ No newline at end of file
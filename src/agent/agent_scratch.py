@@ -0,0 +1,202 @@
+"""
+===================================================================================================
+Title : agent_scratch.py
+
+Description : scratch space for downloaded files, kept under a byte quota
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# Every download is given a path by allocate(), and handed back with done() once it has been verified.  In discard
+# mode the file is deleted there and then, otherwise it is kept and the least recently used files are evicted when
+# the scratch space goes over quota.  Files still being downloaded or verified are never evicted.
+#
+# Small file sizes can be placed on tmpfs (/dev/shm), so disk I/O doesn't skew the latency being measured.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class ScratchSpace:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(ScratchSpace, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__lock = threading.Lock()
+            self.__files = OrderedDict()     # path -> [bytes, in_use], oldest first
+            self.__bytes = 0
+            self.__evicted = 0
+
+            self.__tmpfs = None
+            if cls_agent.Configuration.SCRATCH_TMPFS_ENABLED and os.path.isdir(os.path.dirname(cls_agent.Configuration.SCRATCH_TMPFS_DIR)):
+                self.__tmpfs = cls_agent.Configuration.SCRATCH_TMPFS_DIR
+            #endIf
+
+    def __directories(self) -> list:
+        directories = [cls_agent.Configuration.SCRATCH_DIR]
+        if self.__tmpfs:
+            directories.append(self.__tmpfs)
+        #endIf
+        return directories
+
+    # Delete anything left behind by a previous run, nothing in the scratch space is in use at startup
+    def purge_stale(self, older_than_secs: float = 0):
+        cutoff = time.time() - older_than_secs
+        removed = 0
+        for directory in self.__directories():
+            os.makedirs(directory, exist_ok=True)
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                #endIf
+                with self.__lock:
+                    tracked = entry.path in self.__files
+                #endWith
+                try:
+                    if not tracked and entry.stat().st_mtime <= cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                    #endIf
+                except OSError:
+                    pass
+                #endTry
+            #endFor
+        #endFor
+        if removed:
+            log_writer.log("Scratch space : purged %s stale files", logging.INFO, removed)
+        #endIf
+
+    # Returns the path a download should be written to
+    def allocate(self, filename: str, filesize: str = None) -> str:
+        if filename:
+            prefix = filename.lower()
+        else:
+            prefix ="unknown"
+        #endIf
+
+        directory = cls_agent.Configuration.SCRATCH_DIR
+        if self.__tmpfs and filesize and filesize.lower() in cls_agent.Configuration.SCRATCH_TMPFS_SIZES:
+            directory = self.__tmpfs
+        #endIf
+        os.makedirs(directory, exist_ok=True)
+
+        file_path = os.path.join(directory, f"{prefix}_{next(tempfile._get_candidate_names())}")
+        with self.__lock:
+            self.__files[file_path] = [0, True]
+        #endWith
+        return file_path
+
+    # The client has finished writing, account for the size and bring the scratch space back under quota
+    def commit(self, file_path: str):
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        #endTry
+        with self.__lock:
+            entry = self.__files.get(file_path)
+            if entry is not None:
+                self.__bytes += size - entry[0]
+                entry[0] = size
+            #endIf
+        #endWith
+        self.__evict()
+
+    # The caller has finished with the file (verified, or the download failed)
+    def done(self, file_path: str, discard: bool = None):
+        if not file_path:
+            return
+        #endIf
+        if discard is None:
+            discard = cls_agent.Configuration.SCRATCH_DISCARD
+        #endIf
+        if discard:
+            self.release(file_path)
+        else:
+            with self.__lock:
+                entry = self.__files.get(file_path)
+                if entry is not None:
+                    entry[1] = False
+                    self.__files.move_to_end(file_path)
+                #endIf
+            #endWith
+            self.__evict()
+        #endIfElse
+
+    # Delete the file now
+    def release(self, file_path: str):
+        with self.__lock:
+            entry = self.__files.pop(file_path, None)
+            if entry is not None:
+                self.__bytes -= entry[0]
+            #endIf
+        #endWith
+        self.__remove(file_path)
+
+    def __evict(self):
+        victims = []
+        with self.__lock:
+            for file_path, (size, in_use) in list(self.__files.items()):
+                if self.__bytes <= cls_agent.Configuration.SCRATCH_QUOTA_BYTES:
+                    break
+                #endIf
+                if in_use:
+                    continue
+                #endIf
+                del self.__files[file_path]
+                self.__bytes -= size
+                self.__evicted += 1
+                victims.append(file_path)
+            #endFor
+            over_quota = self.__bytes > cls_agent.Configuration.SCRATCH_QUOTA_BYTES
+        #endWith
+
+        for file_path in victims:
+            self.__remove(file_path)
+        #endFor
+        if over_quota:
+            log_writer.log("> > ScratchSpace/__evict: over quota, remaining files are still in use", logging.WARNING)
+        #endIf
+
+    def __remove(self, file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log_writer.log("> > ScratchSpace/__remove: unable to remove %s: %s", logging.WARNING, file_path, e)
+        #endTry
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "files": len(self.__files),
+                "bytes": self.__bytes,
+                "quota": cls_agent.Configuration.SCRATCH_QUOTA_BYTES,
+                "evicted": self.__evicted
+            }
@@ -0,0 +1,137 @@
+"""
+===================================================================================================
+Title : agent_sketch.py
+
+Description : mergeable latency histograms, for streaming percentiles over rolling windows
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import math
+import threading
+from collections import deque
+
+# Log bucketed histogram (the DDSketch layout) - every bucket is RELATIVE_ACCURACY wide relative to its value, so a
+# quantile is never more than 1% out, whatever the latency.  Buckets are clamped between MIN_VALUE and MAX_VALUE,
+# which caps a histogram at ~930 buckets no matter how many values it has seen, and two histograms merge by adding
+# their buckets.
+class LatencyHistogram:
+    RELATIVE_ACCURACY = 0.01
+    MIN_VALUE = 0.001           # seconds, anything faster counts as zero
+    MAX_VALUE = 100_000         # seconds
+
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_INDEX = math.ceil(math.log(MIN_VALUE) / LOG_GAMMA)
+    MAX_INDEX = math.ceil(math.log(MAX_VALUE) / LOG_GAMMA)
+
+    __slots__ = ("buckets", "zero", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = {}       # bucket index -> count
+        self.zero = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def record(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < self.MIN_VALUE:
+            self.zero += 1
+            return
+        #endIf
+        index = min(max(math.ceil(math.log(value) / self.LOG_GAMMA), self.MIN_INDEX), self.MAX_INDEX)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: 'LatencyHistogram') -> 'LatencyHistogram':
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        #endFor
+        self.zero += other.zero
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        #endIf
+        rank = q * (self.count - 1)
+        if rank < self.zero:
+            return max(self.min, 0.0)
+        #endIf
+        seen = self.zero
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # middle of the bucket, keeps the error within RELATIVE_ACCURACY either way
+                value = 2 * self.GAMMA ** index / (self.GAMMA + 1)
+                return min(max(value, self.min), self.max)
+            #endIf
+        #endFor
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+# One histogram per minute per series, in a ring an hour long, so the 1m/5m/1h windows are a merge of the last
+# 1, 5 or 60 slots.  Memory per series is bounded by the ring length times the bucket cap.
+class RollingHistograms:
+    WINDOWS = {"1m": 1, "5m": 5, "1h": 60}
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__series = {}      # series key -> deque of LatencyHistogram, newest last
+
+    def __ring(self) -> deque:
+        ring = deque(maxlen=max(self.WINDOWS.values()))
+        ring.append(LatencyHistogram())
+        return ring
+
+    def record(self, key: tuple, value: float):
+        with self.__lock:
+            ring = self.__series.get(key)
+            if ring is None:
+                ring = self.__series[key] = self.__ring()
+            #endIf
+            ring[-1].record(value)
+        #endWith
+
+    # Called once a minute - returns {series key: {window: LatencyHistogram}} for the minute just ended, then opens
+    # a new minute.  Series that have seen nothing for an hour are dropped.
+    def rotate(self) -> dict:
+        windows = {}
+        with self.__lock:
+            for key, ring in list(self.__series.items()):
+                slots = list(ring)
+                windows[key] = {}
+                for window, minutes in self.WINDOWS.items():
+                    merged = LatencyHistogram()
+                    for histogram in slots[-minutes:]:
+                        merged.merge(histogram)
+                    #endFor
+                    windows[key][window] = merged
+                #endFor
+                if windows[key]["1h"].count == 0:
+                    del self.__series[key]
+                    del windows[key]
+                    continue
+                #endIf
+                ring.append(LatencyHistogram())
+            #endFor
+        #endWith
+        return windows
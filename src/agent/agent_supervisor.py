@@ -0,0 +1,145 @@
+"""
+===================================================================================================
+Title : agent_supervisor.py
+
+Description : runs scheduled tasks off the scheduler thread, and tracks them to completion
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from application import Agent
+from log import LogWriter
+from agent.agent_runner import AgentRunner
+from agent.agent_helper import Utils
+from client.autonomi import ant_engine
+import kill_switch
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+#get a handle to kill switch state, polled in the background
+killswitch_monitor = kill_switch.KillSwitchMonitor()
+
+# The scheduler hands a task over with dispatch() and returns straight away, the task runs on the executor
+# and the supervisor thread reaps it when it finishes.  When a task runs past the cool down deadline, or the
+# kill-switch is turned on, the supervisor terminates the client processes so the workers are released.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class TaskSupervisor:
+    #Ensure this is a single instance class
+    _instance = None
+
+    @dataclass
+    class Inflight:
+        task_ref: str
+        test_type: str
+        runner: AgentRunner
+        future: Future
+        started: datetime
+        deadline: datetime
+        overdue: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(TaskSupervisor, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__inflight = {}            # (task_ref, test_type) -> Inflight
+            self.__lock = threading.Lock()
+            self.__stop_event = threading.Event()
+            self.__executor = ThreadPoolExecutor(max_workers=cls_agent.Configuration.DISPATCH_MAX_TASKS, thread_name_prefix="Thread-2(TaskSupervisor)")
+
+            self.__thread = threading.Thread(target=self.__supervise, daemon=True, name="Thread-6(TaskSupervisor._supervise)")
+            self.__thread.start()
+
+    # Returns True if the task was handed over, False if a run of the same task is still in flight
+    def dispatch(self, task, test_type: str) -> bool:
+        key = (task.task_ref, test_type)
+        with self.__lock:
+            if key in self.__inflight:
+                log_writer.log("> > TaskSupervisor/dispatch: %s (%s) still running, skipped", logging.DEBUG, task.task_ref, test_type)
+                return False
+            #endIf
+
+            runner = AgentRunner()
+            exec_task = getattr(runner, f"exec_{test_type}_task")
+            future = self.__executor.submit(exec_task, task)
+            self.__inflight[key] = self.Inflight(task_ref=task.task_ref, test_type=test_type, runner=runner, future=future, started=datetime.now(), deadline=Utils.cooldown_deadline())
+        #endWith
+
+        cls_agent.push_thread_task()
+        log_writer.log("> > TaskSupervisor/dispatch: %s (%s) dispatched", logging.DEBUG, task.task_ref, test_type)
+        return True
+
+    def __reap(self):
+        now = datetime.now()
+        finished = []
+        overdue = []     # task_refs past their cool down deadline
+        with self.__lock:
+            for key, inflight in list(self.__inflight.items()):
+                if inflight.future.done():
+                    finished.append(self.__inflight.pop(key))
+                elif now >= inflight.deadline and not inflight.overdue:
+                    inflight.overdue = True
+                    overdue.append(inflight.task_ref)
+                    log_writer.log("Task %s (%s) still running past cool down deadline %s", logging.WARNING, inflight.task_ref, inflight.test_type, inflight.deadline.strftime('%H:%M:%S'))
+                #endIfElse
+            #endFor
+        #endWith
+
+        if overdue:
+            #only the overdue tasks' clients, the others are still inside their window
+            for task_ref in overdue:
+                ant_engine().terminate_all("cool down deadline", task_ref)
+            #endFor
+        elif killswitch_monitor.is_active() and ant_engine().count():
+            ant_engine().terminate_all("kill-switch")
+        #endIfElse
+
+        for inflight in finished:
+            cls_agent.pop_thread_task()
+            error = inflight.future.exception()
+            if error is not None:
+                log_writer.log("Task %s (%s) failed: %s", logging.ERROR, inflight.task_ref, inflight.test_type, error)
+            else:
+                log_writer.log("> > TaskSupervisor/__reap: %s (%s) completed in %.0fs", logging.DEBUG, inflight.task_ref, inflight.test_type, (now - inflight.started).total_seconds())
+            #endIfElse
+        #endFor
+
+    def __supervise(self):
+        while not self.__stop_event.wait(1):
+            self.__reap()
+        #endWhile
+
+    def inflight(self) -> list:
+        with self.__lock:
+            return list(self.__inflight.values())
+
+    def shutdown(self):
+        self.__stop_event.set()
+        self.__thread.join(timeout=5)
+        ant_engine().terminate_all("shutdown")
+
+        # hand back the runners still in flight, and drop anything queued
+        for inflight in self.inflight():
+            inflight.runner.cleanup()
+        #endFor
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        log_writer.log("Task Supervisor - in flight tasks cleaned up", logging.INFO)
@@ -0,0 +1,268 @@
+"""
+===================================================================================================
+Title : agent_timer.py
+
+Description : deadline timer - one thread, a heap of jobs, asleep until the next one is due
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from agent.agent_timer import TimerScheduler
+# timer = TimerScheduler()
+# timer.every(60, fn, task, name="download:T1", group="SM")
+# timer.every(60, fn, name="fetch_tasks", group="TM", jitter=lambda: random.uniform(0, 30))
+# timer.hourly_at(":55", fn, name="fetch_tasks", group="TM", jitter=lambda: random.uniform(0, 120))
+# timer.start()
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+# Jobs sit on a heap ordered by deadline, and the timer thread waits on a condition until the earliest one is due -
+# there is no polling tick, so a job starts on its deadline rather than up to a second late.  Anything that changes
+# the heap (a job added or cancelled, a group paused or resumed, stop) notifies the condition, so the wait is
+# recomputed straight away.
+#
+# Deadlines are wall clock (epoch seconds), as jobs are pinned to minutes past the hour.  Every run records how late
+# it started against its deadline - the lag is kept per job in stats(), and handed to the on_lag callback.
+#
+# Jobs run on the timer thread, so they must hand long work off (the TaskSupervisor does this for tests, the
+# ScheduleManager's fetch thread for the control fetch).
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class TimerScheduler:
+    #Ensure this is a single instance class
+    _instance = None
+
+    @dataclass(eq=False)
+    class Job:
+        name: str
+        group: str
+        fn: Callable
+        args: tuple
+        rule: Optional[Callable[[float], float]]    # previous deadline -> next deadline, None for a one-off
+        deadline: float = 0.0
+        cancelled: bool = False
+        runs: int = 0
+        skipped: int = 0
+        last_lag: float = 0.0
+        max_lag: float = 0.0
+        sequence: int = field(default=0, repr=False)
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(TimerScheduler, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__condition = threading.Condition()
+            self.__heap = []                        # (deadline, sequence, job)
+            self.__jobs = []                        # live jobs, for stats() and clear()
+            self.__paused = set()                   # groups that are held
+            self.__sequence = itertools.count()
+            self.__stopped = False
+            self.__thread = None
+            self.on_lag = None                      # optional callback (job, lag seconds), called after every run
+
+    # -----> adding jobs ---------------------------------------------------------
+    def __push(self, job: 'TimerScheduler.Job'):
+        with self.__condition:
+            job.sequence = next(self.__sequence)
+            heapq.heappush(self.__heap, (job.deadline, job.sequence, job))
+            if job not in self.__jobs:
+                self.__jobs.append(job)
+            #endIf
+            self.__condition.notify()
+        #endWith
+        return job
+
+    # Every interval seconds, first run one interval from now.  Runs stay on the original grid, a late start
+    # doesn't push the next one back.  An optional jitter in seconds is drawn fresh for each run and added to its
+    # slot on the grid, it is never carried forward to the next.
+    def every(self, interval: float, fn: Callable, *args, name: str = None, group: str = "default", jitter: Callable[[], float] = None):
+        grid = time.time()
+
+        def rule(previous: float) -> float:
+            nonlocal grid
+            grid += interval
+            now = time.time()
+            if grid <= now:
+                # we fell behind (suspend, long job) - skip the missed runs rather than firing them back to back
+                grid += ((now - grid) // interval + 1) * interval
+            #endIf
+            return grid + (jitter() if jitter else 0)
+
+        job = self.Job(name or getattr(fn, "__name__", "job"), group, fn, args, rule)
+        job.deadline = rule(grid)
+        return self.__push(job)
+
+    # Every hour at minute ":MM" (or ":MM:SS"), plus an optional jitter in seconds drawn fresh for each run
+    def hourly_at(self, at: str, fn: Callable, *args, name: str = None, group: str = "default", jitter: Callable[[], float] = None):
+        parts = [int(part) for part in at.strip(":").split(":")]
+        minute, second = parts[0], (parts[1] if len(parts) > 1 else 0)
+
+        def rule(previous: float) -> float:
+            now = datetime.now()
+            slot = now.replace(minute=minute, second=second, microsecond=0)
+            if slot <= now:
+                slot += timedelta(hours=1)
+            #endIf
+            return slot.timestamp() + (jitter() if jitter else 0)
+
+        job = self.Job(name or getattr(fn, "__name__", "job"), group, fn, args, rule)
+        job.deadline = rule(time.time())
+        return self.__push(job)
+
+    # Run once, as soon as the timer thread is free (or after delay seconds)
+    def call_soon(self, fn: Callable, *args, name: str = None, group: str = "default", delay: float = 0):
+        job = self.Job(name or getattr(fn, "__name__", "job"), group, fn, args, None)
+        job.deadline = time.time() + delay
+        return self.__push(job)
+
+    # -----> control -------------------------------------------------------------
+    def cancel(self, job: 'TimerScheduler.Job'):
+        with self.__condition:
+            job.cancelled = True
+            if job in self.__jobs:
+                self.__jobs.remove(job)
+            #endIf
+            self.__condition.notify()
+        #endWith
+
+    def clear(self, group: str):
+        with self.__condition:
+            for job in [job for job in self.__jobs if job.group == group]:
+                job.cancelled = True
+                self.__jobs.remove(job)
+            #endFor
+            self.__condition.notify()
+        #endWith
+
+    # A paused group's jobs keep their place on the grid, but a run that comes due while paused is skipped
+    def pause(self, group: str):
+        with self.__condition:
+            self.__paused.add(group)
+            self.__condition.notify()
+        #endWith
+
+    def resume(self, group: str):
+        with self.__condition:
+            self.__paused.discard(group)
+            self.__condition.notify()
+        #endWith
+
+    def is_paused(self, group: str) -> bool:
+        return group in self.__paused
+
+    def wake(self):
+        with self.__condition:
+            self.__condition.notify()
+        #endWith
+
+    def start(self):
+        if self.__thread is None:
+            self.__stopped = False
+            self.__thread = threading.Thread(target=self.__run, daemon=True, name="Thread-1(TimerScheduler._run)")
+            self.__thread.start()
+        #endIf
+
+    def stop(self, timeout: float = None):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        #endWith
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join(timeout)
+        #endIf
+        self.__thread = None
+
+    # -----> timer thread ----------------------------------------------------------
+    def __next_due(self):
+        # Returns the job to run now, or None once stopped - waits on the condition in between
+        with self.__condition:
+            while not self.__stopped:
+                while self.__heap and self.__heap[0][2].cancelled:
+                    heapq.heappop(self.__heap)
+                #endWhile
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                #endIf
+                deadline, _, job = self.__heap[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self.__condition.wait(delay)
+                    continue
+                #endIf
+                heapq.heappop(self.__heap)
+                return job
+            #endWhile
+        #endWith
+        return None
+
+    def __reschedule(self, job: 'TimerScheduler.Job'):
+        with self.__condition:
+            if job.rule is None or job.cancelled:
+                if job in self.__jobs:
+                    self.__jobs.remove(job)
+                #endIf
+                return
+            #endIf
+            job.deadline = job.rule(job.deadline)
+            job.sequence = next(self.__sequence)
+            heapq.heappush(self.__heap, (job.deadline, job.sequence, job))
+        #endWith
+
+    def __run(self):
+        while True:
+            job = self.__next_due()
+            if job is None:
+                return
+            #endIf
+
+            if job.group in self.__paused:
+                job.skipped += 1
+            else:
+                lag = time.time() - job.deadline
+                job.runs += 1
+                job.last_lag = lag
+                job.max_lag = max(job.max_lag, lag)
+                try:
+                    job.fn(*job.args)
+                except Exception as e:
+                    log_writer.log("> > TimerScheduler/__run: %s failed: %s", logging.ERROR, job.name, e)
+                #endTry
+                if self.on_lag is not None:
+                    self.on_lag(job, lag)
+                #endIf
+            #endIfElse
+            self.__reschedule(job)
+        #endWhile
+
+    def stats(self) -> list:
+        with self.__condition:
+            return [{"name": job.name, "group": job.group, "next": datetime.fromtimestamp(job.deadline).strftime('%H:%M:%S'),
+                     "runs": job.runs, "skipped": job.skipped, "last_lag": round(job.last_lag, 3), "max_lag": round(job.max_lag, 3)}
+                    for job in self.__jobs]
@@ -0,0 +1,101 @@
+"""
+===================================================================================================
+Title : agent_verify.py
+
+Description : verifies downloaded files against the catalog md5, off the worker threads
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+CONST_MD5_FORMAT = re.compile(r"^[0-9a-fA-F]{32}$")
+
+# Runs in the pool process - the file is mapped, not read, so a giga/tera file is hashed a chunk at a time from
+# the page cache without being copied into memory.  Returns (hexdigest, seconds taken)
+def md5_file(file_path: str, chunk_bytes: int):
+    started = time.monotonic()
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, chunk_bytes):
+                        digest.update(view[offset:offset + chunk_bytes])
+                    #endFor
+                finally:
+                    view.release()
+                #endTry
+            #endWith
+        #endIf
+    #endWith
+    return digest.hexdigest(), time.monotonic() - started
+
+# Notes : This is a single instance class, so ensure that is enforced.
+class FileVerifier:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(FileVerifier, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            # spawn, not fork - the agent is heavily threaded, and a forked child would inherit held locks
+            self.__executor = ProcessPoolExecutor(max_workers=cls_agent.Configuration.VERIFY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    # Placeholder md5 values in the catalog can't be verified, so they are skipped
+    def can_verify(self, file_path: Optional[str], md5: str) -> bool:
+        return bool(file_path) and bool(md5) and CONST_MD5_FORMAT.match(md5) is not None and os.path.exists(file_path)
+
+    # Returns a Future resolving to (matched, hexdigest, seconds taken)
+    def submit(self, file_path: str, md5: str) -> Future:
+        result = Future()
+        hashed = self.__executor.submit(md5_file, file_path, cls_agent.Configuration.VERIFY_CHUNK_BYTES)
+
+        def done(future: Future):
+            try:
+                digest, seconds = future.result()
+            except Exception as e:
+                log_writer.log("> > FileVerifier/done: unable to hash %s: %s", logging.ERROR, file_path, e)
+                result.set_exception(e)
+                return
+            #endTry
+            matched = digest.lower() == md5.lower()
+            if not matched:
+                log_writer.log("MD5 mismatch on %s: expected %s, got %s", logging.WARNING, file_path, md5, digest)
+            #endIf
+            result.set_result((matched, digest, round(seconds, 3)))
+
+        hashed.add_done_callback(done)
+        return result
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
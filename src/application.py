@@ -15,6 +15,8 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
+import threading
+
 class Agent:
     #Ensure this is a single instance class
     _instance = None
@@ -27,6 +29,7 @@ class Agent:
 
     __int_thread_task_count = 0
     __int_thread_worker_count = 0
+    __lock_thread_count = threading.Lock()     # counters are pushed and popped from many threads
     
     import version              # Version Information on Agent
 
@@ -57,17 +60,21 @@ class Agent:
 
     #Thread Task
     def push_thread_task(self):
-        self.__int_thread_task_count+=1
+        with self.__lock_thread_count:
+            self.__int_thread_task_count+=1
     def pop_thread_task(self):
-        self.__int_thread_task_count-=1
+        with self.__lock_thread_count:
+            self.__int_thread_task_count-=1
     def get_thread_task(self) -> int:
         return self.__int_thread_task_count
     
     #Thread Worker
     def push_thread_worker(self):
-        self.__int_thread_worker_count+=1
+        with self.__lock_thread_count:
+            self.__int_thread_worker_count+=1
     def pop_thread_worker(self):
-        self.__int_thread_worker_count-=1
+        with self.__lock_thread_count:
+            self.__int_thread_worker_count-=1
     def get_thread_worker(self) -> int:
         return self.__int_thread_worker_count
 
@@ -118,6 +125,10 @@ class _Agent__ExceptionHandler:
         if not hasattr(self, 'initialized'): 
             # Ensure __init__ runs only once 
             self.initialized = True 
+            self._listeners = []    # called with no arguments when an exception is thrown, so main wakes up
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
 
     # Check if a program exception has been raised
     def has_occurred(self):
@@ -130,8 +141,8 @@ class _Agent__ExceptionHandler:
     def get(self):
         return (self._class_exception_err)
     
-    # can use following shorthand, to extract calling class, by importing inspect module
-    # {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}
+    # name the calling class and method in the error, e.g. "ant_client/download_async: File Not Found" - the
+    # method is written out, not looked up with inspect, so raising an error doesn't walk the stack
     def throw(self, error=None):
         self._class_exception_err = ""
         if error is not None: 
@@ -140,6 +151,9 @@ class _Agent__ExceptionHandler:
             #endIf
         #endIf
         self._class_exception=True
+        for listener in list(self._listeners):
+            listener()
+        #endFor
 
 
 # Notes : This is a single instance class, so ensure that is enforced.
@@ -155,21 +169,100 @@ class _Agent__Configuration:
     LOG_TO_FILE = False
     DEFAULT_LOG_LEVEL = 'INFO'  # DEBUG, ERROR, WARN, INFO #to-do : needs changing else too verbose
 
-    SCHEDULER_CHECK = ":00" # What time (minutes) the scheduler will check for new jobs
-    SCHEDULER_URL = 'https://raw.githubusercontent.com/jadkins-me/safe-agent/main/tests/00-control.xml'
+    SCHEDULER_CHECK = ":00" # What time (minutes) the scheduler will check for new jobs, when SCHEDULER_REFRESH_SECS is 0
+    SCHEDULER_REFRESH_SECS = 60 # Check for new jobs this often - unchanged XML is a 304 and leaves the schedule alone
+    SCHEDULER_URL = 'https://raw.githubusercontent.com/jadkins-me/safe-agent/main/tests/00-control.xml' # or a local path / file:// url, or a directory of .xml files
     SCHEDULER_NO_TASKS = [56, 57, 58, 59, 0, 1, 2, 3, 4]   # minutes when the schedule can't start new tasks
 
+    FETCH_CONNECT_TIMEOUT = 5 # seconds allowed to connect to github
+    FETCH_READ_TIMEOUT = 15 # seconds allowed between bytes received from github
+    FETCH_POOL_SIZE = 4 # keep-alive connections held open per host
+    FETCH_JITTER_SECS = 120 # random delay applied to each scheduled refresh (at most half of SCHEDULER_REFRESH_SECS), so agents don't all fetch at once
+
+    CONTROL_WATCH_ENABLED = True # local SCHEDULER_URL / CSV_URL sources are reloaded as soon as they change
+    CONTROL_WATCH_DEBOUNCE_SECS = 0.05 # wait for the source to be quiet this long, so one save is one reload
+    CONTROL_WATCH_POLL_SECS = 1 # how often local sources are checked, only where inotify isn't available
+
     GIT_OWNER = "jadkins-me"
     GIT_REPO = "safe-agent"
-    GIT_KILL_SWITCH_URL = "https://api.github.com/repos/{owner}/{repo}/issues"
+    GIT_KILL_SWITCH_URL = "https://api.github.com/repos/{owner}/{repo}/issues" # or a local file (path or file:// url) holding a github style issue list, [] for OFF
+    KILL_SWITCH_POLL_SECS = 120 # How often the background poller checks github, must stay below 60 calls/hour
 
     CACHE_FILE = './cache/cached_files.csv' 
     CACHE_INFO_FILE = './cache/cache_info.json' 
     CACHE_TIME = 3600 # 1 hour in seconds (must be only seconds)
-    CSV_URL = 'https://raw.githubusercontent.com/jadkins-me/safe-agent/main/tests/01-download-files.csv' 
+    CSV_URL = 'https://raw.githubusercontent.com/jadkins-me/safe-agent/main/tests/01-download-files.csv' # or a local path / file:// url, or a directory of .csv files
+
+    DISPATCH_MAX_TASKS = 16 # Maximum number of tasks the scheduler can have running at the same time
+
+    WORKER_POOL_SIZE = 0 # Total worker threads shared by all tasks, 0 = size from the host cpu count
+    WORKER_POOL_PER_CPU = 4 # Workers allowed per cpu, when sizing from the host
+    WORKER_POOL_CEILING = 64 # Upper limit on workers, when sizing from the host
+    WORKER_POOL_QUEUE = 32 # Workers that can wait for a free thread, before new ones are rejected
+    WORKER_TASK_QUOTA = 10 # Maximum workers a single task can have active or queued
+
+    CLIENT_BIN = './bin/autonomi' # The client executable, bench/fake_autonomi.py stands in for it without a network
+    CLIENT_TIMEOUT_GRACE_SECS = 30 # Seconds the client gets past its own --timeout, before the process is killed
+    CLIENT_KILL_GRACE_SECS = 5 # Seconds between SIGTERM and SIGKILL, when client processes are terminated
+    CLIENT_OUTPUT_TAIL_LINES = 50 # Lines of client output kept per stream, for logging and error matching
+
+    VERIFY_WORKERS = 2 # Processes used to md5 verify downloaded files
+    VERIFY_CHUNK_BYTES = 8 * 1024 * 1024 # Bytes hashed at a time, files are mapped so only this much is touched at once
+
+    SCRATCH_DIR = './cache/downloads' # Where downloaded files are written
+    SCRATCH_QUOTA_BYTES = 2 * 1024 * 1024 * 1024 # Bytes of downloaded files kept, least recently used are evicted above this
+    SCRATCH_DISCARD = True # Delete downloaded files as soon as they are verified, rather than keeping them up to the quota
+    SCRATCH_STALE_SECS = 3600 # Files older than this, not tracked by the agent, are purged on the hourly refresh
+    SCRATCH_TMPFS_ENABLED = False # Place small downloads on tmpfs, so disk I/O doesn't skew the latency measured
+    SCRATCH_TMPFS_DIR = '/dev/shm/ant-agent'
+    SCRATCH_TMPFS_SIZES = ['tiny', 'small', 'chunka'] # File sizes placed on tmpfs, when enabled
+
+    METRICS_BUFFER_CAPACITY = 10000 # Results held in memory, when full they are spilled to disk before the 1 minute flush
+
+    INFLUX_ENABLED = False # Write metrics straight to InfluxDB v2, as well as the local metrics files
+    INFLUX_URL = 'http://localhost:8086' # see docker/influxdb/docker-compose.yml
+    INFLUX_ORG = 'docs'
+    INFLUX_BUCKET = 'home'
+    INFLUX_TOKEN = '' # falls back to the INFLUX_TOKEN environment variable
+    INFLUX_BATCH_LINES = 5000 # Lines sent in one write
+    INFLUX_BATCH_SECS = 10 # Longest a line waits before the batch is sent
+    INFLUX_MAX_RETRIES = 4 # Retries for a batch, with exponential backoff, before it is spooled to disk
+    INFLUX_BACKOFF_SECS = 1 # First retry delay, doubled each retry
+    INFLUX_BACKOFF_MAX_SECS = 60 # Longest retry delay, a server's Retry-After is capped to this too
+    INFLUX_SPOOL_DIR = './cache/metrics/spool'
+    INFLUX_SPOOL_MAX_BYTES = 256 * 1024 * 1024 # Oldest spooled batches are dropped above this
+
+    METRICS_HTTP_ENABLED = True # Serve the Prometheus /metrics endpoint
+    METRICS_HTTP_HOST = '127.0.0.1' # 0.0.0.0 to scrape from another host
+    METRICS_HTTP_PORT = 9108
+    METRICS_HTTP_PROFILE_ENABLED = False # Allow POST /profile/cpu|memory|snapshot, from this host only - they write files to PROFILE_DIR
+
+    CONCURRENCY_ENABLED = True # Adapt a task's live download workers between CONCURRENCY_MIN and its 'workers' option
+    CONCURRENCY_INITIAL = 2 # Workers allowed to download at the start of a task run
+    CONCURRENCY_MIN = 1
+    CONCURRENCY_BACKOFF = 0.5 # Limit is multiplied by this when the network or host is struggling
+    CONCURRENCY_ERROR_RATE = 0.2 # Back off above this share of error:network results in a window
+    CONCURRENCY_LATENCY_TOLERANCE = 2.0 # Back off when window latency is this many times the best seen
+    CONCURRENCY_LOAD_PER_CPU = 1.5 # Back off above this 1 minute load average per cpu
+
+    LIMIT_DOWNLOAD_RATE = '600/hour' # Token bucket per test type, unless the control XML has a <Limits> entry for it
+    LIMIT_DOWNLOAD_BURST = 20 # Tokens a bucket can save up, and hand out back to back
+    LIMIT_UPLOAD_RATE = '20/hour'
+    LIMIT_UPLOAD_BURST = 2
+    LIMIT_QUOTE_RATE = '120/hour'
+    LIMIT_QUOTE_BURST = 5
+
+    PROFILE_DIR = './cache/profile'
+    PROFILE_SAMPLE_HZ = 100 # Stack samples per second, across all threads, while CPU profiling is on
+    PROFILE_STACK_DEPTH = 64 # Frames kept per sample, from the innermost
+    PROFILE_TRACE_FRAMES = 10 # Frames tracemalloc keeps per allocation
+    PROFILE_TOP_N = 50 # Lines in the cpu/memory summaries
 
     DOWNLOAD_YIELD_SECS = 10 # When in repeat mode, this is how many seconds we yield on a thread before repeating
     DOWNLOAD_OFFSET_MAX_MINS = 10 # Maximum minutes allows for offsetting tasks
+    DOWNLOAD_RETRY_POLICY = {'network': 3, 'timeout': 1, 'unknown': 1} # Retries allowed per error class, the task's 'retry' option caps the total - client and aborted are never retried
+    DOWNLOAD_RETRY_BACKOFF_SECS = 2 # First retry delay, doubled each retry, with +/-50% jitter
+    DOWNLOAD_RETRY_BACKOFF_MAX_SECS = 60 # Longest retry delay, before jitter
     
     def __new__(cls, *args, **kwargs): 
         if not cls._instance: cls._instance = super(_Agent__Configuration, cls).__new__(cls, *args, **kwargs) 
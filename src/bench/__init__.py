@@ -0,0 +1,2 @@
+# bench/fake_autonomi.py is run as the client executable, bench/benchmark.py as python -m bench.benchmark - neither
+# is imported by the agent
@@ -0,0 +1,321 @@
+"""
+===================================================================================================
+Title : benchmark.py
+
+Description : Agent overhead benchmark - runs download tasks against the fake client at rising worker counts
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# run from src with
+# python -m bench.benchmark                                        # 1, 10, 100 and 1000 workers
+# python -m bench.benchmark --workers 1,10 --rounds 3 --json out.json
+# python -m bench.benchmark --baseline out.json --tolerance 0.25   # exit 1 if the agent got heavier
+#
+# Each level loads a generated control XML with the task loader, and dispatches the task through the TaskSupervisor
+# - the path the ScheduleManager takes - once per round, so every round is 'workers' downloads by the AgentRunner
+# against bench/fake_autonomi.py.  Only the agent is measured, the fake client's own cost is reported apart:
+#
+#   cpu/dl      agent process CPU (user + sys) per download, milliseconds
+#   rss         peak resident memory of the agent process, MB
+#   threads     peak threads in the agent process
+#   lag p99/max how late a probe job on the TimerScheduler started, every 100ms through the run, milliseconds
+#   logs/dl     log records, and bytes written to the log file, per download
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import wait
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import Agent
+
+cls_agent = Agent()
+
+CONST_FAKE_CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_autonomi.py")
+CONST_LEVELS = "1,10,100,1000"
+CONST_PROBE_SECS = 0.1
+
+# compared with --baseline, a level fails when one of these grows by more than the tolerance
+CONST_REGRESSION_KEYS = ("cpu_ms_per_download", "peak_rss_mb", "peak_threads", "lag_p99_ms", "log_bytes_per_download")
+
+CONST_CONTROL_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<Schedule>
+  <Limits>
+    <Limit type="download" rate="1000000/second" burst="100000"/>
+  </Limits>
+  <Task>
+    <TaskRef>bench-{workers}</TaskRef>
+    <Description>benchmark at {workers} workers</Description>
+    <TimePeriod>0</TimePeriod>
+    <TimeOffset>0</TimeOffset>
+    <TestType>download</TestType>
+    <TestOptions>
+      <Option key="filesize" value="tiny"/>
+      <Option key="workers" value="{workers}"/>
+      <Option key="timeout" value="{timeout}"/>
+    </TestOptions>
+  </Task>
+</Schedule>
+"""
+
+CONST_CATALOG_CSV = "fileSize,name,address,md5\n" + "".join(f"tiny,bench-{index}.bin,{index:064x},\n" for index in range(16))
+
+# Samples the process while a level runs - RSS from /proc where there is one, and the thread count
+class _Sampler:
+    def __init__(self):
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="Thread-B(benchmark._sampler)")
+
+    def __rss(self) -> int:
+        try:
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+                    #endIf
+                #endFor
+            #endWith
+        except OSError:
+            pass
+        #endTry
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak since start, linux reports KB
+
+    def __run(self):
+        while not self.__stop.wait(0.05):
+            self.peak_rss = max(self.peak_rss, self.__rss())
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)  # not counting the sampler
+        #endWhile
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.__stop.set()
+        self.__thread.join()
+
+# Counts records as they are logged, the bytes come from the log file once the listener has written them
+class _LogCounter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.records = 0
+
+    def filter(self, record) -> bool:
+        self.records += 1
+        return True
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    #endIf
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+# Configuration has to be in place before the agent modules are imported, as their singletons size themselves from
+# it when they are first created
+def _configure(args, workdir: str, max_workers: int):
+    config = cls_agent.Configuration
+    config.CLIENT_BIN = CONST_FAKE_CLIENT
+    config.CSV_URL = os.path.join(workdir, "catalog.csv")
+    config.SCHEDULER_URL = os.path.join(workdir, "control.xml")
+    config.WORKER_POOL_SIZE = max_workers
+    config.WORKER_POOL_QUEUE = max_workers
+    config.WORKER_TASK_QUOTA = max_workers
+    config.CONCURRENCY_ENABLED = args.adaptive
+    config.METRICS_HTTP_ENABLED = False
+    config.INFLUX_ENABLED = False
+    config.CONTROL_WATCH_ENABLED = False
+    config.DEFAULT_LOG_LEVEL = args.log_level
+    config.SCRATCH_DISCARD = True
+
+    with open(config.CSV_URL, "w") as file:
+        file.write(CONST_CATALOG_CSV)
+    #endWith
+    if args.fake_config:
+        os.environ["FAKE_AUTONOMI_CONFIG"] = os.path.abspath(args.fake_config)
+    #endIf
+
+def _run_level(workers: int, args, workdir: str, counter: _LogCounter, log_path: str) -> dict:
+    from tasks import fetch_and_parse_xml
+    from agent.agent_supervisor import TaskSupervisor
+    from agent.agent_timer import TimerScheduler
+    from agent.agent_performance import Performance
+    from agent.agent_limiter import Limiter
+
+    with open(cls_agent.Configuration.SCHEDULER_URL, "w") as file:
+        file.write(CONST_CONTROL_XML.format(workers=workers, timeout=args.timeout))
+    #endWith
+    tasks, limits = fetch_and_parse_xml(cls_agent.Configuration.SCHEDULER_URL)
+    task = tasks[0]
+    Limiter().configure(limits)
+
+    supervisor = TaskSupervisor()
+    timer = TimerScheduler()
+    lags = []
+    timer.on_lag = lambda job, lag: lags.append(lag) if job.name == "bench:probe" else None
+    probe = timer.every(CONST_PROBE_SECS, lambda: None, name="bench:probe", group="BENCH")
+
+    def downloads() -> int:
+        return sum(series["count"] for (test_type, _), series in Performance().totals.snapshot().items() if test_type == "download")
+
+    done_before, records_before = downloads(), counter.records
+    log_bytes_before = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    usage_before, children_before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+
+    with _Sampler() as sampler:
+        for round_index in range(args.rounds):
+            # the supervisor reaps the previous run on its own tick, until then the task counts as still in flight
+            while not supervisor.dispatch(task, "download"):
+                time.sleep(0.05)
+            #endWhile
+            wait([inflight.future for inflight in supervisor.inflight() if inflight.task_ref == task.task_ref])
+            # results are added once the worker hands them over, give the last of them a moment
+            deadline = time.monotonic() + 5
+            while downloads() - done_before < workers * (round_index + 1) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            #endWhile
+        #endFor
+    #endWith
+
+    seconds = time.monotonic() - started
+    usage, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    timer.cancel(probe)
+    time.sleep(0.5)  # let the log listener catch up before the file is measured
+
+    completed = max(downloads() - done_before, 1)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    client_cpu = (children.ru_utime - children_before.ru_utime) + (children.ru_stime - children_before.ru_stime)
+    log_bytes = (os.path.getsize(log_path) if os.path.exists(log_path) else 0) - log_bytes_before
+    return {
+        "workers": workers,
+        "downloads": downloads() - done_before,
+        "seconds": round(seconds, 2),
+        "cpu_ms_per_download": round(cpu * 1000 / completed, 2),
+        "client_cpu_ms_per_download": round(client_cpu * 1000 / completed, 2),
+        "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1),
+        "peak_threads": sampler.peak_threads,
+        "lag_p50_ms": round(_percentile(lags, 0.5) * 1000, 2),
+        "lag_p99_ms": round(_percentile(lags, 0.99) * 1000, 2),
+        "lag_max_ms": round(max(lags, default=0) * 1000, 2),
+        "log_records_per_download": round((counter.records - records_before) / completed, 2),
+        "log_bytes_per_download": round(log_bytes / completed, 1),
+    }
+
+# Returns the failures, a level that grew past tolerance on any of CONST_REGRESSION_KEYS
+def _compare(results: list, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path) as file:
+        baseline = {level["workers"]: level for level in json.load(file)["levels"]}
+    #endWith
+    failures = []
+    for level in results:
+        previous = baseline.get(level["workers"])
+        if previous is None:
+            continue
+        #endIf
+        for key in CONST_REGRESSION_KEYS:
+            # a floor, so a near zero baseline doesn't fail on noise
+            allowed = max(previous[key] * (1 + tolerance), previous[key] + 1)
+            if level[key] > allowed:
+                failures.append(f"{level['workers']} workers: {key} {level[key]} against {previous[key]} in the baseline")
+            #endIf
+        #endFor
+    #endFor
+    return failures
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the agent's own overhead, against a fake client")
+    parser.add_argument("--workers", default=CONST_LEVELS, help=f"comma separated worker counts, default {CONST_LEVELS}")
+    parser.add_argument("--rounds", type=int, default=3, help="task runs per level, each is one download per worker")
+    parser.add_argument("--timeout", type=int, default=30, help="client --timeout, seconds")
+    parser.add_argument("--fake-config", help="JSON config for the fake client, see bench/fake_autonomi.py")
+    parser.add_argument("--adaptive", action="store_true", help="leave the adaptive concurrency on, off by default so every worker runs")
+    parser.add_argument("--log-level", default="INFO", help="agent log level, default INFO")
+    parser.add_argument("--json", help="write the results here, to use as a --baseline later")
+    parser.add_argument("--baseline", help="results from an earlier --json run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="growth allowed against the baseline, default 0.25")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.workers.split(",")]
+    workdir = tempfile.mkdtemp(prefix="ant-agent-bench-")
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    json_path = os.path.abspath(args.json) if args.json else None
+    os.chdir(workdir)   # the agent's ./cache paths land in the work directory
+
+    cls_agent.start()
+    _configure(args, workdir, max(levels))
+
+    from log import LogWriter
+    log_path = os.path.join(workdir, "agent.log")
+    log_writer = LogWriter()
+    log_writer.config(log_to_file=True, log_file_path=log_path, log_to_console=False)
+    counter = _LogCounter()
+    log_writer.logger.addFilter(counter)
+
+    from agent.agent_timer import TimerScheduler
+    TimerScheduler().start()
+
+    results = []
+    for workers in levels:
+        print(f"benchmark: {workers} workers x {args.rounds} rounds ...", flush=True)
+        results.append(_run_level(workers, args, workdir, counter, log_path))
+    #endFor
+
+    from agent.agent_supervisor import TaskSupervisor
+    from agent.agent_pool import WorkerPool
+    from agent.agent_verify import FileVerifier
+    from agent.agent_performance import Performance
+    from client.autonomi import ant_engine
+    TimerScheduler().stop()
+    TaskSupervisor().shutdown()
+    WorkerPool().shutdown()
+    FileVerifier().shutdown()
+    Performance().shutdown()
+    ant_engine().shutdown()
+    log_writer.stop()
+
+    from tabulate import tabulate
+    print(tabulate(results, headers="keys", tablefmt="grid", numalign="centre"))
+
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump({"levels": results, "rounds": args.rounds, "fake_config": args.fake_config}, file, indent=2)
+        #endWith
+    #endIf
+    if args.keep:
+        print(f"work directory kept at {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    #endIfElse
+
+    if baseline_path:
+        failures = _compare(results, baseline_path, args.tolerance)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        #endFor
+        return 1 if failures else 0
+    #endIf
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+===================================================================================================
+Title : fake_autonomi.py
+
+Description : Stand-in for the autonomi client, so the agent can run without a network
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# Point the agent at it with CLIENT_BIN = './bench/fake_autonomi.py', and the behaviour at a JSON config with the
+# FAKE_AUTONOMI_CONFIG environment variable - anything left out of the config uses CONST_DEFAULTS:
+#
+#   {
+#     "latency": {"distribution": "lognormal", "median": 0.2, "sigma": 0.5},   # or uniform (min, max),
+#                                                                              # exponential (mean), constant (seconds)
+#     "failures": {"network": 0.02, "unknown": 0.005, "client": 0, "hang": 0}, # chance of each, per call
+#     "output": "progress",                                                    # progress, quiet or verbose
+#     "verbose_lines": 20,                                                     # extra lines per chunk, when verbose
+#     "chunks": 4,
+#     "write_bytes": 65536
+#   }
+#
+# It answers the calls the agent makes - --version, file download, file cost and file upload - and honours
+# --timeout.  Only the standard library is used, so a call costs little more than the interpreter starting.
+
+import json
+import os
+import random
+import sys
+import time
+
+CONST_VERSION = "autonomi-cli 0.0.0-fake"
+
+CONST_DEFAULTS = {
+    "latency": {"distribution": "lognormal", "median": 0.2, "sigma": 0.5},
+    "failures": {"network": 0.02, "unknown": 0.005, "hang": 0.0},
+    "output": "progress",
+    "verbose_lines": 20,
+    "chunks": 4,
+    "write_bytes": 65536,
+}
+
+# the wording the agent's client wrapper looks for
+CONST_FAILURES = {
+    "network": (1, "Error: could not connect to enough peers in time"),
+    "unknown": (1, "Error: unexpected failure in the fake client"),
+    "client": (2, "error: unexpected argument found\n\nUsage: autonomi file download <ADDR> <DEST_PATH>"),
+}
+
+def load_config() -> dict:
+    config = dict(CONST_DEFAULTS)
+    path = os.environ.get("FAKE_AUTONOMI_CONFIG")
+    if path:
+        with open(path) as file:
+            config.update(json.load(file))
+        #endWith
+    #endIf
+    return config
+
+def latency(spec: dict) -> float:
+    distribution = spec.get("distribution", "constant")
+    if distribution == "lognormal":
+        return random.lognormvariate(0, spec.get("sigma", 0.5)) * spec.get("median", 0.2)
+    elif distribution == "uniform":
+        return random.uniform(spec.get("min", 0.0), spec.get("max", 1.0))
+    elif distribution == "exponential":
+        return random.expovariate(1 / spec.get("mean", 0.2))
+    #endIfElse
+    return float(spec.get("seconds", 0.2))
+
+def say(line: str, stream=sys.stdout):
+    stream.write(line + "\n")
+    stream.flush()
+
+# Picks at most one failure for the call, by the chances in the config
+def failure(chances: dict):
+    roll = random.random()
+    for name, chance in chances.items():
+        if roll < chance:
+            return name
+        #endIf
+        roll -= chance
+    #endFor
+    return None
+
+def download(config: dict, address: str, path: str, timeout: float) -> int:
+    seconds = latency(config["latency"])
+    failed = failure(config["failures"])
+    chunks = max(int(config["chunks"]), 1)
+    verbose = config["output"] == "verbose"
+    progress = config["output"] in ("progress", "verbose")
+
+    if failed == "hang":
+        time.sleep(timeout + 3600)  # killed by the agent's hard timeout
+    #endIf
+    if seconds > timeout:
+        time.sleep(timeout)
+        say("Error: timed out fetching the file", sys.stderr)
+        return 3
+    #endIf
+
+    if progress:
+        say(f"Connected to the network, fetching {address}")
+    #endIf
+    if failed in CONST_FAILURES:
+        # fail part way through, as a real client would
+        time.sleep(seconds / 2)
+        code, message = CONST_FAILURES[failed]
+        say(message, sys.stderr)
+        return code
+    #endIf
+
+    written = 0
+    per_chunk = config["write_bytes"] // chunks
+    with open(path, "wb") as file:
+        for chunk in range(chunks):
+            time.sleep(seconds / chunks)
+            size = per_chunk if chunk < chunks - 1 else config["write_bytes"] - written
+            file.write(os.urandom(size))
+            written += size
+            if progress:
+                say(f"Fetching chunk {chunk + 1}/{chunks}")
+            #endIf
+            for line in range(config["verbose_lines"] if verbose else 0):
+                say(f"DEBUG chunk {chunk + 1} record {line} peer {random.getrandbits(64):016x}")
+            #endFor
+        #endFor
+    #endWith
+    if progress:
+        say("Successfully downloaded all chunks")
+        say(f"{written} bytes written to {path}")
+    #endIf
+    return 0
+
+def main(argv: list) -> int:
+    # global options come before the command: --timeout <secs> --log-output-dest <dir>
+    timeout = 3600.0
+    while argv and argv[0].startswith("--"):
+        option = argv.pop(0)
+        if option == "--version":
+            say(CONST_VERSION)
+            return 0
+        elif option == "--timeout" and argv:
+            timeout = float(argv.pop(0))
+        elif option == "--log-output-dest" and argv:
+            argv.pop(0)
+        #endIfElse
+    #endWhile
+
+    config = load_config()
+    command = " ".join(argv[:2])
+    if command == "file download" and len(argv) >= 4:
+        return download(config, argv[2], argv[3], timeout)
+    elif command == "file cost":
+        time.sleep(latency(config["latency"]))
+        say("Total cost: 0.000000000000000001 ANT")
+        return 0
+    elif command == "file upload":
+        time.sleep(latency(config["latency"]))
+        say(f"Uploaded to {random.getrandbits(256):064x}")
+        return 0
+    #endIfElse
+    say(f"Error: unsupported command {' '.join(argv)}", sys.stderr)
+    return 64
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
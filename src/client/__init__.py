@@ -1 +1,2 @@
-from .autonomi import ant_client
\ No newline at end of file
+from .autonomi import ant_client, ant_engine, ClientAborted
+from .progress import ant_progress
\ No newline at end of file
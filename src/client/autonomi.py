@@ -7,49 +7,300 @@ Description : Wrapper around pre-compiled binaries
 ===============================================================================
 """
 
-import subprocess
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import re
 import os
-import tempfile
-import inspect
+import signal
+import threading
 import logging
 from log import LogWriter
 from application import Agent
+from agent.agent_scratch import ScratchSpace
 
 cls_agent = Agent()
 log_writer = LogWriter()
 
+# Raised by ant_engine.run when the process was killed by terminate_all (cool down, kill-switch, shutdown)
+class ClientAborted(Exception):
+   pass
+
+CONST_READ_CHUNK = 4096         # bytes read from the client pipes at a time
+CONST_MAX_LINE = 65536          # a line longer than this is cut, so a runaway progress bar can't pin memory
+CONST_LINE_SPLIT = re.compile(rb'[\r\n]')
+
+# The task a client is started for, so terminate_all() can reclaim one task's clients and leave the others running
+client_owner = contextvars.ContextVar("client_owner", default=None)
+
+# Failures by the wording in the client output, the first match wins - a fault on this host (disk, permissions, the
+# client itself) is checked ahead of the network, as a client that can't write its file often reports that too.
+# Anything not matched falls back to CONST_EXIT_CODES, then error:unknown.
+CONST_ERROR_PATTERNS = (
+   ("no space left on device", "error:client"),
+   ("permission denied", "error:client"),
+   ("panicked at", "error:client"),
+   ("unexpected argument", "error:client"),
+   ("usage:", "error:client"),
+   ("could not connect to enough peers", "error:network"),
+   ("connection refused", "error:network"),
+   ("connection reset", "error:network"),
+   ("network is unreachable", "error:network"),
+   ("timed out", "error:timeout"),
+)
+# the client exits 1 for any error it reports, so only the command line parser's exit code says anything on its own
+CONST_EXIT_CODES = {
+   2: "error:client",
+}
+
+# A single event loop thread starts every client process, streams its output and enforces its timeout, in place of
+# a blocking subprocess.run per call.  An open loop arrival is a coroutine on this loop from start to finish, so a
+# download in flight there holds no thread.  A closed loop worker still runs on a WorkerPool thread and blocks in
+# call() until its client exits - it waits on the rate limiter and its concurrency controller between downloads,
+# and those waits block.  Coroutines can be awaited directly from async code, or handed over with submit()/call()
+# from any thread.
+#
+# Every client is started in its own process group and kept in a registry, tagged with the task it was started for,
+# so terminate_all() can reclaim them (and anything they spawned) - one task's at its cool down deadline, all of
+# them on kill-switch or shutdown.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class ant_engine:
+   #Ensure this is a single instance class
+   _instance = None
+
+   def __new__(cls, *args, **kwargs): 
+      if not cls._instance: cls._instance = super(ant_engine, cls).__new__(cls, *args, **kwargs) 
+      return cls._instance 
+
+   def __init__(self): 
+      if not hasattr(self, 'initialized'): 
+         # Ensure __init__ runs only once 
+         self.initialized = True
+         self.__loop = None
+         self.__thread = None
+         self.__lock = threading.Lock()
+         self.__processes = {}      # pid -> asyncio Process, only touched on the loop thread
+         self.__owners = {}         # pid -> task_ref it was started for, only touched on the loop thread
+         self.__aborted = set()     # pids killed by terminate_all
+
+   def __start(self):
+      with self.__lock:
+         if self.__loop is None:
+            self.__loop = asyncio.new_event_loop()
+            self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True, name="Thread-7(ant_engine._loop)")
+            self.__thread.start()
+         #endIf
+      return self.__loop
+
+   # Run the client with args, returns (returncode, stdout, stderr) - raises asyncio.TimeoutError if it runs past
+   # timeout, and ClientAborted if terminate_all killed it.  The process is killed on timeout or if the caller is cancelled
+   #
+   # Output is read as it streams and handed line by line to on_line(stream, line), only the last
+   # CLIENT_OUTPUT_TAIL_LINES of each stream are kept and returned.
+   async def run(self, args, timeout, on_line=None):
+      #WARNING ! exec, not shell, is a safety measure to minimize XSS injections, don't change unless you know what the implications are
+      process = await asyncio.create_subprocess_exec(cls_agent.Configuration.CLIENT_BIN, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+      self.__processes[process.pid] = process
+      self.__owners[process.pid] = client_owner.get()
+      stdout_tail = collections.deque(maxlen=cls_agent.Configuration.CLIENT_OUTPUT_TAIL_LINES)
+      stderr_tail = collections.deque(maxlen=cls_agent.Configuration.CLIENT_OUTPUT_TAIL_LINES)
+      try:
+         await asyncio.wait_for(asyncio.gather(
+            self.__pump(process.stdout, "stdout", stdout_tail, on_line),
+            self.__pump(process.stderr, "stderr", stderr_tail, on_line),
+            process.wait()
+         ), timeout=timeout)
+      except (asyncio.TimeoutError, asyncio.CancelledError):
+         if process.returncode is None:
+            self.__signal(process, signal.SIGKILL)
+            await process.wait()
+         #endIf
+         raise
+      finally:
+         self.__processes.pop(process.pid, None)
+         self.__owners.pop(process.pid, None)
+      #endTry
+
+      if process.pid in self.__aborted:
+         self.__aborted.discard(process.pid)
+         raise ClientAborted(f"client pid {process.pid} terminated")
+      #endIf
+      return process.returncode, "\n".join(stdout_tail), "\n".join(stderr_tail)
+
+   async def __pump(self, stream, name, tail, on_line):
+      # split on \r as well as \n, progress bars redraw the same line with \r
+      buffer = b""
+      while True:
+         data = await stream.read(CONST_READ_CHUNK)
+         if not data:
+            break
+         #endIf
+         buffer += data
+         *lines, buffer = CONST_LINE_SPLIT.split(buffer)
+         if len(buffer) > CONST_MAX_LINE:
+            lines.append(buffer[:CONST_MAX_LINE])
+            buffer = b""
+         #endIf
+         for line in lines:
+            self.__emit(name, line, tail, on_line)
+         #endFor
+      #endWhile
+      self.__emit(name, buffer, tail, on_line)
+
+   def __emit(self, name, line, tail, on_line):
+      if not line:
+         return
+      #endIf
+      text = line.decode('utf-8', errors='replace')
+      tail.append(text)
+      if on_line is not None:
+         try:
+            on_line(name, text)
+         except Exception as e:
+            log_writer.log("> > ant_engine/__emit: on_line failed: %s", logging.DEBUG, e)
+         #endTry
+      #endIf
+
+   def __signal(self, process, sig):
+      try:
+         os.killpg(process.pid, sig)   # pid == pgid, as the client leads its own session
+      except (ProcessLookupError, PermissionError):
+         pass
+      #endTry
+
+   async def __terminate_all(self, reason, owner):
+      processes = [process for pid, process in self.__processes.items() if owner is None or self.__owners.get(pid) == owner]
+      if not processes:
+         return 0
+      #endIf
+      log_writer.log("Terminating %s client processes%s - %s", logging.WARNING, len(processes), f" of task {owner}" if owner is not None else "", reason)
+
+      for process in processes:
+         self.__aborted.add(process.pid)
+         self.__signal(process, signal.SIGTERM)
+      #endFor
+
+      # give them a chance to exit cleanly, then escalate
+      await asyncio.wait([asyncio.ensure_future(process.wait()) for process in processes], timeout=cls_agent.Configuration.CLIENT_KILL_GRACE_SECS)
+      for process in processes:
+         if process.returncode is None:
+            self.__signal(process, signal.SIGKILL)
+         #endIf
+      #endFor
+      return len(processes)
+
+   # Kill every running client process, or only those started for owner (a task_ref), SIGTERM then SIGKILL - returns
+   # the number of processes terminated
+   def terminate_all(self, reason: str, owner: str = None) -> int:
+      with self.__lock:
+         loop = self.__loop
+      #endWith
+      if loop is None:
+         return 0
+      #endIf
+      return asyncio.run_coroutine_threadsafe(self.__terminate_all(reason, owner), loop).result()
+
+   # Number of client processes running right now
+   def count(self) -> int:
+      return len(self.__processes)
+
+   # Hand a coroutine to the engine from any thread, cancel the returned future to cancel the call.  The clients it
+   # starts belong to owner, by default the owner set on the calling thread with owned()
+   def submit(self, coro, owner: str = None) -> concurrent.futures.Future:
+      if owner is None:
+         owner = client_owner.get()
+      #endIf
+      return asyncio.run_coroutine_threadsafe(self.__owned(owner, coro), self.__start())
+
+   # every coroutine handed over runs as a task of its own, so the owner set here is seen by that call only
+   async def __owned(self, owner, coro):
+      client_owner.set(owner)
+      return await coro
+
+   # Clients started from this thread inside the with block belong to owner
+   @contextlib.contextmanager
+   def owned(self, owner: str):
+      token = client_owner.set(owner)
+      try:
+         yield
+      finally:
+         client_owner.reset(token)
+      #endTry
+
+   # Blocking helper for thread callers
+   def call(self, coro):
+      future = self.submit(coro)
+      try:
+         return future.result()
+      except BaseException:
+         future.cancel()
+         raise
+      #endTry
+
+   def shutdown(self):
+      with self.__lock:
+         if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join(timeout=5)
+            self.__loop = None
+         #endIf
+
 class ant_client:
    def ___init___(self):
       # BOILER: todo
       pass
    
-   def __get_temp_filepath (self,filename):
-      if filename:
-         prefix = filename.lower()
-      else:
-         prefix ="unknown"
+   def __get_temp_filepath (self,filename,filesize=None):
+      return ScratchSpace().allocate(filename, filesize)
 
-      custom_path = "./cache/downloads"
-      temp_file_name = os.path.join( custom_path, f"{prefix}_{next(tempfile._get_candidate_names())}" )
-      return (temp_file_name)
-   
-   def quote(self, filename, timeout=30):
-      # BOILER: todo
-      pass
-   def download(self, file_address, timeout):
-      error_messages = { 
-         "could not connect to enough peers in time": "error:network"
-      }
-      error_unknown = {"error:unknown"}
+   # the hard limit for a call is the client's own --timeout, plus a grace period for it to give up cleanly
+   def __hard_timeout(self, timeout):
+      return int(timeout) + cls_agent.Configuration.CLIENT_TIMEOUT_GRACE_SECS
 
-      # BOILER: todo
-      log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: file: {file_address.name}, address: {file_address.address}, md5: {file_address.md5}",logging.INFO)        
+   # A failed call as error:client, error:network, error:timeout or error:unknown, from the client's output and exit
+   # code.  A negative returncode is a signal the agent didn't send (terminate_all and the hard timeout are raised
+   # before this) - the client crashed, or was OOM killed.
+   def __classify(self, returncode, stdout, stderr):
+      if returncode < 0:
+         return "error:client"
+      #endIf
+      output = (stdout + "\n" + stderr).lower()
+      for pattern, err_tag in CONST_ERROR_PATTERNS:
+         if pattern in output:
+            return err_tag
+         #endIf
+      #endFor
+      return CONST_EXIT_CODES.get(returncode, "error:unknown")
+
+# -----> async interface, driven by ant_engine --------------------------------------------------------------
+   async def quote_async(self, filename, timeout=30):
+      try:
+         returncode, stdout, stderr = await ant_engine().run(['file', 'cost', filename], self.__hard_timeout(timeout))
+      except asyncio.TimeoutError:
+         return "error:timeout"
+      except ClientAborted:
+         return "error:aborted"
+      except FileNotFoundError:
+         cls_agent.Exception.throw(error=("ant_client/quote_async: File Not Found"))
+         return "Error: not_found" # don't change the wording as we look for a match in other modules
+      #endTry
+      if returncode != 0:
+         return self.__classify(returncode, stdout, stderr)
+      return stdout.strip()
+
+   # progress is an optional ant_progress, fed with the client output as it streams.  The downloaded file is left in
+   # the scratch space for the caller, at progress.file_path, who hands it back with ScratchSpace().done()
+   async def download_async(self, file_address, timeout, progress=None, filesize=None):
+      log_writer.log("< < ant_client/download_async: file: %s, address: %s, md5: %s",logging.INFO, file_address.name, file_address.address, file_address.md5)        
 
-      temp_file_name = self.__get_temp_filepath(file_address.name)
+      scratch = ScratchSpace()
+      temp_file_name = self.__get_temp_filepath(file_address.name, filesize)
       temp_file_name_log = "./cache/log/"
 
-      command = [ 
-         './bin/autonomi', 
+      args = [ 
          '--timeout', str(timeout), 
          '--log-output-dest', 
          temp_file_name_log, 
@@ -59,33 +310,81 @@ class ant_client:
          temp_file_name 
       ] 
       
+      on_line = None
+      if progress is not None:
+         progress.start()
+         on_line = progress.feed
+      #endIf
+
       try:
-         #WARNING ! shell=False is a safety measure to minimize XSS injections, don't change unless you know what the implications are
-         result = subprocess.run( command, shell=False,check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True )
-
-         #to-do: need to handle file cleanup chore
-         log_writer.log(f"{result.stdout.strip()}",logging.INFO)
-         return result.stdout.strip()
-      except subprocess.CalledProcessError as e:
-         err_tag=error_unknown
-         output = (e.stdout + e.stderr).lower() 
-         for error, action in error_messages.items(): 
-            if error in output: 
-               err_tag = action
-         return (err_tag)
+         returncode, stdout, stderr = await ant_engine().run(args, self.__hard_timeout(timeout), on_line)
+      except asyncio.TimeoutError:
+         scratch.release(temp_file_name)
+         return "error:timeout"
+      except ClientAborted:
+         scratch.release(temp_file_name)
+         return "error:aborted"
+      except asyncio.CancelledError:
+         scratch.release(temp_file_name)
+         raise
       except FileNotFoundError:  #to-do : should be using common dictionary
-         cls_agent.Exception.throw(error=(f"{self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: File Not Found"))
+         scratch.release(temp_file_name)
+         cls_agent.Exception.throw(error=("ant_client/download_async: File Not Found"))
          return "Error: not_found" # don't change the wording as we look for a match in other modules
-      pass
-   def upload(self, filename, timeout=30):
-      # BOILER: todo
-      pass
-   def version(self):
+      #endTry
+
+      if returncode != 0:
+         scratch.release(temp_file_name)  # drop anything partially written
+         return self.__classify(returncode, stdout, stderr)
+      #endIf
+
+      scratch.commit(temp_file_name)
+      if progress is not None:
+         progress.finish(temp_file_name)
+      else:
+         scratch.done(temp_file_name)
+      #endIfElse
+
+      log_writer.log("%s",logging.INFO, stdout.strip())
+      return stdout.strip()
+
+   async def upload_async(self, filename, timeout=30):
+      try:
+         returncode, stdout, stderr = await ant_engine().run(['file', 'upload', '--public', filename], self.__hard_timeout(timeout))
+      except asyncio.TimeoutError:
+         return "error:timeout"
+      except ClientAborted:
+         return "error:aborted"
+      except FileNotFoundError:
+         cls_agent.Exception.throw(error=("ant_client/upload_async: File Not Found"))
+         return "Error: not_found" # don't change the wording as we look for a match in other modules
+      #endTry
+      if returncode != 0:
+         return self.__classify(returncode, stdout, stderr)
+      return stdout.strip()
+
+   async def version_async(self, timeout=30):
       try:
-         result = subprocess.run(['./bin/autonomi', '--version'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-         return result.stdout.strip()
-      except subprocess.CalledProcessError as e:
-         return f"Error: {e.stderr.strip()}"
+         returncode, stdout, stderr = await ant_engine().run(['--version'], timeout)
+      except asyncio.TimeoutError:
+         return "Error: timeout"
       except FileNotFoundError:
-         cls_agent.Exception.throw(error=(f"{self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: File Not Found"))
+         cls_agent.Exception.throw(error=("ant_client/version_async: File Not Found"))
          return "Error: not_found" # don't change the wording as we look for a match in other modules
+      #endTry
+      if returncode != 0:
+         return f"Error: {stderr.strip()}"
+      return stdout.strip()
+
+# -----> blocking interface, for worker threads ---------------------------------------------------------------
+   def quote(self, filename, timeout=30):
+      return ant_engine().call(self.quote_async(filename, timeout))
+
+   def download(self, file_address, timeout, progress=None, filesize=None):
+      return ant_engine().call(self.download_async(file_address, timeout, progress, filesize))
+
+   def upload(self, filename, timeout=30):
+      return ant_engine().call(self.upload_async(filename, timeout))
+
+   def version(self):
+      return ant_engine().call(self.version_async())
@@ -0,0 +1,68 @@
+"""
+===============================================================================
+Title : progress.py
+
+Description : Parses client output as it streams, and times each phase
+
+===============================================================================
+"""
+
+import os
+import re
+import time
+
+# Phase name -> pattern, matched case-insensitively against each line of stdout/stderr.  The first line to match
+# a phase records the time since the client started, a pattern with a group also records the number it captured.
+# Client output changes between releases, so patterns can be swapped per instance or with register_pattern().
+CONST_PROGRESS_PATTERNS = {
+   "connected": r"connected to the network|connected to \d+ peers",
+   "first_chunk": r"(fetch|download|receiv)\w* (data|chunk)",
+   "chunks_done": r"successfully downloaded|download(ed)? complete|all chunks",
+   "bytes_written": r"(\d+) bytes",
+}
+
+class ant_progress:
+   def __init__(self, patterns=None):
+      self.patterns = {name: re.compile(pattern, re.IGNORECASE) for name, pattern in (patterns or CONST_PROGRESS_PATTERNS).items()}
+      self.started = time.monotonic()
+      self.phases = {}     # phase -> seconds since start
+      self.values = {}     # phase -> number captured by the pattern
+      self.lines = 0
+      self.file_path = None
+
+   def register_pattern(self, name, pattern):
+      self.patterns[name] = re.compile(pattern, re.IGNORECASE)
+
+   def start(self):
+      self.started = time.monotonic()
+
+   # Called by ant_engine for every line, from the event loop - keep it cheap, only unmatched phases are tested
+   def feed(self, stream, line):
+      self.lines += 1
+      for name, pattern in self.patterns.items():
+         if name in self.phases:
+            continue
+         match = pattern.search(line)
+         if match:
+            self.phases[name] = round(time.monotonic() - self.started, 3)
+            if match.groups() and match.group(1) and match.group(1).isdigit():
+               self.values[name] = int(match.group(1))
+            #endIf
+         #endIf
+      #endFor
+
+   # The client doesn't always report what it wrote, so fall back to the file on disk once it has exited
+   def finish(self, file_path=None):
+      self.file_path = file_path
+      if "bytes_written" not in self.values and file_path and os.path.exists(file_path):
+         self.values["bytes_written"] = os.path.getsize(file_path)
+         self.phases.setdefault("bytes_written", round(time.monotonic() - self.started, 3))
+      #endIf
+
+   # Copy the phase timings into a Performance.TestResults
+   def apply(self, results):
+      results.t_connect = self.phases.get("connected", 0)
+      results.t_first_chunk = self.phases.get("first_chunk", 0)
+      results.t_chunks_done = self.phases.get("chunks_done", 0)
+      results.t_written = self.phases.get("bytes_written", 0)
+      results.bytes_written = self.values.get("bytes_written", 0)
@@ -0,0 +1,150 @@
+"""
+===================================================================================================
+Title : fetcher.py
+
+Description : Shared fetcher for control-plane files (tasks, kill-switch, file catalog), over HTTP or from disk
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from fetcher import ControlFetcher
+# response = ControlFetcher().fetch(url)
+#
+# results = ControlFetcher().fetch_all(source, suffix=".xml")    # one result per file when source is a directory
+#
+# A source is an http(s) url, a file:// url, or a plain path to a file or a directory - a local source is read
+# straight from disk, so lab and CI runs work offline (and the ControlWatcher reloads it as soon as it changes).
+
+import logging
+import os
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import NamedTuple
+from application import Agent
+from log import LogWriter
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+class FetchResult(NamedTuple):
+    url: str
+    text: str
+    status_code: int    # 200 or 304, anything else raises
+    modified: bool      # False when the server answered 304 and text came from our cache
+
+# Notes : This is a single instance class, so ensure that is enforced.
+class ControlFetcher:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(ControlFetcher, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            # keep-alive session, connections are re-used between fetches
+            self.__session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=cls_agent.Configuration.FETCH_POOL_SIZE, pool_maxsize=cls_agent.Configuration.FETCH_POOL_SIZE)
+            self.__session.mount("https://", adapter)
+            self.__session.mount("http://", adapter)
+
+            self.__cache = {}                # url -> (etag, last_modified, text)
+            self.__cache_lock = threading.Lock()
+
+    # True for a file:// url or a path, anything that isn't http(s)
+    @staticmethod
+    def is_local(source: str) -> bool:
+        return not source.lower().startswith(("http://", "https://"))
+
+    @staticmethod
+    def local_path(source: str) -> str:
+        return os.path.abspath(os.path.expanduser(source[len("file://"):] if source.lower().startswith("file://") else source))
+
+    # Reads a local file, raises OSError.  modified is False when the text is the same as the last read.
+    def __read_local(self, url: str) -> FetchResult:
+        with open(self.local_path(url), 'r', encoding='utf-8') as file:
+            text = file.read()
+        #endWith
+        with self.__cache_lock:
+            cached = self.__cache.get(url)
+            self.__cache[url] = (None, None, text)
+        #endWith
+        log_writer.log("> > ControlFetcher/__read_local: %s read %s bytes", logging.DEBUG, url, len(text))
+        return FetchResult(url=url, text=text, status_code=200, modified=cached is None or cached[2] != text)
+
+    # The files of a local directory, in name order - hidden files and editor backups are left out
+    def list_local(self, source: str, suffix: str = "") -> list:
+        path = self.local_path(source)
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if not name.startswith(('.', '#')) and not name.endswith('~') and name.lower().endswith(suffix) and os.path.isfile(os.path.join(path, name))]
+
+    # One result for a url or a file, or one per file (ending in suffix) for a local directory.  A directory with no
+    # such files raises FileNotFoundError, the same as a missing file - it is usually mid checkout or mid save, and an
+    # empty result would read as "no tasks" and clear the schedule.
+    def fetch_all(self, source: str, suffix: str = "") -> list:
+        if self.is_local(source) and os.path.isdir(self.local_path(source)):
+            paths = self.list_local(source, suffix)
+            if not paths:
+                raise FileNotFoundError(f"{self.local_path(source)} has no {suffix or 'control'} files")
+            #endIf
+            return [self.__read_local(path) for path in paths]
+        #endIf
+        return [self.fetch(source)]
+
+    def fetch(self, url: str) -> FetchResult:
+        if self.is_local(url):
+            return self.__read_local(url)
+        #endIf
+
+        headers = {}
+        with self.__cache_lock:
+            cached = self.__cache.get(url)
+        #endWith
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        #endIf
+
+        response = self.__session.get(url, headers=headers, timeout=(cls_agent.Configuration.FETCH_CONNECT_TIMEOUT, cls_agent.Configuration.FETCH_READ_TIMEOUT))
+
+        if response.status_code == 304 and cached:
+            log_writer.log("> > ControlFetcher/fetch: %s not modified", logging.DEBUG, url)
+            return FetchResult(url=url, text=cached[2], status_code=304, modified=False)
+        #endIf
+
+        response.raise_for_status()  # Raise an error if the request was unsuccessful
+
+        with self.__cache_lock:
+            self.__cache[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'), response.text)
+        #endWith
+
+        log_writer.log("> > ControlFetcher/fetch: %s fetched %s bytes", logging.DEBUG, url, len(response.content))
+        return FetchResult(url=url, text=response.text, status_code=response.status_code, modified=True)
+
+    # Random delay in seconds to apply to a scheduled refresh, so a fleet of agents doesn't all hit github at once -
+    # up to FETCH_JITTER_SECS, or at most if that is less (a periodic refresh mustn't run into the next one)
+    def refresh_jitter(self, at_most: float = None) -> float:
+        limit = cls_agent.Configuration.FETCH_JITTER_SECS if at_most is None else min(cls_agent.Configuration.FETCH_JITTER_SECS, at_most)
+        return random.uniform(0, limit)
+
+    # Closes the keep-alive connections, called on shutdown
+    def close(self):
+        self.__session.close()
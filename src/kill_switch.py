@@ -15,8 +15,11 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
+import json
+import threading
 import requests
 from application import Agent
+from fetcher import ControlFetcher
 from datetime import datetime, timedelta
 import logging
 from log import LogWriter
@@ -25,6 +28,7 @@ from ratelimit import limits, RateLimitException
 #to-do : constants need moving
 log_writer = LogWriter()
 cls_agent = Agent()
+fetcher = ControlFetcher()
 
 # Define the rate limit (60 requests per hour) 
 CONST_ONE_HOUR = 3600 
@@ -44,7 +48,7 @@ def ignore_rate_limit(func):
             current_time = datetime.now() 
             if current_time - last_exception_time >= CONST_FIVE_MINUTES: 
                 last_exception_time = current_time 
-                log_writer.log(f"Rate limit : check_for_kill_switch called, suppressing for 5 minutes",logging.INFO) 
+                log_writer.log("Rate limit : check_for_kill_switch called, suppressing for 5 minutes",logging.INFO) 
             #endIf    
             return None
         #endTry
@@ -59,11 +63,12 @@ class GitHubRepoIssuesChecker:
         self.repo = cls_agent.Configuration.GIT_REPO
         self.url = cls_agent.Configuration.GIT_KILL_SWITCH_URL
         
-        # Substitute the variables into the URL
-        url = self.url.format(owner=self.owner, repo=self.repo)
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an error if the request was unsuccessful
-        return response.json()
+        # Substitute the variables into the URL - a local file (path or file:// url) is read as is, in the same
+        # shape as the github issue list, so an offline run can turn the switch off with a file holding []
+        url = self.url if fetcher.is_local(self.url) else self.url.format(owner=self.owner, repo=self.repo)
+        # conditional request, an unchanged issue list answers 304 and doesn't count against the github rate limit
+        response = fetcher.fetch(url)
+        return json.loads(response.text)
 
     @ignore_rate_limit 
     @limits(calls=60, period=CONST_ONE_HOUR)
@@ -82,3 +87,96 @@ class GitHubRepoIssuesChecker:
             #endIf
         #endFor
         return False, None
+
+
+# Background poller, so workers never call github themselves - they read the published state, which is an
+# in-memory event, and a repeat loop waiting on it is woken as soon as the kill-switch is turned on.
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class KillSwitchMonitor:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs): 
+        if not cls._instance: cls._instance = super(KillSwitchMonitor, cls).__new__(cls, *args, **kwargs) 
+        return cls._instance 
+    
+    def __init__(self): 
+        if not hasattr(self, 'initialized'): 
+            # Ensure __init__ runs only once 
+            self.initialized = True
+
+            self.__checker = GitHubRepoIssuesChecker()
+            self.__created_date = None
+            self.__stop_event = threading.Event()
+            self.__thread = None
+            self.__listeners = []       # called with the new state (True = ON), on the poller thread, when it flips
+
+            # The agent must default to a failed state, so the switch is ON until github (or the local file) tells us otherwise
+            self.__active = threading.Event()
+            self.__active.set()
+
+    def __poll(self):
+        try:
+            result = self.__checker.check_for_kill_switch()
+        except (requests.exceptions.RequestException, OSError, ValueError, KeyError, TypeError) as e:
+            log_writer.log("Kill-switch check failed, keeping last state (active=%s): %s", logging.WARNING, self.is_active(), e)
+            return
+        #endTry
+
+        if result is None:
+            return  # rate limited, keep the last known state
+        #endIf
+
+        killswitch_found, created_date = result
+        if killswitch_found:
+            self.__created_date = created_date
+            changed = not self.__active.is_set()
+            if changed:
+                log_writer.log("Kill-switch ON, raised by github issue created %s", logging.WARNING, created_date)
+            self.__active.set()
+        else:
+            changed = self.__active.is_set()
+            if changed:
+                log_writer.log("Kill-switch OFF", logging.INFO)
+            self.__active.clear()
+            self.__created_date = None
+        #endIfElse
+
+        if changed:
+            for listener in list(self.__listeners):
+                listener(killswitch_found)
+            #endFor
+        #endIf
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def __run(self):
+        while not self.__stop_event.wait(cls_agent.Configuration.KILL_SWITCH_POLL_SECS):
+            self.__poll()
+        #endWhile
+
+    def start(self):
+        if self.__thread is None:
+            # first poll is inline, so the state is known before any task is scheduled
+            self.__poll()
+            self.__thread = threading.Thread(target=self.__run, daemon=True, name="Thread-5(KillSwitchMonitor._run)")
+            self.__thread.start()
+        #endIf
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=5)
+
+    def is_active(self) -> bool:
+        return self.__active.is_set()
+
+    # same shape as GitHubRepoIssuesChecker.check_for_kill_switch, (found, created date)
+    def get(self):
+        return self.__active.is_set(), self.__created_date
+
+    # Sleep for up to timeout seconds, returns True straight away if the kill-switch is (or turns) ON
+    def wait(self, timeout: float) -> bool:
+        return self.__active.wait(timeout)
@@ -15,12 +15,37 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
-#todo : needs a complete re-write
+# Workers never touch a handler - log() checks the level, then drops the record on a queue, and a single listener
+# thread formats it and writes it to the console and file.  Messages are %-style with their arguments passed
+# separately, so a line below the log level costs one level check and nothing is formatted on the calling thread.
+#
+#   log_writer.log("> > DownloadClient/download: time_to_sleep %s", logging.DEBUG, time_to_sleep)
+#
+# Call sites name their class/method in the message, so this logger skips logging's caller lookup (a stack walk per
+# record).  Only this logger - the logging module itself is left alone, so other libraries' records keep theirs.
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import time
 from application import Agent
 
+class _AgentLogger(logging.Logger):
+    def findCaller(self, stack_info=False, stacklevel=1):
+        return "(unknown file)", 0, "(unknown function)", None
+
+# QueueHandler.prepare() formats the message on the calling thread, this one leaves it for the listener.  Arguments
+# are held by reference until then, so pass values, not objects that are about to change.
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # traceback frames can't wait, render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        #endIf
+        record.exc_info = None
+        return record
+
 # Notes : This is a single instance class, so ensure that is enforced.
 class LogWriter:
     #Ensure this is a single instance class
@@ -32,54 +57,69 @@ class LogWriter:
         if not cls._instance: cls._instance = super(LogWriter, cls).__new__(cls, *args, **kwargs) 
         return cls._instance 
 
-    #todo : this needs much better handler
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.initialized = True
+
+            # not from getLogger(), which would hand back a plain Logger
+            self.logger = _AgentLogger('LogWriter')
+            self.logger.propagate = False
+            self.__listener = None
                 
-    def config(self, log_to_file=None, log_file_path=None): 
+    def config(self, log_to_file=None, log_file_path=None, log_to_console=True): 
         # Assign default values if None 
         if log_to_file is None: 
             log_to_file = self.cls_agent.Configuration.LOG_TO_FILE 
         if log_file_path is None: 
             log_file_path = self.cls_agent.Configuration.LOG_FILE_PATH
+        if self.__listener is not None:
+            return
 
-            self.logger = logging.getLogger('LogWriter')
-            self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(self.cls_agent.Configuration.DEFAULT_LOG_LEVEL)
 
-            # Custom time function to get UTC time
-            logging.Formatter.converter = time.gmtime
+        # Custom time function to get UTC time
+        logging.Formatter.converter = time.gmtime
 
-            # Console handler
+        # Console handler
+        handlers = []
+        if log_to_console:
             console_handler = logging.StreamHandler()
-            console_handler.setLevel(logging.DEBUG)
             console_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s\r', datefmt=self.cls_agent.Configuration.DATE_FORMAT)
             console_handler.setFormatter(console_format)
-            self.logger.addHandler(console_handler)
+            handlers.append(console_handler)
 
-            # File handler
+        # File handler
+        if log_to_file:
+            if not os.path.exists(os.path.dirname(log_file_path)):
+                try:
+                    os.makedirs(os.path.dirname(log_file_path))
+                except Exception as e:
+                    print(f"Error creating log directory: {e}")
+                    log_to_file = False
             if log_to_file:
-                if not os.path.exists(os.path.dirname(log_file_path)):
-                    try:
-                        os.makedirs(os.path.dirname(log_file_path))
-                    except Exception as e:
-                        print(f"Error creating log directory: {e}")
-                        log_to_file = False
-                if log_to_file:
-                    file_handler = logging.FileHandler(log_file_path)
-                    file_handler.setLevel(logging.DEBUG)
-                    file_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt=self.cls_agent.Configuration.DATE_FORMAT)
-                    file_handler.setFormatter(file_format)
-                    self.logger.addHandler(file_handler)
-
-    def log(self, message, level=logging.INFO):
-        if level == logging.DEBUG:
-            self.logger.debug(message)
-        elif level == logging.INFO:
-            self.logger.info(message)
-        elif level == logging.WARNING:
-            self.logger.warning(message)
-        elif level == logging.ERROR:
-            self.logger.error(message)
-        elif level == logging.CRITICAL:
-            self.logger.critical(message)
\ No newline at end of file
+                file_handler = logging.FileHandler(log_file_path)
+                file_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt=self.cls_agent.Configuration.DATE_FORMAT)
+                file_handler.setFormatter(file_format)
+                handlers.append(file_handler)
+
+        # the only handler on the logger is the queue, the listener thread owns the real ones
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(_DeferredQueueHandler(log_queue))
+        self.__listener = logging.handlers.QueueListener(log_queue, *handlers)
+        self.__listener.start()
+        self.__listener._thread.name = "Thread-10(LogWriter._monitor)"
+        atexit.register(self.stop)
+
+    # Cheap enough to guard an expensive message with, logging caches the answer per level
+    def is_enabled(self, level) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def log(self, message, level=logging.INFO, *args):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, *args)
+
+    # Write out anything still queued, and stop the listener thread
+    def stop(self):
+        if self.__listener is not None:
+            self.__listener.stop()
+            self.__listener = None
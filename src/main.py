@@ -25,11 +25,13 @@ import threading
 import queue 
 import tty 
 import termios 
-import time
 from agent.agent_performance import Performance
 from agent.agent_limiter import Limiter
+from agent.agent_profiler import Profiler
+from web import MetricsServer
 from scheduler import ScheduleManager
-from client.autonomi import ant_client
+from client.autonomi import ant_client, ant_engine
+from fetcher import ControlFetcher
 
 # DEFINITIONS ------------------------------------------------------------------
 def getch(): 
@@ -65,19 +67,19 @@ if __name__ == "__main__":
     input_queue = queue.Queue()
     
     #Build Information
-    log_writer.log(f"Build Name: {cls_agent.version.BUILD_NAME}", logging.INFO)
-    log_writer.log(f"Build Version: {cls_agent.version.BUILD_VERSION}", logging.INFO)
-    log_writer.log(f"Build Commit Hash: {cls_agent.version.COMMIT_HASH}", logging.INFO)
-    log_writer.log(f"Build Date: {cls_agent.version.BUILD_DATE}", logging.INFO)
+    log_writer.log("Build Name: %s", logging.INFO, cls_agent.version.BUILD_NAME)
+    log_writer.log("Build Version: %s", logging.INFO, cls_agent.version.BUILD_VERSION)
+    log_writer.log("Build Commit Hash: %s", logging.INFO, cls_agent.version.COMMIT_HASH)
+    log_writer.log("Build Date: %s", logging.INFO, cls_agent.version.BUILD_DATE)
 
     #Detect if client can be found, else terminate
     client = ant_client()
     ant_version = client.version()
     if "not_found" in ant_version:
-       log_writer.log(f"The 'autonomi' client command was not found. Have you installed it ?", logging.FATAL )
+       log_writer.log("The 'autonomi' client command was not found. Have you installed it ?", logging.FATAL )
        sys.exit(1)
     else:
-        log_writer.log(f"Found Client: {ant_version}", logging.INFO)
+        log_writer.log("Found Client: %s", logging.INFO, ant_version)
     #endIfElse
     client = None
 
@@ -93,34 +95,50 @@ if __name__ == "__main__":
     rate_limit = Limiter()
     rate_limit.show_limits()
 
+    #scrape endpoint for live agent state
+    metrics_server = MetricsServer()
+    metrics_server.start()
+
     #Show console update that we are running
-    log_writer.log(f"Agent Scheduler Threads for (ScheduleManager) and (TaskManager) started", logging.INFO)
-    log_writer.log(F"Press >> q << to terminate agent - >> f << to fetch updated tasks before :00 - (10 second delay)", logging.INFO)
+    log_writer.log("Agent Scheduler Threads for (ScheduleManager) and (TaskManager) started", logging.INFO)
+    log_writer.log("Press >> q << to terminate agent - >> f << to fetch updated tasks now", logging.INFO)
+    log_writer.log("Press >> p << to start/stop CPU profiling - >> m << to start/stop memory tracing - output in %s", logging.INFO, cls_agent.Configuration.PROFILE_DIR)
+
+    #runtime profiling, off until toggled
+    profiler = Profiler()
 
      # Start the input reading thread 
     input_thread = threading.Thread(target=read_input, name="Thread-0(_main.read_input)") 
     input_thread.daemon = True 
     input_thread.start() 
 
-    #Lazy main loop # todo - needs to support service / docker / webapp
+    #an exception thrown on any thread wakes the main loop, so it doesn't have to poll for it
+    cls_agent.Exception.add_listener(lambda: input_queue.put(None))
+
+    #Main loop, blocks until there is a key press or an exception # todo - needs to support service / docker / webapp
     while True: 
-        try: 
-            user_input = input_queue.get_nowait() 
-            if user_input == 'q':
-                cls_agent.exec_Shutdown() 
-                schedule_manager.terminate()
-                perf.shutdown()
-                log_writer.log(f"Scheduler Threads terminated and Agent is stopped.", logging.INFO)
-                sys.exit(None)
-                #end __main__
-            elif user_input == 'f': 
-                schedule_manager.fetch_tasks()
-            #endIf
-        except queue.Empty: 
-            # handle this when no user input - should really be somewhere else
-            if cls_agent.Exception.has_occurred():
-                log_writer.log(f"Code exception has occured {cls_agent.Exception.get}",logging.FATAL)
-                sys.exit(1)
-                #end __main__ with FATAL exception
-        # Sleep for 10 seconds 
-        time.sleep(10)
\ No newline at end of file
+        user_input = input_queue.get() 
+        if user_input == 'q':
+            cls_agent.exec_Shutdown() 
+            schedule_manager.terminate()
+            perf.shutdown()
+            profiler.shutdown()
+            metrics_server.shutdown()
+            ant_engine().shutdown()
+            ControlFetcher().close()
+            log_writer.log("Scheduler Threads terminated and Agent is stopped.", logging.INFO)
+            sys.exit(None)
+            #end __main__
+        elif user_input == 'f': 
+            schedule_manager.fetch_tasks()
+        elif user_input == 'p':
+            profiler.toggle_cpu()
+        elif user_input == 'm':
+            profiler.toggle_memory()
+        #endIf
+
+        if cls_agent.Exception.has_occurred():
+            log_writer.log("Code exception has occured %s",logging.FATAL, cls_agent.Exception.get)
+            sys.exit(1)
+            #end __main__ with FATAL exception
+        #endIf
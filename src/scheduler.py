@@ -15,29 +15,47 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
-import schedule
-import inspect
-import time
 import threading
 from application import Agent
 import logging
-from agent.agent_runner import AgentRunner
-from tasks import Agent_Task
+from agent.agent_supervisor import TaskSupervisor
+from agent.agent_pool import WorkerPool
+from agent.agent_verify import FileVerifier
+from agent.agent_scratch import ScratchSpace
+from agent.agent_timer import TimerScheduler
+from agent.agent_limiter import Limiter
+from agent.agent_performance import Performance
+from tasks import fetch_and_parse_xml
 import kill_switch
 from log import LogWriter
 from agent.agent_helper import Utils
 from tabulate import tabulate
+from fetcher import ControlFetcher
+from watcher import ControlWatcher
+from agent.agent_catalog import FileCatalog
 
 #get a handle to logging class
 log_writer = LogWriter()
 cls_agent = Agent()
 
-#get a handle to kill switch detection
-killswitch_checker = kill_switch.GitHubRepoIssuesChecker()
+#get a handle to kill switch state, polled in the background
+killswitch_monitor = kill_switch.KillSwitchMonitor()
 
 #get a handle to helper utils
 helper = Utils()
 
+#get a handle to the task supervisor, which runs the tasks we dispatch
+task_supervisor = TaskSupervisor()
+
+#get a handle to the shared control-plane fetcher
+fetcher = ControlFetcher()
+
+#get a handle to the deadline timer, which runs both schedules
+timer = TimerScheduler()
+
+#get a handle to the watcher, which reloads local control sources as soon as they change
+watcher = ControlWatcher()
+
 # Notes : This is a single instance class, so ensure that is enforced.
 class ScheduleManager:
      #Ensure this is a single instance class
@@ -54,151 +72,210 @@ class ScheduleManager:
             self._instance = False  # Allow schedule setup only once, and define threads
 
             self.tasks = []         # holds the tasks we have spawned from the test plan
-            self.agent_runners = [] # Store references to AgentRunner instances
+            self.__live = {}        # task_ref -> (content hash, timer job), what the schedule is running now
+            self.__reconcile_lock = threading.Lock()
 
-            #Schedule Manager (SM) Schedule used for running jobs - can be paused, and cleared
+            #Schedule Manager (SM) group, used for running jobs - can be paused, and cleared
             self._paused = True 
-            self._stop_eventSM = threading.Event()
-            self._schedulerSM = schedule.Scheduler()
+            timer.pause("SM")
 
-            #Task Manager (TM) Schedule used solely for downloading jobs to run from github
+            #Task Manager (TM) group, used solely for downloading jobs to run from github - the timer only asks for a
+            #fetch, it runs on its own thread so a slow github never holds up the SM jobs
             self._stop_eventTM = threading.Event()
-            self._schedulerTM = schedule.Scheduler()
+            self.__fetch_wanted = threading.Event()
+            self.__fetch_thread = None
         #endIf
     
-    def __convert_to_colon_format(self, minutes_string):
-        padded_minutes = f"{int(minutes_string):02d}"
-        return f":{padded_minutes}"
+    def __convert_to_colon_format(self, minutes: int):
+        return f":{minutes:02d}"
 
+    # Returns the timer job, or None if the task couldn't be scheduled
     def __add_task(self, task):
         if self.task_already_scheduled(self.__convert_to_colon_format(task.time_period)):
-            log_writer.log(f"Task already scheduled at {self.__convert_to_colon_format(task.time_period)}", logging.ERROR)
-            return
-        if task.test_type.lower() == "download":
-            self._schedulerSM.every(1).minute.do(self.__downloadtask_schedule, task)
-            #self._schedulerSM.every().hour.at(self.__convert_to_colon_format(task.time_period)).do(self.__downloadtask_schedule, task)
+            log_writer.log("Task already scheduled at %s", logging.ERROR, self.__convert_to_colon_format(task.time_period))
+            return None
+        if task.test_type == "download":
+            job = timer.every(60, self.__downloadtask_schedule, task, name=f"download:{task.task_ref}", group="SM")
+            #job = timer.hourly_at(self.__convert_to_colon_format(task.time_period), self.__downloadtask_schedule, task, name=f"download:{task.task_ref}", group="SM")
             self.tasks.append((task, "download", self.__convert_to_colon_format(task.time_period)))
-        elif task.test_type.lower() == "quote":
-            self._schedulerSM.every(2).minutes.do(self.__quotetask_schedule, task)
-            #self._schedulerSM.every().hour.at(self.__convert_to_colon_format(task.time_period)).do(self.__quotetask_schedule, task)
+        elif task.test_type == "quote":
+            job = timer.every(120, self.__quotetask_schedule, task, name=f"quote:{task.task_ref}", group="SM")
+            #job = timer.hourly_at(self.__convert_to_colon_format(task.time_period), self.__quotetask_schedule, task, name=f"quote:{task.task_ref}", group="SM")
             self.tasks.append((task, "quote", self.__convert_to_colon_format(task.time_period)))
-        elif task.test_type.lower() == "upload":
-            self._schedulerSM.every().hour.at(self.__convert_to_colon_format(task.time_period)).do(self.__uploadtask_schedule, task)
+        elif task.test_type == "upload":
+            job = timer.hourly_at(self.__convert_to_colon_format(task.time_period), self.__uploadtask_schedule, task, name=f"upload:{task.task_ref}", group="SM")
             self.tasks.append((task, "upload", self.__convert_to_colon_format(task.time_period)))
         else:
-            log_writer.log(f"Unknown test type: {task.test_type}", logging.ERROR)
-            
-    # Fetch_Tasks will query the source, and populate a TASKS object will all the tasks to execute
+            log_writer.log("Unknown test type: %s", logging.ERROR, task.test_type)
+            return None
+        #endIfElse
+
+        # optional per task rate, on top of the limit for its test type
+        Limiter().configure_task(task.task_ref, task.rate, task.burst)
+        return job
+
+    # keep_limit for a task about to be re-added, its rate bucket is updated in place so it keeps the tokens it has
+    def __remove_task(self, task_ref, keep_limit=False):
+        _, job = self.__live.pop(task_ref)
+        if job is not None:
+            timer.cancel(job)
+        #endIf
+        self.tasks = [entry for entry in self.tasks if entry[0].task_ref != task_ref]
+        if not keep_limit:
+            Limiter().configure_task(task_ref)
+        #endIf
+
+    # Fetch_Tasks will query the source, and bring the schedule in line with it.  Tasks are matched by TaskRef and
+    # compared by content hash, so only added, removed and changed tasks touch the timer - an unchanged XML leaves
+    # every job (and its place on the grid) alone, and the schedule is never paused to do it.
     def fetch_tasks(self):
-        log_writer.log(f"Fetching tasks and jobs from github XML and updating schedule",logging.INFO)    
- 
-        #pause any existing schedules, and clear them
-        self.pause_schedule()
-        self.clear_schedule()
+        log_writer.log("> > ScheduleManager/fetch_tasks: checking github XML for task changes", logging.DEBUG)
  
         #if killswitch is active, then we don't process any TASKS and we wait...      
-        killswitch_found, datetime = killswitch_checker.check_for_kill_switch()
+        killswitch_found, datetime = killswitch_monitor.get()
         if killswitch_found:
-            log_writer.log(f"Kill-switch ON, test paused by github issue created {datetime}, agent active.",logging.WARNING)
-        else:
-            tasks = Agent_Task.fetch_and_parse_xml(cls_agent.Configuration.SCHEDULER_URL)
-
-            # Collect data for table, and store it in tabulate format 
-            table_data = []
-
-            for task in tasks:
-                table_data.append( {
-                    "Task": f"{task.task_ref}",
-                    "Mins" : f"{task.time_period}",
-                    "Worker": f"{task.test_options.get('workers', None)}", 
-                    "Repeat": f"{task.test_options.get('repeat', False)}",
-                    "Offset": f"{task.test_options.get('offset', None)}",
-                    "Type": f"{task.test_type}", 
-                    "Description": f"{task.description}" 
-                })
-
-                self.__add_task(task)
-            #EndFor
+            log_writer.log("Kill-switch ON, test paused by github issue created %s, agent active.",logging.WARNING, datetime)
+            self.pause_schedule()
+            return
+        #endIf
 
-            # Create a nice looking table 
-            table = tabulate(table_data, headers="keys", tablefmt="grid", numalign="centre")
+        parsed = fetch_and_parse_xml(cls_agent.Configuration.SCHEDULER_URL)
+        if parsed is None:
+            # fetch or parse failed, keep running the schedule we have
+            return
+        #endIf
+        tasks, limits = parsed
 
-            # todo - logger doesnt support tabulate format
-            print(f"{table}")
+        with self.__reconcile_lock:
+            # limits for each test type, the per task rates are set as the tasks are added
+            Limiter().configure(limits)
 
+            wanted = {}
+            for task in tasks:
+                if task.task_ref in wanted:
+                    log_writer.log("Task %s is defined more than once, the last definition is used", logging.WARNING, task.task_ref)
+                #endIf
+                wanted[task.task_ref] = task
+            #endFor
+
+            removed = [task_ref for task_ref in self.__live if task_ref not in wanted]
+            changed = [task_ref for task_ref, task in wanted.items() if task_ref in self.__live and self.__live[task_ref][0] != task.content_hash]
+            added = [task_ref for task_ref in wanted if task_ref not in self.__live]
+
+            # removals first, so a changed task can move into a time slot another task just left
+            for task_ref in removed + changed:
+                self.__remove_task(task_ref, keep_limit=task_ref in changed)
+            #endFor
+            for task_ref in changed + added:
+                task = wanted[task_ref]
+                job = self.__add_task(task)
+                # a task that couldn't be scheduled (its slot is taken) isn't live, so the next refresh tries it again
+                if job is not None:
+                    self.__live[task_ref] = (task.content_hash, job)
+                elif task_ref in changed:
+                    Limiter().configure_task(task_ref)
+                #endIfElse
+            #endFor
+            added = [task_ref for task_ref in added if task_ref in self.__live]
+        #endWith
+
+        if removed or changed or added:
+            log_writer.log("Schedule updated from github XML - added %s, changed %s, removed %s", logging.INFO, added, changed, removed)
+            self.__show_tasks([task for task, _, _ in self.tasks])
+            Limiter().show_limits()
             self.__purge_envionment()
+        #endIf
 
+        if self._paused:
             self.resume_schedule()
-        #EndIfElse
+        #endIf
+
+    def __show_tasks(self, tasks):
+        # Collect data for table, and store it in tabulate format 
+        table_data = []
+
+        for task in tasks:
+            table_data.append( {
+                "Task": f"{task.task_ref}",
+                "Mins" : f"{task.time_period}",
+                "Worker": f"{task.workers}", 
+                "Repeat": f"{task.repeat}",
+                "Offset": f"{task.offset}",
+                "Size": f"{task.filesize}",
+                "Arrival": f"{task.arrival} {task.arrival_rate:g}/min" if task.arrival != "closed" else f"{task.arrival}",
+                "Type": f"{task.test_type}", 
+                "Description": f"{task.description}" 
+            })
+        #EndFor
+
+        # Create a nice looking table 
+        table = tabulate(table_data, headers="keys", tablefmt="grid", numalign="centre")
+
+        # todo - logger doesnt support tabulate format
+        print(f"{table}")
 
 # ----> DOWNLOAD TASK SCHEDULER <--------------------------------------------------------------------------------------------------
     def __downloadtask_schedule(self, task):
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {task.task_ref}", logging.DEBUG )
+        log_writer.log("> > ScheduleManager/__downloadtask_schedule: %s", logging.DEBUG, task.task_ref )
 
         if Utils.scheduler_no_tasks_window():
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
+            log_writer.log("> > ScheduleManager/__downloadtask_schedule: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
             #We can't execute this schedule, as we are in a no-tasks window
-        elif killswitch_checker.check_for_kill_switch()[0]:
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: check_for_kill_switch: TRUE", logging.DEBUG )
+        elif killswitch_monitor.is_active():
+            log_writer.log("> > ScheduleManager/__downloadtask_schedule: kill_switch: ACTIVE", logging.DEBUG )
             #We can't execute this schedule, kill switch is active
         else:
             try:
-                #pass the task over to the Agent Runner to spawn the workers
-                agent_runner = AgentRunner()
-                self.agent_runners.append(agent_runner) # Keep track of AgentRunner instances 
-                agent_runner.exec_download_task(task)
+                #hand the task over to the supervisor, the Agent Runner spawns the workers off this thread
+                task_supervisor.dispatch(task, "download")
             except Exception as e:
-                log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {e}", logging.ERROR)
+                log_writer.log("> > ScheduleManager/__downloadtask_schedule: %s", logging.ERROR, e)
             #endTry
         #endIfElse    
         
-        log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: return: NONE", logging.DEBUG )
+        log_writer.log("< < ScheduleManager/__downloadtask_schedule: return: NONE", logging.DEBUG )
 
 # ----> QUOTE TASK SCHEDULER <--------------------------------------------------------------------------------------------------
     def __quotetask_schedule(self, task):
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {task.task_ref}", logging.DEBUG )
+        log_writer.log("> > ScheduleManager/__quotetask_schedule: %s", logging.DEBUG, task.task_ref )
 
         if Utils.scheduler_no_tasks_window():
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
+            log_writer.log("> > ScheduleManager/__quotetask_schedule: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
             #We can't execute this schedule, as we are in a no-tasks window
-        elif killswitch_checker.check_for_kill_switch()[0]:
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: check_for_kill_switch: TRUE", logging.DEBUG )
+        elif killswitch_monitor.is_active():
+            log_writer.log("> > ScheduleManager/__quotetask_schedule: kill_switch: ACTIVE", logging.DEBUG )
             #We can't execute this schedule, kill switch is active
         else:
             try:
-                #pass the task over to the Agent Runner to spawn the workers
-                agent_runner = AgentRunner()
-                self.agent_runners.append(agent_runner) # Keep track of AgentRunner instances 
-                agent_runner.exec_quote_task(task)
+                #hand the task over to the supervisor, the Agent Runner spawns the workers off this thread
+                task_supervisor.dispatch(task, "quote")
             except Exception as e:
-                log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {e}", logging.ERROR)
+                log_writer.log("> > ScheduleManager/__quotetask_schedule: %s", logging.ERROR, e)
             #endTry
         #endIfElse    
         
-        log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: return: NONE", logging.DEBUG )
+        log_writer.log("< < ScheduleManager/__quotetask_schedule: return: NONE", logging.DEBUG )
 
 # ----> UPLOAD TASK SCHEDULER <--------------------------------------------------------------------------------------------------
     def __uploadtask_schedule(self, task):
-        log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {task.task_ref}", logging.DEBUG )
+        log_writer.log("> > ScheduleManager/__uploadtask_schedule: %s", logging.DEBUG, task.task_ref )
 
         if Utils.scheduler_no_tasks_window():
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
+            log_writer.log("> > ScheduleManager/__uploadtask_schedule: _scheduler_no_tasks_window: TRUE", logging.DEBUG )
             #We can't execute this schedule, as we are in a no-tasks window
-        elif killswitch_checker.check_for_kill_switch()[0]:
-            log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: check_for_kill_switch: TRUE", logging.DEBUG )
+        elif killswitch_monitor.is_active():
+            log_writer.log("> > ScheduleManager/__uploadtask_schedule: kill_switch: ACTIVE", logging.DEBUG )
             #We can't execute this schedule, kill switch is active
         else:
             try:
-                #pass the task over to the Agent Runner to spawn the workers
-                agent_runner = AgentRunner()
-                self.agent_runners.append(agent_runner) # Keep track of AgentRunner instances 
-                agent_runner.exec_upload_task(task)
+                #hand the task over to the supervisor, the Agent Runner spawns the workers off this thread
+                task_supervisor.dispatch(task, "upload")
             except Exception as e:
-                log_writer.log(f"> > {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: {e}", logging.ERROR)
+                log_writer.log("> > ScheduleManager/__uploadtask_schedule: %s", logging.ERROR, e)
             #endTry
         #endIfElse    
         
-        log_writer.log(f"< < {self.__class__.__name__}/{inspect.currentframe().f_code.co_name}: return: NONE", logging.DEBUG )
+        log_writer.log("< < ScheduleManager/__uploadtask_schedule: return: NONE", logging.DEBUG )
 
 # ----> LIST TASK <-----------------------------------------------------------------------------------------------------------
     def list_schedules(self):
@@ -206,7 +283,7 @@ class ScheduleManager:
             print("No tasks scheduled.")
         else:
             for task in self.tasks:
-                log_writer.log(f"Task: {task}")
+                log_writer.log("Task: %s", logging.INFO, task)
 
     def task_already_scheduled(self, time):
         for _, _, scheduled_time in self.tasks:
@@ -214,60 +291,115 @@ class ScheduleManager:
                 return True
         return False
 
-    def __run_pendingSM(self):
-        while not self._stop_eventSM.is_set():
-            if not self._paused:
-                self._schedulerSM.run_pending()
-            time.sleep(1)
+    # Start lag of every timer job goes into the latency histograms, so schedule drift shows up in the summary
+    def __record_lag(self, job, lag):
+        Performance().latency.record(("schedule_lag", None, job.name), max(lag, 0.0))
+        log_writer.log("> > ScheduleManager/__record_lag: %s started %.3fs after its deadline", logging.DEBUG, job.name, lag)
+
+    # Ask the fetch thread for a fetch_tasks(), from any thread - asks made while a fetch runs are one more fetch
+    def __request_fetch(self):
+        if not self._stop_eventTM.is_set():
+            self.__fetch_wanted.set()
+        #endIf
+
+    # The fetch (up to FETCH_CONNECT_TIMEOUT + FETCH_READ_TIMEOUT against github), the reconcile and the purge run
+    # here, off the timer thread
+    def __fetch_loop(self):
+        while True:
+            self.__fetch_wanted.wait()
+            if self._stop_eventTM.is_set():
+                return
+            #endIf
+            self.__fetch_wanted.clear()
+            try:
+                self.fetch_tasks()
+            except Exception as e:
+                log_writer.log("> > ScheduleManager/__fetch_loop: fetch_tasks failed: %s", logging.ERROR, e)
+            #endTry
+        #endWhile
 
-    def __run_pendingTM(self):
-        while not self._stop_eventTM.is_set():
-            self._schedulerTM.run_pending()
-            time.sleep(1)        
+    # Called by the kill-switch poller when it flips.  ON holds the schedule straight away; OFF fetches the tasks
+    # again, as a fetch made while it was ON skipped them.
+    def __on_kill_switch(self, active):
+        if active:
+            self.pause_schedule()
+        else:
+            self.__request_fetch()
+        #endIfElse
+
+    # Called by the watcher when a local SCHEDULER_URL is saved
+    def __on_source_changed(self):
+        self.__request_fetch()
+
+    # Called by TM every SCHEDULER_REFRESH_SECS or at SCHEDULER_CHECK, after a random jitter either way so a fleet of
+    # agents started (or restarted) together doesn't stampede github
+    def __fetch_tasks_scheduled(self):
+        self.__request_fetch()
 
     def __purge_envionment(self):
-        #todo : routines to clear out old test runs, logs, and cache
-        pass
+        #todo : routines to clear out old test runs, logs
+        ScratchSpace().purge_stale(older_than_secs=cls_agent.Configuration.SCRATCH_STALE_SECS)
 
     def initiate(self):
         if not self._instance:
-            self.scheduler_threadSM = threading.Thread(target=self.__run_pendingSM,name="Thread-1(Scheduler.ScheduleManager.SM)")
-            self.scheduler_threadSM.start()
-            self._paused = False
+            # nothing in the scratch space is in use yet, so clear out what a previous run left behind
+            ScratchSpace().purge_stale()
+            killswitch_monitor.start()
 
-            self.scheduler_threadTM = threading.Thread(target=self.__run_pendingTM,name="Thread-1(Scheduler.ScheduleManager.TM)")
-            self.scheduler_threadTM.start()
+            killswitch_monitor.add_listener(self.__on_kill_switch)
+
+            timer.on_lag = self.__record_lag
+            timer.start()
+            self.__fetch_thread = threading.Thread(target=self.__fetch_loop, daemon=True, name="Thread-13(ScheduleManager._fetch_loop)")
+            self.__fetch_thread.start()
+            self.resume_schedule()
 
-            #to-do: change schedule to every minute for fast refresh, and ability to invoke refresh with rate limit
-            self._schedulerTM.every().hour.at(cls_agent.Configuration.SCHEDULER_CHECK).do(self.fetch_tasks)
-            #self._schedulerTM.every(1).minutes.do(self.fetch_tasks)
-            log_writer.log(f"Starting TM Scheduler to check github for new jobs at {cls_agent.Configuration.SCHEDULER_CHECK} every hour", logging.INFO)
+            #local control sources are reloaded when they are saved, the TM refresh below is then only a backstop
+            watcher.watch(cls_agent.Configuration.SCHEDULER_URL, self.__on_source_changed, suffix=".xml")
+            watcher.watch(cls_agent.Configuration.CSV_URL, FileCatalog().invalidate, suffix=".csv")
+            watcher.start()
+
+            #refreshes only apply what changed, so they can run every minute - or once an hour at SCHEDULER_CHECK
+            if cls_agent.Configuration.SCHEDULER_REFRESH_SECS > 0:
+                #the jitter is held to half the interval, so refreshes stay at least half an interval apart
+                refresh_secs = cls_agent.Configuration.SCHEDULER_REFRESH_SECS
+                timer.every(refresh_secs, self.__fetch_tasks_scheduled, name="fetch_tasks", group="TM", jitter=lambda: fetcher.refresh_jitter(refresh_secs / 2))
+                log_writer.log("Starting TM Scheduler to check github for new jobs every %s seconds (+%ss jitter)", logging.INFO, refresh_secs, min(cls_agent.Configuration.FETCH_JITTER_SECS, refresh_secs / 2))
+            else:
+                timer.hourly_at(cls_agent.Configuration.SCHEDULER_CHECK, self.__fetch_tasks_scheduled, name="fetch_tasks", group="TM", jitter=fetcher.refresh_jitter)
+                log_writer.log("Starting TM Scheduler to check github for new jobs at %s (+%ss jitter) every hour", logging.INFO, cls_agent.Configuration.SCHEDULER_CHECK, cls_agent.Configuration.FETCH_JITTER_SECS)
+            #endIfElse
             self._instance = True      
         else:
-            log_writer.log(F"Scheduler intiate has been called more than once, this is not supported.", logging.ERROR)
+            log_writer.log("Scheduler intiate has been called more than once, this is not supported.", logging.ERROR)
         #endIfElse
 
     def terminate(self):
-        self._stop_eventSM.set()
         self._stop_eventTM.set()
-        self.scheduler_threadSM.join()
-        self.scheduler_threadTM.join()
-        log_writer.log(f"Agent Scheduler TM & SM received Terminate signal -", logging.WARNING)
+        self.__fetch_wanted.set()   # wakes the fetch thread, to see the stop
+        watcher.stop()
+        timer.stop()
+        killswitch_monitor.stop()
+        log_writer.log("Agent Scheduler TM & SM received Terminate signal -", logging.WARNING)
 
         # Ensure all AgentRunner instances are cleaned up 
-        for runner in self.agent_runners: 
-            runner.cleanup() 
-        log_writer.log(f"Agent Scheduler - AgentRunner instances cleaned up", logging.INFO)
+        task_supervisor.shutdown()
+        WorkerPool().shutdown()
+        FileVerifier().shutdown()
+        log_writer.log("Agent Scheduler - AgentRunner instances cleaned up", logging.INFO)
 
     def pause_schedule(self):
         self._paused = True
-        log_writer.log(f"Agent Scheduler SM received pause signal ||", logging.INFO)
+        timer.pause("SM")
+        log_writer.log("Agent Scheduler SM received pause signal ||", logging.INFO)
 
     def resume_schedule(self):
         self._paused = False
-        log_writer.log(f"Agent Scheduler SM received resume signal +", logging.INFO)
+        timer.resume("SM")
+        log_writer.log("Agent Scheduler SM received resume signal +", logging.INFO)
 
     def clear_schedule(self):
-        self._schedulerSM.clear()
+        timer.clear("SM")
         self.tasks = []
-        log_writer.log(f"Agent Scheduler SM received clear signal >|", logging.INFO)
\ No newline at end of file
+        self.__live = {}
+        log_writer.log("Agent Scheduler SM received clear signal >|", logging.INFO)
\ No newline at end of file
@@ -2,7 +2,7 @@
 ===============================================================================
 Title : tasks.py
 
-Description : Task loader and task definition
+Description : Task loader, and the validated task definition
 
 Copyright 2024 - Jadkins-Me
 
@@ -15,70 +15,273 @@ permissions and limitations relating to use of the Code/Software.
 ===================================================================================================
 """
 
+import hashlib
+import json
 import xml.etree.ElementTree as ET
 import requests
 import logging
+from dataclasses import asdict, dataclass, field
+from typing import Optional
 from log import LogWriter
 from application import Agent
+from fetcher import ControlFetcher
+from agent.agent_limiter import parse_rate
 
 # handle to logging
 log_writer = LogWriter()
 cls_agent = Agent()
+fetcher = ControlFetcher()
 
-class Agent_Task:
-    def __init__(self, task_ref, description, time_period, time_offset, test_type, test_options):
-        self.task_ref = task_ref
-        self.description = description
-        self.time_period = time_period
-        self.time_offset = time_offset
-        self.test_type = test_type
-        self.test_options = test_options
-
-    def __repr__(self):
-        return (f"Task(task_ref={self.task_ref}, description={self.description}, "
-                f"time_period={self.time_period}, time_offset={self.time_offset}, "
-                f"test_type={self.test_type}, test_options={self.test_options})")
-
-    #todo: need better exception handling to deal with badly formed XML
-    def fetch_and_parse_xml(url):
+CONST_TEST_TYPES = ("download", "upload", "quote")
+CONST_FILESIZES = ("tiny", "small", "medium", "large", "huge", "giga", "tera", "chunka", "chunkb")  # as the download CSV
+CONST_ARRIVALS = ("closed", "poisson", "constant")  # closed = each worker waits on its own download, see AgentRunner
+CONST_BOOLEANS = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+
+class TaskError(ValueError):
+    pass
+
+# -----> option converters, raise ValueError with the reason ---------------------------------------------------
+def _to_int(minimum: int, maximum: int = None):
+    def convert(value: str) -> int:
+        if not value.strip().lstrip("-").isdigit():
+            raise ValueError("must be a whole number")
+        #endIf
+        number = int(value.strip())
+        if number < minimum or (maximum is not None and number > maximum):
+            raise ValueError(f"must be between {minimum} and {maximum}" if maximum is not None else f"must be {minimum} or more")
+        #endIf
+        return number
+    return convert
+
+def _to_bool(value: str) -> bool:
+    if value.strip().lower() not in CONST_BOOLEANS:
+        raise ValueError(f"must be one of {', '.join(CONST_BOOLEANS)}")
+    #endIf
+    return CONST_BOOLEANS[value.strip().lower()]
+
+def _to_offset(value: str) -> int:
+    # "false" has always meant no offset
+    return 0 if value.strip().lower() == "false" else _to_int(0)(value)
+
+def _to_filesize(value: str) -> str:
+    if value.strip().lower() not in CONST_FILESIZES:
+        raise ValueError(f"must be one of {', '.join(CONST_FILESIZES)}")
+    #endIf
+    return value.strip().lower()
+
+def _to_arrival(value: str) -> str:
+    if value.strip().lower() not in CONST_ARRIVALS:
+        raise ValueError(f"must be one of {', '.join(CONST_ARRIVALS)}")
+    #endIf
+    return value.strip().lower()
+
+def _to_arrival_rate(value: str) -> float:
+    try:
+        rate = float(value)
+    except ValueError:
+        raise ValueError("must be a number of requests a minute")
+    #endTry
+    if rate <= 0:
+        raise ValueError("must be more than 0")
+    #endIf
+    return rate
+
+def _to_rate(value: str) -> str:
+    try:
+        parse_rate(value)
+    except ValueError:
+        raise ValueError("must be <count>/<second|minute|hour|day>, with a count of 0 or more")
+    #endTry
+    return value.strip()
+
+def _to_burst(value: str) -> float:
+    try:
+        burst = float(value)
+    except ValueError:
+        raise ValueError("must be a number")
+    #endTry
+    if burst < 1:
+        raise ValueError("must be 1 or more")
+    #endIf
+    return burst
+
+# <Option key=".."> -> (TaskSpec field, converter)
+CONST_OPTIONS = {
+    "filesize": ("filesize", _to_filesize),
+    "workers": ("workers", _to_int(1)),
+    "repeat": ("repeat", _to_bool),
+    "offset": ("offset", _to_offset),
+    "timeout": ("timeout", _to_int(1)),
+    "retry": ("retry", _to_int(0)),
+    "rate": ("rate", _to_rate),
+    "burst": ("burst", _to_burst),
+    "arrival": ("arrival", _to_arrival),
+    "arrival_rate": ("arrival_rate", _to_arrival_rate),
+}
+
+# A task from the control XML, parsed and validated once when the XML is loaded - everything that runs the task
+# reads these typed fields, and never looks at the XML strings again.  Frozen, so a running task can't see its
+# definition change under it; a changed task in the XML is a new TaskSpec, with a new content_hash.
+@dataclass(frozen=True)
+class TaskSpec:
+    task_ref: str
+    description: str
+    time_period: int                # minute past the hour
+    time_offset: int
+    test_type: str                  # download, upload or quote
+    filesize: str = "tiny"
+    workers: int = 1
+    repeat: bool = False
+    offset: int = 0                 # minutes, a random delay of up to this before each download
+    timeout: int = 30
+    retry: int = 3
+    rate: Optional[str] = None      # per task limit, on top of the limit for the test type
+    burst: float = 1
+    arrival: str = "closed"         # closed, or open loop - poisson or constant arrivals at arrival_rate
+    arrival_rate: Optional[float] = None    # open loop requests a minute, workers bounds how many are in flight
+    content_hash: str = field(default="", init=False, compare=False)
+
+    def __post_init__(self):
+        # everything that defines how the task runs, so the schedule can tell a changed task from an unchanged one
+        content = {key: value for key, value in asdict(self).items() if key != "content_hash"}
+        object.__setattr__(self, "content_hash", hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest())
+
+    # Builds a TaskSpec from a <Task> element, raises TaskError saying what is wrong with it
+    @classmethod
+    def from_xml(cls, element: ET.Element) -> 'TaskSpec':
+        task_ref = (element.findtext('TaskRef') or "").strip()
+        if not task_ref:
+            raise TaskError("a <Task> has no <TaskRef>")
+        #endIf
+
+        def text(tag: str, required: bool = True) -> str:
+            value = (element.findtext(tag) or "").strip()
+            if required and not value:
+                raise TaskError(f"task {task_ref} <{tag}> is missing")
+            #endIf
+            return value
+
+        fields = {
+            "task_ref": task_ref,
+            "description": text('Description', required=False)[:100],
+            "time_period": cls.__convert(task_ref, "<TimePeriod>", text('TimePeriod'), _to_int(0, 59)),
+            "time_offset": cls.__convert(task_ref, "<TimeOffset>", text('TimeOffset'), _to_int(0)),
+            "test_type": text('TestType').lower(),
+        }
+        if fields["test_type"] not in CONST_TEST_TYPES:
+            raise TaskError(f"task {task_ref} <TestType> '{fields['test_type']}' must be one of {', '.join(CONST_TEST_TYPES)}")
+        #endIf
+
+        options = element.find('TestOptions')
+        seen = {}
+        for option in (options.findall('Option') if options is not None else []):
+            key, value = option.attrib.get('key', '').strip().lower(), option.attrib.get('value')
+            if not key or value is None:
+                raise TaskError(f"task {task_ref} has an <Option> without a key or value")
+            #endIf
+            if key not in CONST_OPTIONS:
+                log_writer.log("Task %s option '%s' is not recognised, ignored", logging.WARNING, task_ref, key)
+                continue
+            #endIf
+            if key in seen:
+                if seen[key] != value:
+                    raise TaskError(f"task {task_ref} option '{key}' is set twice, to '{seen[key]}' and '{value}'")
+                #endIf
+                log_writer.log("Task %s option '%s' is set twice", logging.WARNING, task_ref, key)
+                continue
+            #endIf
+            seen[key] = value
+            name, converter = CONST_OPTIONS[key]
+            fields[name] = cls.__convert(task_ref, f"option '{key}'", value, converter)
+        #endFor
+
+        if fields.get("arrival", "closed") != "closed" and "arrival_rate" not in fields:
+            raise TaskError(f"task {task_ref} option 'arrival' is {fields['arrival']}, but there is no 'arrival_rate'")
+        #endIf
+
+        # the quota is this agent's, the XML is shared by every agent - so clamp rather than reject
+        if fields.get("workers", 1) > cls_agent.Configuration.WORKER_TASK_QUOTA:
+            log_writer.log("Task %s workers %s is over the quota, limited to %s", logging.WARNING, task_ref, fields["workers"], cls_agent.Configuration.WORKER_TASK_QUOTA)
+            fields["workers"] = cls_agent.Configuration.WORKER_TASK_QUOTA
+        #endIf
+        return cls(**fields)
+
+    @staticmethod
+    def __convert(task_ref: str, what: str, value: str, converter):
         try:
-            response = requests.get(cls_agent.Configuration.SCHEDULER_URL)
-            response.raise_for_status()  # Raise an exception if the request fails
-        except requests.exceptions.RequestException as e:
-            log_writer.log(f"Error fetching the XML data: {e}", logging.ERROR)
-            cls_agent.Exception.throw(error=f"tasks.fetch_and_parse_xml: Error {e}")
-            return []
+            return converter(value)
+        except ValueError as e:
+            raise TaskError(f"task {task_ref} {what} '{value}' is invalid: {e}")
         #endTry
 
+# A <Limit> element as (test type, (rate, burst)) for Limiter().configure(), raises TaskError saying what is wrong with it
+def _limit_from_xml(element: ET.Element):
+    test_type = element.attrib.get('type', '').strip().lower()
+    if test_type not in CONST_TEST_TYPES:
+        raise TaskError(f"limit type '{element.attrib.get('type', '')}' must be one of {', '.join(CONST_TEST_TYPES)}")
+    #endIf
+    if 'rate' not in element.attrib:
+        raise TaskError(f"limit {test_type} has no rate")
+    #endIf
+    limit = []
+    for what, value, converter in (("rate", element.attrib['rate'], _to_rate), ("burst", element.attrib.get('burst', '1'), _to_burst)):
         try:
-            root = ET.fromstring(response.text)
-        except ET.ParseError as e:
-            log_writer.log(f"Error parsing the XML data: {e}", logging.ERROR)
-            cls_agent.Exception.throw(error=f"tasks.fetch_and_parse_xml: Error {e}")
-            return []
+            limit.append(converter(value))
+        except ValueError as e:
+            raise TaskError(f"limit {test_type} {what} '{value}' is invalid: {e}")
         #endTry
+    #endFor
+    return test_type, tuple(limit)
+
+# Returns (tasks, limits) - the valid tasks (an invalid task is logged and left out, the rest still run), and the
+# <Limits> for Limiter().configure(), which is the caller's to apply.  Returns None if the XML couldn't be fetched or
+# parsed, the caller keeps the schedule it has and the next refresh tries again - a short github outage or a half
+# saved file must not stop the agent.  url may be a local directory, when every .xml file in it is read as one
+# schedule.
+def fetch_and_parse_xml(url):
+    try:
+        responses = fetcher.fetch_all(url, suffix=".xml")  # Raises an exception if the request fails
+    except requests.exceptions.RequestException as e:
+        log_writer.log("Error fetching the XML data: %s", logging.ERROR, e)
+        return None
+    except OSError as e:
+        # a local source can be missing (or a directory of them empty) for a moment while it is saved, keep the schedule we have
+        log_writer.log("Error reading the XML data: %s", logging.ERROR, e)
+        return None
+    #endTry
 
-        tasks = []
+    roots = []
+    for response in responses:
+        try:
+            roots.append(ET.fromstring(response.text))
+        except ET.ParseError as e:
+            log_writer.log("Error parsing the XML data %s: %s", logging.ERROR, response.url, e)
+            # don't drop the tasks of a file that is half saved, or was cut short on the way
+            return None
+        #endTry
+    #endFor
 
-        #need better validation processing here
+    # <Limits><Limit type="download" rate="600/hour" burst="20"/></Limits> - types left out, or with an invalid limit,
+    # use the defaults
+    limits = {}
+    for root in roots:
+        for limit in root.findall('Limits/Limit'):
+            try:
+                test_type, limits[test_type] = _limit_from_xml(limit)
+            except TaskError as e:
+                log_writer.log("Limit rejected, %s", logging.ERROR, e)
+            #endTry
+        #endFor
+    #endFor
+    tasks = []
+    for root in roots:
         for task in root.findall('Task'):
             try:
-                task_ref = task.find('TaskRef').text
-                description = task.find('Description').text[:100]
-                time_period = task.find('TimePeriod').text
-                time_offset = task.find('TimeOffset').text
-                test_type = task.find('TestType').text
-
-                test_options = {}
-                for option in task.find('TestOptions').findall('Option'):
-                    test_options[option.attrib['key']] = option.attrib['value']
-                #endFor
-
-                tasks.append(Agent_Task(task_ref, description, time_period, time_offset, test_type, test_options))
-            except AttributeError as e:
-                #todo: better handling needed here
-                log_writer.log(f"Error processing a task element: {e}",logging.ERROR)
+                tasks.append(TaskSpec.from_xml(task))
+            except TaskError as e:
+                log_writer.log("Task rejected, %s", logging.ERROR, e)
             #endTry
         #endFor
-        
-        return tasks
+    #endFor
+
+    return tasks, limits
@@ -0,0 +1,283 @@
+"""
+===================================================================================================
+Title : watcher.py
+
+Description : Watches local control sources (tasks, file catalog), and reloads them as soon as they change
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from watcher import ControlWatcher
+# ControlWatcher().watch(cls_agent.Configuration.SCHEDULER_URL, callback, suffix=".xml")
+# ControlWatcher().start()
+#
+# Only local sources (a path or file:// url, see fetcher.py) are watched, an http source is left to the TM refresh.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from application import Agent
+from log import LogWriter
+from fetcher import ControlFetcher
+
+cls_agent = Agent()
+log_writer = LogWriter()
+fetcher = ControlFetcher()
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000                   # the watch was removed, the directory was deleted
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+CONST_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len - then len bytes of name
+
+# A file is watched through its directory rather than itself, as most editors save by writing a new file and
+# renaming it over the old one - a watch on the file would be left pointing at the old inode.  Events are collected
+# until the directory is quiet for CONTROL_WATCH_DEBOUNCE_SECS, so a save (often several events) calls back once.
+#
+# Linux inotify is used through ctypes, where that isn't available the sources are polled for a change of mtime
+# every CONTROL_WATCH_POLL_SECS instead.  A watched directory that is deleted or moved away (a checkout can do both)
+# is looked for every CONTROL_WATCH_POLL_SECS, and watched again once it is back.
+#
+# Callbacks run on the watcher thread, so they must hand long work off (the scheduler wakes its fetch thread).
+#
+# Notes : This is a single instance class, so ensure that is enforced.
+class ControlWatcher:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(ControlWatcher, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__lock = threading.Lock()
+            self.__watches = []                 # (directory, name or None for the whole directory, suffix, callback)
+            self.__thread = None
+            self.__stop = threading.Event()
+            self.__stop_pipe = None             # wakes the inotify select on stop
+            self.reloads = 0                    # callbacks made, for the /metrics endpoint
+
+    # Calls callback() whenever the source changes.  Returns False if the source isn't local, or doesn't exist.
+    def watch(self, source: str, callback, suffix: str = "") -> bool:
+        if not cls_agent.Configuration.CONTROL_WATCH_ENABLED or not fetcher.is_local(source):
+            return False
+        #endIf
+        path = fetcher.local_path(source)
+        if os.path.isdir(path):
+            watch = (path, None, suffix.lower(), callback)
+        elif os.path.isdir(os.path.dirname(path)):
+            watch = (os.path.dirname(path), os.path.basename(path), "", callback)
+        else:
+            log_writer.log("Control source %s not found, it will not be watched", logging.WARNING, path)
+            return False
+        #endIfElse
+        with self.__lock:
+            self.__watches.append(watch)
+        #endWith
+        log_writer.log("Watching %s for changes", logging.INFO, path)
+        return True
+
+    def __matches(self, watch, name: str) -> bool:
+        directory, file_name, suffix, _ = watch
+        if file_name is not None:
+            return name == file_name
+        #endIf
+        # a directory of sources, the same files fetch_all() would read
+        return not name.startswith(('.', '#')) and not name.endswith('~') and name.lower().endswith(suffix)
+
+    def __fire(self, watches):
+        for watch in watches:
+            self.reloads += 1
+            log_writer.log("Control source %s changed, reloading", logging.INFO, os.path.join(watch[0], watch[1] or ""))
+            try:
+                watch[3]()
+            except Exception as e:
+                log_writer.log("> > ControlWatcher/__fire: reload of %s failed: %s", logging.ERROR, watch[0], e)
+            #endTry
+        #endFor
+
+    # -----> inotify -------------------------------------------------------------
+    def __inotify(self):
+        # returns (libc, fd), or None if inotify can't be used here
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        #endTry
+        return (libc, fd) if fd >= 0 else None
+
+    # Returns False if the directory can't be watched (yet)
+    def __add_watch(self, libc, fd, watch, by_wd, log_failure=True) -> bool:
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+        wd = libc.inotify_add_watch(fd, watch[0].encode(), mask)
+        if wd < 0:
+            if log_failure:
+                log_writer.log("Unable to watch %s: %s", logging.WARNING, watch[0], os.strerror(ctypes.get_errno()))
+            #endIf
+            return False
+        #endIf
+        by_wd.setdefault(wd, []).append(watch)
+        return True
+
+    def __watch_inotify(self, libc, fd):
+        by_wd = {}                              # watch descriptor -> [watch]
+        lost = []                               # watches whose directory is gone, until it is back
+        with self.__lock:
+            watches = list(self.__watches)
+        #endWith
+        for watch in watches:
+            if not self.__add_watch(libc, fd, watch, by_wd):
+                lost.append(watch)
+            #endIf
+        #endFor
+
+        stop_read = self.__stop_pipe[0]
+        pending = []
+        while not self.__stop.is_set():
+            # block until there is an event, or while some are pending until the directory goes quiet - and wake
+            # now and then to look for a lost directory
+            if pending:
+                timeout = cls_agent.Configuration.CONTROL_WATCH_DEBOUNCE_SECS
+            else:
+                timeout = cls_agent.Configuration.CONTROL_WATCH_POLL_SECS if lost else None
+            #endIfElse
+            ready, _, _ = select.select([fd, stop_read], [], [], timeout)
+            if stop_read in ready:
+                break
+            #endIf
+            if not ready:
+                for watch in list(lost):
+                    if self.__add_watch(libc, fd, watch, by_wd, log_failure=False):
+                        # whatever is in it now is new to us
+                        log_writer.log("Control source %s is back, watching it again", logging.INFO, watch[0])
+                        lost.remove(watch)
+                        if watch not in pending:
+                            pending.append(watch)
+                        #endIf
+                    #endIf
+                #endFor
+                self.__fire(pending)
+                pending = []
+                continue
+            #endIf
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            #endTry
+            offset = 0
+            while offset + CONST_EVENT.size <= len(data):
+                wd, event_mask, _, length = CONST_EVENT.unpack_from(data, offset)
+                name = data[offset + CONST_EVENT.size:offset + CONST_EVENT.size + length].rstrip(b"\0").decode(errors="replace")
+                offset += CONST_EVENT.size + length
+                if event_mask & (IN_IGNORED | IN_MOVE_SELF):
+                    # the watch is gone, or follows the directory to wherever it was moved - look for it by path
+                    if event_mask & IN_MOVE_SELF:
+                        libc.inotify_rm_watch(fd, wd)
+                    #endIf
+                    for watch in by_wd.pop(wd, []):
+                        log_writer.log("Control source %s has gone, watching for it to come back", logging.WARNING, watch[0])
+                        lost.append(watch)
+                        if watch not in pending:
+                            pending.append(watch)
+                        #endIf
+                    #endFor
+                    continue
+                #endIf
+                for watch in by_wd.get(wd, []):
+                    # the directory itself going away is a change to everything in it
+                    if (event_mask & (IN_DELETE_SELF | IN_MOVE_SELF) or self.__matches(watch, name)) and watch not in pending:
+                        pending.append(watch)
+                    #endIf
+                #endFor
+            #endWhile
+        #endWhile
+        os.close(fd)
+
+    # -----> polling, where there is no inotify ---------------------------------------
+    def __signature(self, watch):
+        directory, file_name, suffix, _ = watch
+        try:
+            names = [file_name] if file_name is not None else [name for name in os.listdir(directory) if self.__matches(watch, name)]
+            signature = []
+            for name in sorted(names):
+                stat = os.stat(os.path.join(directory, name))
+                signature.append((name, stat.st_mtime_ns, stat.st_size))
+            #endFor
+            return tuple(signature)
+        except OSError:
+            return None
+        #endTry
+
+    def __watch_polling(self):
+        with self.__lock:
+            watches = list(self.__watches)
+        #endWith
+        signatures = {id(watch): self.__signature(watch) for watch in watches}
+        while not self.__stop.wait(cls_agent.Configuration.CONTROL_WATCH_POLL_SECS):
+            changed = []
+            for watch in watches:
+                signature = self.__signature(watch)
+                if signature != signatures[id(watch)]:
+                    signatures[id(watch)] = signature
+                    changed.append(watch)
+                #endIf
+            #endFor
+            self.__fire(changed)
+        #endWhile
+
+    def __run(self):
+        inotify = self.__inotify()
+        if inotify is None:
+            log_writer.log("inotify is not available, polling control sources every %ss", logging.INFO, cls_agent.Configuration.CONTROL_WATCH_POLL_SECS)
+            self.__watch_polling()
+        else:
+            self.__watch_inotify(*inotify)
+        #endIfElse
+
+    def start(self):
+        if self.__thread is not None or not self.__watches:
+            return
+        #endIf
+        self.__stop.clear()
+        self.__stop_pipe = os.pipe()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="Thread-12(ControlWatcher._run)")
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        #endIf
+        self.__stop.set()
+        os.write(self.__stop_pipe[1], b"\0")
+        self.__thread.join(timeout=5)
+        for end in self.__stop_pipe:
+            os.close(end)
+        #endFor
+        self.__thread, self.__stop_pipe = None, None
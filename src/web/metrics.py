@@ -0,0 +1,244 @@
+"""
+===================================================================================================
+Title : metrics.py
+
+Description : Prometheus /metrics endpoint, for the live state of the agent
+
+Copyright 2024 - Jadkins-Me
+
+This Code/Software is licensed to you under GNU AFFERO GENERAL PUBLIC LICENSE (GPL), Version 3
+Unless required by applicable law or agreed to in writing, the Code/Software distributed
+under the GPL Licence is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied. Please review the Licences for the specific language governing
+permissions and limitations relating to use of the Code/Software.
+
+===================================================================================================
+"""
+
+# reference from other objects with
+# from web import MetricsServer
+# MetricsServer().start()
+#
+# curl http://127.0.0.1:9108/metrics
+# curl -X POST http://127.0.0.1:9108/profile/cpu       (start/stop, as the >> p << key)
+# curl -X POST http://127.0.0.1:9108/profile/memory    (start/stop, as the >> m << key)
+# curl -X POST http://127.0.0.1:9108/profile/snapshot  (write a memory diff, and keep tracing)
+#
+# The /profile routes write files, so they are off unless METRICS_HTTP_PROFILE_ENABLED, and even then only answer a
+# client on this host - METRICS_HTTP_HOST = '0.0.0.0' for a remote scrape doesn't open them up.
+
+import ipaddress
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from application import Agent
+from log import LogWriter
+from kill_switch import KillSwitchMonitor
+from agent.agent_performance import Performance
+from agent.agent_pool import WorkerPool
+from agent.agent_scratch import ScratchSpace
+from agent.agent_limiter import Limiter
+from agent.agent_influx import InfluxSink
+from agent.agent_profiler import Profiler
+from watcher import ControlWatcher
+from client import ant_engine
+
+cls_agent = Agent()
+log_writer = LogWriter()
+
+CONST_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# One metric family in the text exposition format, samples are (suffix, {label: value}, value)
+def _family(name: str, kind: str, help_text: str, samples: list) -> list:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        label_set = ",".join(f'{key}="{_label_value(label)}"' for key, label in labels.items() if label is not None)
+        lines.append(f"{name}{suffix}{{{label_set}}} {value}" if label_set else f"{name}{suffix} {value}")
+    #endFor
+    return lines
+
+# Every value here is already aggregated by the object that owns it - a scrape copies a few dicts out under their
+# locks (or reads a counter), then formats without holding anything, so a worker never waits on a scrape.
+def render() -> str:
+    lines = []
+    perf = Performance()
+
+    # results
+    totals = perf.totals.snapshot()
+    samples = []
+    for (test_type, file_size), series in totals.items():
+        labels = {"test": test_type, "filesize": file_size}
+        for bound, count in zip(perf.totals.BUCKETS, series["buckets"]):
+            samples.append(("_bucket", {**labels, "le": bound}, count))
+        #endFor
+        samples.append(("_bucket", {**labels, "le": "+Inf"}, series["count"]))
+        samples.append(("_sum", labels, round(series["sum"], 3)))
+        samples.append(("_count", labels, series["count"]))
+    #endFor
+    lines += _family("ant_agent_test_duration_seconds", "histogram", "Test execution time", samples)
+    lines += _family("ant_agent_test_errors_total", "counter", "Test errors by class",
+        [("", {"test": test_type, "filesize": file_size, "error": error}, series[error]) for (test_type, file_size), series in totals.items() for error in perf.totals.ERRORS])
+    lines += _family("ant_agent_bytes_written_total", "counter", "Bytes written by the client",
+        [("", {"test": test_type, "filesize": file_size}, series["bytes"]) for (test_type, file_size), series in totals.items()])
+
+    # streaming percentiles from the last 1 minute flush
+    samples = []
+    for (test_type, file_size, task_ref), windows in perf.quantiles.items():
+        for window, quantiles in windows.items():
+            for quantile, value in quantiles.items():
+                samples.append(("", {"test": test_type, "filesize": file_size, "task": task_ref, "window": window, "quantile": quantile}, value))
+            #endFor
+        #endFor
+    #endFor
+    lines += _family("ant_agent_test_latency_seconds", "gauge", "Test latency percentiles over the 1m/5m/1h windows", samples)
+
+    # gauges set by the agent as it runs, e.g. ant_agent_concurrency_limit{task=".."}
+    families = {}
+    for (name, tags), fields in list(perf.gauges.items()):
+        for field, value in fields.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                families.setdefault(f"ant_agent_{name}_{field}", []).append(("", dict(tags), value))
+            #endIf
+        #endFor
+    #endFor
+    for family, samples in families.items():
+        lines += _family(family, "gauge", f"Latest {family[len('ant_agent_'):].replace('_', ' ')}", samples)
+    #endFor
+
+    # threads and processes
+    lines += _family("ant_agent_thread_tasks", "gauge", "Task threads running", [("", {}, cls_agent.get_thread_task())])
+    lines += _family("ant_agent_thread_workers", "gauge", "Worker threads running", [("", {}, cls_agent.get_thread_worker())])
+    lines += _family("ant_agent_client_processes", "gauge", "Client subprocesses running", [("", {}, ant_engine().count())])
+
+    pool = WorkerPool().stats()
+    lines += _family("ant_agent_pool_workers", "gauge", "Worker pool size", [("", {}, pool["size"])])
+    lines += _family("ant_agent_pool_active", "gauge", "Worker pool jobs running", [("", {}, pool["active"])])
+    lines += _family("ant_agent_pool_queued", "gauge", "Worker pool jobs waiting", [("", {}, pool["queued"])])
+    lines += _family("ant_agent_pool_rejected_total", "counter", "Jobs turned away by the worker pool", [("", {}, pool["rejected"])])
+
+    # load control
+    lines += _family("ant_agent_limiter_rejected_total", "counter", "Requests turned away by the rate limiter",
+        [("", {"test": test_type}, count) for test_type, count in Limiter().rejected.items()])
+    lines += _family("ant_agent_limiter_tokens", "gauge", "Tokens left in each rate limiter bucket",
+        [("", {"bucket": name}, bucket["tokens"]) for name, bucket in Limiter().stats().items()])
+
+    active, created_date = KillSwitchMonitor().get()
+    lines += _family("ant_agent_kill_switch_active", "gauge", "1 while the kill-switch is ON", [("", {}, int(active))])
+
+    # housekeeping
+    scratch = ScratchSpace().stats()
+    lines += _family("ant_agent_scratch_bytes", "gauge", "Bytes held in the scratch space", [("", {}, scratch["bytes"])])
+    lines += _family("ant_agent_scratch_files", "gauge", "Files held in the scratch space", [("", {}, scratch["files"])])
+    lines += _family("ant_agent_scratch_evicted_total", "counter", "Files evicted from the scratch space", [("", {}, scratch["evicted"])])
+
+    lines += _family("ant_agent_control_reloads_total", "counter", "Local control sources reloaded on change", [("", {}, ControlWatcher().reloads)])
+
+    influx = InfluxSink().stats()
+    lines += _family("ant_agent_influx_lines_total", "counter", "Lines written to InfluxDB", [("", {}, influx["written"])])
+    lines += _family("ant_agent_influx_spooled_total", "counter", "Batches spooled to disk", [("", {}, influx["spooled"])])
+
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        #endIf
+        try:
+            body = render().encode('utf-8')
+        except Exception as e:
+            log_writer.log("> > _MetricsHandler/do_GET: unable to render metrics: %s", logging.ERROR, e)
+            self.send_error(500)
+            return
+        #endTry
+        self.send_response(200)
+        self.send_header("Content-Type", CONST_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __is_loopback(self) -> bool:
+        try:
+            return ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            return False
+        #endTry
+
+    def __send_json(self, status: int, reply: dict):
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # profiling control, the same as the console keys - replies with the profiler state and any file written
+    def do_POST(self):
+        profiler = Profiler()
+        actions = {"/profile/cpu": profiler.toggle_cpu, "/profile/memory": profiler.toggle_memory, "/profile/snapshot": profiler.snapshot_memory}
+        action = actions.get(self.path.split("?")[0])
+        if action is None or not cls_agent.Configuration.METRICS_HTTP_PROFILE_ENABLED:
+            self.send_error(404)
+            return
+        #endIf
+        if not self.__is_loopback():
+            log_writer.log("Profiling request from %s refused, only local clients may profile", logging.WARNING, self.client_address[0])
+            self.send_error(403)
+            return
+        #endIf
+        try:
+            result = action()
+        except Exception as e:
+            log_writer.log("> > _MetricsHandler/do_POST: %s failed: %s", logging.ERROR, self.path, e)
+            self.__send_json(500, {"error": str(e)})
+            return
+        #endTry
+        self.__send_json(200, {**profiler.status(), "file": result if isinstance(result, str) else None})
+
+    def log_message(self, format, *args):
+        pass # scrapes would flood the console log
+
+# Notes : This is a single instance class, so ensure that is enforced.
+class MetricsServer:
+    #Ensure this is a single instance class
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance: cls._instance = super(MetricsServer, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            # Ensure __init__ runs only once
+            self.initialized = True
+
+            self.__server = None
+            self.__thread = None
+
+    def start(self):
+        if not cls_agent.Configuration.METRICS_HTTP_ENABLED or self.__server is not None:
+            return
+        #endIf
+        host, port = cls_agent.Configuration.METRICS_HTTP_HOST, cls_agent.Configuration.METRICS_HTTP_PORT
+        try:
+            self.__server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            log_writer.log("Metrics endpoint not started, unable to bind %s:%s: %s", logging.WARNING, host, port, e)
+            return
+        #endTry
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True, name="Thread-9(MetricsServer.serve_forever)")
+        self.__thread.start()
+        log_writer.log("Metrics endpoint listening on http://%s:%s/metrics", logging.INFO, host, port)
+
+    def shutdown(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        #endIf